@@ -0,0 +1,154 @@
+"""
+Generates synthetic directories of ISO8601 logfiles for benchmarking.
+
+Sample usage:
+
+    python -m benchmarks.generate /tmp/logs --prefixes 20 --hours 48 \
+        --size 1048576 --line-format haproxy
+
+"""
+
+import argparse
+import datetime
+import os
+import os.path
+import random
+
+#
+# Globals
+#
+
+BASE_TIMESTAMP = datetime.datetime(2013, 7, 27, 0, 0)
+ONE_HOUR = datetime.timedelta(hours=1)
+
+PATHS = ('/', '/login', '/api/v1/items', '/api/v1/items/42', '/static/app.js')
+METHODS = ('GET', 'GET', 'GET', 'POST', 'PUT')
+STATUSES = (200, 200, 200, 200, 302, 404, 500)
+
+
+def _haproxy_line(rng, timestamp):
+    return (
+        '{ts} haproxy[1234]: 10.0.{a}.{b}:{port} '
+        '[{ts}] www backend/web{n} 0/0/1/{ms}/{ms} {status} {size} - - '
+        '---- 1/1/0/0/0 0/0 "{method} {path} HTTP/1.1"\n'
+    ).format(
+        ts=timestamp.strftime('%Y-%m-%dT%H:%M:%S'),
+        a=rng.randint(0, 255), b=rng.randint(0, 255),
+        port=rng.randint(1024, 65535), n=rng.randint(1, 8),
+        ms=rng.randint(1, 500), status=rng.choice(STATUSES),
+        size=rng.randint(100, 50000), method=rng.choice(METHODS),
+        path=rng.choice(PATHS),
+    )
+
+
+def _json_line(rng, timestamp):
+    return (
+        '{{"time": "{ts}", "level": "info", "method": "{method}", '
+        '"path": "{path}", "status": {status}, "duration_ms": {ms}}}\n'
+    ).format(
+        ts=timestamp.strftime('%Y-%m-%dT%H:%M:%S'),
+        method=rng.choice(METHODS), path=rng.choice(PATHS),
+        status=rng.choice(STATUSES), ms=rng.randint(1, 500),
+    )
+
+
+def _syslog_line(rng, timestamp):
+    return '{ts} web{n} app[{pid}]: {method} {path} -> {status}\n'.format(
+        ts=timestamp.strftime('%Y-%m-%dT%H:%M:%S'),
+        n=rng.randint(1, 8), pid=rng.randint(100, 32000),
+        method=rng.choice(METHODS), path=rng.choice(PATHS),
+        status=rng.choice(STATUSES),
+    )
+
+
+LINE_FORMATS = {
+    'haproxy': _haproxy_line,
+    'json': _json_line,
+    'syslog': _syslog_line,
+}
+
+
+#
+# Generators
+#
+
+def logfile_names(prefixes, hours, suffix='us-west-2-i-ae23fega',
+                  extension='.log'):
+    """
+    Returns the names of prefixes x hours logfiles, all of them older
+    than the present.
+    """
+    return [
+        '{prefix}-{ts}-{suffix}{extension}'.format(
+            prefix='service{:03d}'.format(p),
+            ts=(BASE_TIMESTAMP + h * ONE_HOUR).strftime('%Y%m%dT%H%MZ'),
+            suffix=suffix,
+            extension=extension,
+        )
+        for p in range(prefixes)
+        for h in range(hours)
+    ]
+
+
+def write_logfile(path, size, line_format='haproxy', seed=0):
+    """ Writes about size bytes of log lines to path. """
+    rng = random.Random(seed)
+    make_line = LINE_FORMATS[line_format]
+    written = 0
+    timestamp = BASE_TIMESTAMP
+    with open(path, 'w') as f:
+        lines = []
+        while written < size:
+            line = make_line(rng, timestamp)
+            lines.append(line)
+            written += len(line)
+            timestamp += datetime.timedelta(milliseconds=rng.randint(0, 50))
+            if len(lines) >= 1000:
+                f.write(''.join(lines))
+                lines = []
+        f.write(''.join(lines))
+
+
+def generate_log_dir(log_dir, prefixes, hours, size, line_format='haproxy',
+                     extension='.log'):
+    """
+    Fills log_dir with prefixes x hours logfiles of about size bytes.
+    Returns their filenames.
+    """
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    filenames = logfile_names(prefixes, hours, extension=extension)
+    for seed, filename in enumerate(filenames):
+        write_logfile(
+            os.path.join(log_dir, filename), size, line_format, seed)
+    return filenames
+
+
+#
+# CLI functions
+#
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description='Generates a directory of synthetic logfiles.')
+    parser.add_argument('log_dir')
+    parser.add_argument('--prefixes', type=int, default=10)
+    parser.add_argument('--hours', type=int, default=24)
+    parser.add_argument(
+        '--size', type=int, default=64 * 1024,
+        help='Approximate size of each logfile, in bytes.')
+    parser.add_argument(
+        '--line-format', choices=sorted(LINE_FORMATS), default='haproxy')
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    generate_log_dir(
+        args.log_dir, args.prefixes, args.hours, args.size,
+        args.line_format
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""
+Times logjam's core functions against synthetic log directories, and
+writes the results as JSON so that releases can be compared.
+
+Sample usage:
+
+    python -m benchmarks.run --prefixes 50 --hours 48 --output bench.json
+
+"""
+
+import argparse
+import datetime
+import json
+import os
+import os.path
+import platform
+import shutil
+import string
+import sys
+import tempfile
+import time
+
+import logjam.compress
+import logjam.parse
+import logjam.upload
+from logjam.base_uploader import BaseUploader
+
+from . import generate
+
+
+#
+# A local stand-in for S3
+#
+
+class LocalUploader(BaseUploader):
+    """
+    Uploads logfiles by copying them into a local directory, using an
+    upload URI like file:///tmp/bucket/{prefix}/{year}/{filename}.
+    """
+
+    formatter = string.Formatter()
+
+    def _get_path(self, logfile):
+        uri = self.formatter.format(
+            self.upload_uri,
+            prefix=logfile.prefix,
+            year=logfile.timestamp.year,
+            month='{:02d}'.format(logfile.timestamp.month),
+            day='{:02d}'.format(logfile.timestamp.day),
+            filename=logfile.filename,
+        )
+        return uri[len('file://'):]
+
+    def check_uri(self):
+        if not self.upload_uri.startswith('file://'):
+            return 'LocalUploader requires a file:// URI'
+
+    def scan_remote(self, logfiles):
+        uploaded = set(
+            lf for lf in logfiles if os.path.exists(self._get_path(lf)))
+        return uploaded, set(logfiles) - uploaded
+
+    def upload_logfile(self, log_archive_dir, logfile):
+        path = self._get_path(logfile)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        shutil.copyfile(
+            os.path.join(log_archive_dir, logfile.filename), path)
+
+
+#
+# Harness
+#
+
+def time_runs(func, repeat, setup=None):
+    """
+    Calls func() repeat times, calling setup() (untimed) before each.
+    Returns the list of elapsed times, in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return times
+
+
+def summarize(times, items):
+    best = min(times)
+    return {
+        'runs': times,
+        'best_secs': best,
+        'items': items,
+        'items_per_sec': items / best if best else None,
+    }
+
+
+def bench_group_filenames(args, work_dir):
+    filenames = generate.logfile_names(args.prefixes, args.hours)
+    times = time_runs(
+        lambda: logjam.parse.group_filenames(filenames), args.repeat)
+    return summarize(times, len(filenames))
+
+
+def bench_yield_old_logfiles(args, work_dir):
+    filenames = generate.logfile_names(args.prefixes, args.hours)
+    now = datetime.datetime.utcnow()
+    times = time_runs(
+        lambda: list(logjam.compress.yield_old_logfiles(filenames, now)),
+        args.repeat
+    )
+    return summarize(times, len(filenames))
+
+
+def bench_scan_and_compress(args, work_dir):
+    log_dir = os.path.join(work_dir, 'compress')
+    source_dir = os.path.join(work_dir, 'source')
+    if not os.path.isdir(source_dir):
+        generate.generate_log_dir(
+            source_dir, args.prefixes, args.hours, args.size,
+            args.line_format
+        )
+
+    def setup():
+        if os.path.isdir(log_dir):
+            shutil.rmtree(log_dir)
+        shutil.copytree(source_dir, log_dir)
+
+    compress_cmd_args, compress_extension = logjam.compress.make_compressor(
+        args.codec, engine=args.engine)
+    times = time_runs(
+        lambda: logjam.compress.scan_and_compress(
+            log_dir, compress_cmd_args, compress_extension,
+            workers=args.workers
+        ),
+        args.repeat,
+        setup=setup
+    )
+    result = summarize(times, args.prefixes * args.hours)
+    result['bytes'] = args.prefixes * args.hours * args.size
+    result['bytes_per_sec'] = result['bytes'] / result['best_secs']
+    return result
+
+
+def bench_scan_and_upload_filenames(args, work_dir):
+    archive_dir = os.path.join(work_dir, 'archive')
+    bucket_dir = os.path.join(work_dir, 'bucket')
+    filenames = generate.generate_log_dir(
+        archive_dir, args.prefixes, args.hours, args.size,
+        args.line_format, extension='.log.gz'
+    )
+    upload_uri = 'file://' + bucket_dir + '/{prefix}/{year}/{month}/' \
+        '{day}/{filename}'
+
+    def setup():
+        if os.path.isdir(bucket_dir):
+            shutil.rmtree(bucket_dir)
+
+    times = time_runs(
+        lambda: logjam.upload.scan_and_upload_filenames(
+            archive_dir, filenames, LocalUploader(upload_uri)),
+        args.repeat,
+        setup=setup
+    )
+    return summarize(times, len(filenames))
+
+
+BENCHMARKS = {
+    'parse.group_filenames': bench_group_filenames,
+    'compress.yield_old_logfiles': bench_yield_old_logfiles,
+    'compress.scan_and_compress': bench_scan_and_compress,
+    'upload.scan_and_upload_filenames': bench_scan_and_upload_filenames,
+}
+
+
+#
+# CLI functions
+#
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks logjam against synthetic logfiles.')
+    parser.add_argument('--prefixes', type=int, default=10)
+    parser.add_argument('--hours', type=int, default=24)
+    parser.add_argument(
+        '--size', type=int, default=64 * 1024,
+        help='Approximate size of each logfile, in bytes.')
+    parser.add_argument(
+        '--line-format', choices=sorted(generate.LINE_FORMATS),
+        default='haproxy')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument(
+        '--codec', choices=logjam.compress.CODEC_NAMES, default='gzip')
+    parser.add_argument(
+        '--engine', choices=logjam.compress.ENGINES, default='subprocess')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument(
+        '--only', action='append', choices=sorted(BENCHMARKS),
+        help='Run only this benchmark. May be given more than once.')
+    parser.add_argument(
+        '--output', '-o',
+        help='Write results to this file instead of stdout.')
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='logjam-bench.')
+    try:
+        results = {}
+        for name in sorted(args.only or BENCHMARKS):
+            results[name] = BENCHMARKS[name](args, work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+
+    report = {
+        'date': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': dict(
+            (k, v) for k, v in vars(args).items()
+            if k not in ('only', 'output')
+        ),
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,487 @@
+"""
+An S3 Uploader that speaks HTTP itself, over logjam.eventloop, so that
+hundreds of uploads and listings can be in flight from a single thread.
+"""
+
+from __future__ import absolute_import
+
+import base64
+import collections
+import datetime
+import hashlib
+import hmac
+import logging
+import os
+import os.path
+import ssl
+import time
+import urllib
+import xml.etree.cElementTree as ElementTree
+
+import boto.exception
+
+from .base_uploader import AsyncBaseUploader
+from . import eventloop
+from . import parse
+from . import s3_uploader
+
+#
+# Globals
+#
+
+DEFAULT_MAX_IN_FLIGHT = 100
+DEFAULT_TIMEOUT = 60
+DEFAULT_REGION = 'us-east-1'
+
+SEND_SIZE = 256 * 1024
+
+EMPTY_SHA256 = hashlib.sha256('').hexdigest()
+# S3 accepts this in place of a payload's SHA256 (the payload is still
+# checked against its Content-MD5), which saves reading each file twice.
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+
+S3_NAMESPACE = '{http://s3.amazonaws.com/doc/2006-03-01/}'
+
+Credentials = collections.namedtuple(
+    'Credentials', ['access_key', 'secret_key', 'token', 'expiration'])
+
+Response = collections.namedtuple(
+    'Response', ['status', 'reason', 'headers', 'body'])
+
+
+#
+# Signing
+#
+
+def _quote(s, safe='-_.~'):
+    return urllib.quote(s, safe=safe)
+
+
+def _hmac_sha256(key, msg):
+    return hmac.new(key, msg, hashlib.sha256).digest()
+
+
+def get_canonical_query(query):
+    return '&'.join(
+        '{}={}'.format(_quote(k), _quote(v))
+        for k, v in sorted(query.items())
+    )
+
+
+def sign_request(method, host, path, query, headers, payload_hash,
+                 credentials, region, now, service='s3'):
+    """
+    Signs a request with AWS Signature Version 4.
+
+    Takes the request's method, Host, unquoted path, dict of query
+    parameters and dict of headers; the hex SHA256 of its payload (or
+    UNSIGNED_PAYLOAD); Credentials; and the region and UTC datetime to
+    sign for. Returns a new dict of headers that includes the
+    Authorization header, and every header it signs.
+    """
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    headers = dict(headers)
+    headers['Host'] = host
+    headers['x-amz-date'] = amz_date
+    headers['x-amz-content-sha256'] = payload_hash
+    if credentials.token:
+        headers['x-amz-security-token'] = credentials.token
+
+    signed = sorted(
+        (name.lower(), ' '.join(str(value).split()))
+        for name, value in headers.items()
+    )
+    signed_headers = ';'.join(name for name, _ in signed)
+    canonical_request = '\n'.join([
+        method,
+        _quote(path, safe='/-_.~'),
+        get_canonical_query(query),
+        ''.join('{}:{}\n'.format(name, value) for name, value in signed),
+        signed_headers,
+        payload_hash,
+    ])
+
+    scope = '/'.join([amz_date[:8], region, service, 'aws4_request'])
+    string_to_sign = '\n'.join([
+        'AWS4-HMAC-SHA256',
+        amz_date,
+        scope,
+        hashlib.sha256(canonical_request).hexdigest(),
+    ])
+
+    key = 'AWS4' + credentials.secret_key
+    for part in (amz_date[:8], region, service, 'aws4_request'):
+        key = _hmac_sha256(key, part)
+    signature = hmac.new(key, string_to_sign, hashlib.sha256).hexdigest()
+
+    headers['Authorization'] = (
+        'AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, '
+        'Signature={}'.format(
+            credentials.access_key, scope, signed_headers, signature)
+    )
+    return headers
+
+
+#
+# HTTP
+#
+
+def _decode_chunked(data):
+    chunks = []
+    while True:
+        size_line, _, data = data.partition('\r\n')
+        size = int(size_line.split(';')[0], 16)
+        if size == 0:
+            return ''.join(chunks)
+        chunks.append(data[:size])
+        data = data[size + 2:]
+
+
+def parse_response(data, method):
+    """
+    Parses the whole of an HTTP/1.1 response, as read up to the
+    connection's close. Returns a Response.
+
+    A response that's empty, truncated or otherwise malformed (as when
+    the peer closes the connection early) is returned with a status of
+    None, which _get_error() makes a network error.
+    """
+    head, _, body = data.partition('\r\n\r\n')
+    lines = head.split('\r\n')
+    version, status, reason = (lines[0].split(' ', 2) + ['', ''])[:3]
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        if not version.startswith('HTTP/') or len(status) != 3:
+            raise ValueError('bad status line {!r}'.format(lines[0]))
+        status = int(status)
+        if method == 'HEAD':
+            body = ''
+        elif 'chunked' in headers.get('transfer-encoding', ''):
+            body = _decode_chunked(body)
+        elif 'content-length' in headers:
+            body = body[:int(headers['content-length'])]
+    except ValueError:
+        return Response(
+            None, 'malformed or truncated response', headers, data)
+    return Response(status, reason, headers, body)
+
+
+def http_request(host, port, method, path, headers, body=None,
+                 ssl_context=None, timeout=DEFAULT_TIMEOUT):
+    """
+    Coroutine that makes an HTTP request on a new connection, which is
+    closed after the response. body may be a string or a file. Returns a
+    Response.
+    """
+    sock = yield eventloop.connect(host, port, timeout, ssl_context)
+    try:
+        lines = ['{} {} HTTP/1.1'.format(method, path)]
+        lines.extend(
+            '{}: {}'.format(name, value)
+            for name, value in sorted(headers.items())
+        )
+        yield eventloop.send_all(sock, '\r\n'.join(lines) + '\r\n\r\n',
+                                 timeout)
+        if isinstance(body, str):
+            yield eventloop.send_all(sock, body, timeout)
+        elif body is not None:
+            while True:
+                data = body.read(SEND_SIZE)
+                if not data:
+                    break
+                yield eventloop.send_all(sock, data, timeout)
+
+        chunks = []
+        while True:
+            data = yield eventloop.recv(sock, timeout)
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        sock.close()
+    raise eventloop.Return(parse_response(''.join(chunks), method))
+
+
+#
+# The uploader
+#
+
+def _split_uri(logfile_uri):
+    """ Splits an s3:// URI into its bucket and key names. """
+    bucket_name, _, key_name = logfile_uri[len('s3://'):].partition('/')
+    return bucket_name, key_name
+
+
+class AsyncS3Uploader(AsyncBaseUploader):
+    def __init__(self, upload_uri, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 endpoint=None, region=None, credentials=None,
+                 use_ssl=True, timeout=DEFAULT_TIMEOUT, os_environ=None,
+                 get_ec2_metadata=None):
+        """
+        Takes an upload_uri and the number of requests to keep in flight
+        at once, plus optional arguments generally used for testing:
+
+            - endpoint: host[:port] to send requests to. Defaults to the
+                        S3 endpoint of the region.
+            - region: region to sign requests for. Defaults to
+                      $AWS_DEFAULT_REGION, else the EC2 region, else
+                      us-east-1.
+            - credentials: Credentials to sign requests with. Default to
+                           $AWS_ACCESS_KEY_ID and
+                           $AWS_SECRET_ACCESS_KEY, else the first IAM
+                           role in the EC2 instance metadata.
+            - use_ssl: whether to speak HTTPS.
+            - timeout: seconds a request may go without progress.
+            - os_environ, get_ec2_metadata: as for
+                                            s3_uploader._connect_s3().
+
+        Buckets are addressed by path, so that bucket names with dots
+        in them work over HTTPS.
+        """
+        super(AsyncS3Uploader, self).__init__(
+            upload_uri, max_in_flight=max_in_flight)
+        self.endpoint = endpoint
+        self.region = region
+        self.credentials = credentials
+        self.static_credentials = credentials is not None
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.os_environ = os.environ if os_environ is None else os_environ
+        self.get_ec2_metadata = get_ec2_metadata
+        if self.get_ec2_metadata is None:
+            self.get_ec2_metadata = s3_uploader._get_ec2_metadata
+
+        self.ssl_context = None
+        self.uri_checked = False
+
+    def clone(self):
+        return self.__class__(
+            self.upload_uri,
+            max_in_flight=self.max_in_flight,
+            endpoint=self.endpoint,
+            region=self.region,
+            credentials=self.credentials if self.static_credentials
+            else None,
+            use_ssl=self.use_ssl,
+            timeout=self.timeout,
+            os_environ=self.os_environ,
+            get_ec2_metadata=self.get_ec2_metadata
+        )
+
+    #
+    # Connecting
+    #
+
+    def _load_credentials(self):
+        access_key = self.os_environ.get('AWS_ACCESS_KEY_ID')
+        secret_key = self.os_environ.get('AWS_SECRET_ACCESS_KEY')
+        if access_key and secret_key:
+            return Credentials(
+                access_key, secret_key,
+                self.os_environ.get('AWS_SESSION_TOKEN'), None)
+
+        cred = s3_uploader._get_iam_cred(self.get_ec2_metadata)
+        if cred is None:
+            raise Exception('No credentials found for connecting to S3')
+        logging.debug('AsyncS3Uploader: using IAM role credentials')
+        return Credentials(
+            cred['AccessKeyId'],
+            cred['SecretAccessKey'],
+            cred['Token'],
+            s3_uploader._get_cred_expiration(cred)
+        )
+
+    def _credentials_expiring(self):
+        expiration = self.credentials.expiration
+        return (expiration is not None and time.time() >=
+                expiration - s3_uploader.CREDENTIALS_REFRESH_SECS)
+
+    def connect(self):
+        """
+        Finds the region, endpoint and credentials to use, keeping them
+        until disconnect() or until the credentials near expiry. Each
+        request makes its own connection.
+        """
+        if self.region is None:
+            self.region = s3_uploader._get_region(
+                self.os_environ, self.get_ec2_metadata) or DEFAULT_REGION
+        if self.endpoint is None:
+            if self.region == DEFAULT_REGION:
+                self.endpoint = 's3.amazonaws.com'
+            else:
+                self.endpoint = 's3.{}.amazonaws.com'.format(self.region)
+        if self.use_ssl and self.ssl_context is None:
+            self.ssl_context = ssl.create_default_context()
+        if self.credentials is None or self._credentials_expiring():
+            self.credentials = self._load_credentials()
+
+    def disconnect(self):
+        if not self.static_credentials:
+            self.credentials = None
+        self.uri_checked = False
+
+    def _request(self, method, bucket_name, key_name='', query=None,
+                 headers=None, body=None, payload_hash=EMPTY_SHA256):
+        """ Coroutine making a signed request. Returns a Response. """
+        path = '/{}/{}'.format(bucket_name, key_name)
+        query = query or {}
+        signed_headers = sign_request(
+            method, self.endpoint, path, query, headers or {},
+            payload_hash, self.credentials, self.region,
+            datetime.datetime.utcnow()
+        )
+        signed_headers['Connection'] = 'close'
+
+        host, _, port = self.endpoint.partition(':')
+        if port:
+            port = int(port)
+        else:
+            port = 443 if self.use_ssl else 80
+        request_path = _quote(path, safe='/-_.~')
+        if query:
+            request_path += '?' + get_canonical_query(query)
+
+        response = yield http_request(
+            host, port, method, request_path, signed_headers, body,
+            self.ssl_context, self.timeout)
+        raise eventloop.Return(response)
+
+    def _get_error(self, response):
+        if response.status is None:
+            return IOError(response.reason)
+        return boto.exception.S3ResponseError(
+            response.status, response.reason, response.body)
+
+    def check_uri(self):
+        """
+        Checks that our upload_uri is valid, and that its bucket can be
+        reached. Returns a string if any error occurred.
+        """
+        if self.uri_checked:
+            return
+        try:
+            logfile_uri = s3_uploader.get_logfile_uri(
+                self.upload_uri, parse.SAMPLE_LOGFILE)
+        except ValueError, e:
+            return str(e)
+
+        bucket_name, _ = _split_uri(logfile_uri)
+        response = eventloop.run([self._request('HEAD', bucket_name)])[0]
+        if response.status != 200:
+            return 'Failed to find bucket {}'.format(bucket_name)
+        self.uri_checked = True
+
+    #
+    # Scanning
+    #
+
+    def _list_key_names(self, bucket_name, key_names):
+        """
+        Coroutine returning which of key_names are present in the
+        bucket. Lists only the keys from the first of them to the last,
+        under their common prefix.
+        """
+        first, last = min(key_names), max(key_names)
+        prefix = os.path.commonprefix([first, last])
+        marker = first[:-1]
+        found = set()
+        fetched = 0
+        while True:
+            response = yield self._request(
+                'GET', bucket_name, query={'prefix': prefix, 'marker': marker})
+            if response.status != 200:
+                raise self._get_error(response)
+
+            root = ElementTree.fromstring(response.body)
+            names = [
+                contents.findtext(S3_NAMESPACE + 'Key')
+                for contents in root.findall(S3_NAMESPACE + 'Contents')
+            ]
+            fetched += len(names)
+            found.update(name for name in names if name in key_names)
+            truncated = root.findtext(S3_NAMESPACE + 'IsTruncated')
+            if truncated != 'true' or not names or names[-1] >= last:
+                break
+            marker = names[-1]
+
+        logging.debug(
+            'AsyncS3Uploader: listed %s/%s*: fetched %d keys, matched %d',
+            bucket_name, prefix, fetched, len(found))
+        raise eventloop.Return(found)
+
+    def scan_remote_async(self, logfiles):
+        """
+        Coroutine returning, as two sets, those of logfiles that have
+        been uploaded already, and those that have not. Lists up to
+        max_in_flight remote directories at once.
+        """
+        logfiles_by_key = {}
+        key_names_by_dir = collections.defaultdict(set)
+        for logfile in logfiles:
+            bucket_name, key_name = _split_uri(
+                s3_uploader.get_logfile_uri(self.upload_uri, logfile))
+            logfiles_by_key[bucket_name, key_name] = logfile
+            dir_name = key_name.rsplit('/', 1)[0]
+            key_names_by_dir[bucket_name, dir_name].add(key_name)
+
+        dirs = sorted(key_names_by_dir)
+        found_by_dir = yield eventloop.gather(
+            [self._list_key_names(bucket_name, key_names_by_dir[
+                bucket_name, dir_name])
+             for bucket_name, dir_name in dirs],
+            limit=self.max_in_flight
+        )
+
+        uploaded = set()
+        for (bucket_name, _), found in zip(dirs, found_by_dir):
+            uploaded.update(
+                logfiles_by_key[bucket_name, key_name]
+                for key_name in found
+            )
+        raise eventloop.Return((uploaded, set(logfiles) - uploaded))
+
+    #
+    # Uploading
+    #
+
+    def upload_logfile_async(self, log_archive_dir, logfile):
+        """
+        Coroutine that uploads a logfile with a single PUT. Returns an
+        error, if any. S3 is asked not to overwrite an existing key, as
+        for S3Uploader with trust_scan.
+        """
+        logfile_uri = s3_uploader.get_logfile_uri(self.upload_uri, logfile)
+        bucket_name, key_name = _split_uri(logfile_uri)
+        path = os.path.join(log_archive_dir, logfile.filename)
+        try:
+            with open(path, 'rb') as f:
+                md5 = hashlib.md5()
+                for data in iter(lambda: f.read(SEND_SIZE), ''):
+                    md5.update(data)
+                size = f.tell()
+                f.seek(0)
+                headers = {
+                    'Content-Length': str(size),
+                    'Content-MD5': base64.b64encode(md5.digest()),
+                    'If-None-Match': '*',
+                }
+                response = yield self._request(
+                    'PUT', bucket_name, key_name, headers=headers, body=f,
+                    payload_hash=UNSIGNED_PAYLOAD)
+        except EnvironmentError, e:
+            logging.error(
+                'AsyncS3Uploader: upload of %s failed: %s', logfile_uri, e)
+            raise eventloop.Return(e)
+
+        if response.status == 412:
+            logging.warning(
+                'AsyncS3Uploader: %s already uploaded', logfile_uri)
+        elif response.status != 200:
+            logging.error(
+                'AsyncS3Uploader: upload of %s failed: %s %s',
+                logfile_uri, response.status, response.reason)
+            raise eventloop.Return(self._get_error(response))
@@ -1,11 +1,19 @@
 """
-Base class for Uploaders.
+Base classes for Uploaders.
 """
 
+from __future__ import absolute_import
+
+import threading
+
+from . import eventloop
+
 
 class BaseUploader(object):
     def __init__(self, upload_uri):
         self.upload_uri = upload_uri
+        self._idle_clones = []
+        self._idle_clones_lock = threading.Lock()
 
     def check_uri(self):
         """
@@ -13,10 +21,44 @@ class BaseUploader(object):
         """
         raise NotImplementedError
 
+    def clone(self):
+        """
+        Returns a new, unconnected Uploader with the same configuration,
+        for use from another thread.
+        """
+        return self.__class__(self.upload_uri)
+
+    def acquire_clone(self):
+        """
+        Returns a connected clone(), for use from another thread until
+        it's given back with release_clone(). Clones given back are
+        reused, so that their connections outlive a single upload cycle.
+        """
+        with self._idle_clones_lock:
+            clone = self._idle_clones.pop() if self._idle_clones else None
+        if clone is None:
+            clone = self.clone()
+        clone.connect()
+        return clone
+
+    def release_clone(self, clone):
+        """
+        Gives back a clone from acquire_clone(), for reuse.
+        """
+        with self._idle_clones_lock:
+            self._idle_clones.append(clone)
+
     def connect(self):
         """
         Initializes a connection to the Uploader's URI. May be called
-        more than once.
+        more than once, and may keep an existing connection if so.
+        """
+        pass
+
+    def disconnect(self):
+        """
+        Drops any connection kept by connect(), so that the next call
+        makes a new one. Called after errors.
         """
         pass
 
@@ -35,3 +77,61 @@ class BaseUploader(object):
         file's URI.
         """
         raise NotImplementedError
+
+    def open_stream(self, logfile):
+        """
+        Takes a LogFile that has yet to be written. Returns a write-only
+        file object that uploads what's written to it. Its close()
+        method returns an error, if any, and its cancel() method
+        abandons the upload.
+        """
+        raise NotImplementedError
+
+
+class AsyncBaseUploader(BaseUploader):
+    """
+    Base class for Uploaders whose I/O is done by coroutines run on a
+    logjam.eventloop, so that many uploads and listings can be in flight
+    at once from a single thread.
+
+    Subclasses implement scan_remote_async() and upload_logfile_async();
+    the synchronous methods of BaseUploader run them to completion.
+    """
+
+    def __init__(self, upload_uri, max_in_flight=1):
+        super(AsyncBaseUploader, self).__init__(upload_uri)
+        self.max_in_flight = max_in_flight
+
+    def clone(self):
+        return self.__class__(
+            self.upload_uri, max_in_flight=self.max_in_flight)
+
+    def scan_remote_async(self, logfiles):
+        """
+        Coroutine returning what scan_remote() does.
+        """
+        raise NotImplementedError
+
+    def upload_logfile_async(self, log_archive_dir, logfile):
+        """
+        Coroutine returning what upload_logfile() does.
+        """
+        raise NotImplementedError
+
+    def scan_remote(self, logfiles):
+        return eventloop.run([self.scan_remote_async(logfiles)])[0]
+
+    def upload_logfile(self, log_archive_dir, logfile):
+        return eventloop.run(
+            [self.upload_logfile_async(log_archive_dir, logfile)])[0]
+
+    def upload_logfiles(self, log_archive_dir, logfiles):
+        """
+        Uploads logfiles, up to max_in_flight at a time. Returns a list
+        of the errors (or None) of each logfile's upload, in order.
+        """
+        return eventloop.run(
+            [self.upload_logfile_async(log_archive_dir, logfile)
+             for logfile in logfiles],
+            limit=self.max_in_flight
+        )
@@ -0,0 +1,259 @@
+"""
+Bundling small archives into one upload.
+
+Services that rotate every minute, or prefixes that see little traffic,
+leave behind many small archives, each of which costs a PUT to upload
+and a key in every listing of its directory. A Bundler packs the small
+archives of each (prefix, day) into a tar file, followed by a table of
+contents. The tar is named like a logfile of that prefix and day, so
+that it's uploaded to the same directory its members would have been.
+"""
+
+import cStringIO
+import datetime
+import hashlib
+import json
+import logging
+import os
+import os.path
+import tarfile
+
+from . import parse
+from . import state
+
+#
+# Globals
+#
+
+BUNDLES_DIRNAME = 'bundles'
+BUNDLE_SUFFIX = 'bundle'
+BUNDLE_EXTENSION = '.tar'
+TOC_NAME = 'TOC.json'
+
+DEFAULT_MAX_SIZE = 64 * 1024
+DEFAULT_MIN_COUNT = 10
+DEFAULT_MAX_COUNT = 1000
+DEFAULT_MAX_DELAY = 60 * 60
+
+
+#
+# Reading and writing bundles
+#
+
+def get_bundle_filename(prefix, day, filenames):
+    """
+    Returns the filename of the bundle of the given filenames of prefix
+    on day (a datetime.date). The name is the same for the same files,
+    so that a bundle that's written again is uploaded to the same key.
+    """
+    digest = hashlib.sha1('\n'.join(sorted(filenames))).hexdigest()
+    return '{}-{}T0000Z-{}-{}{}'.format(
+        prefix, day.strftime('%Y%m%d'), BUNDLE_SUFFIX, digest[:12],
+        BUNDLE_EXTENSION)
+
+
+def _padded(size):
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+def _add_member(tar, name, data, mtime):
+    """
+    Adds a member to tar, returning the offset of its data within the
+    tar file.
+    """
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = mtime
+    tar.addfile(info, cStringIO.StringIO(data))
+    return tar.offset - _padded(len(data))
+
+
+def write_bundle(path, log_archive_dir, logfiles):
+    """
+    Writes the given logfiles of log_archive_dir to a tar file at path,
+    followed by a TOC_NAME member: a JSON table of contents giving the
+    offset, size and MD5 of each member's data within the tar file.
+
+    Returns the table of contents, as a dict.
+    """
+    members = []
+    tmp_path = path + '.tmp'
+    tar = tarfile.open(tmp_path, 'w')
+    try:
+        last_mtime = 0
+        for logfile in sorted(logfiles, key=parse.logfile_keyfunc):
+            src_path = os.path.join(log_archive_dir, logfile.filename)
+            with open(src_path, 'rb') as f:
+                data = f.read()
+                mtime = int(os.fstat(f.fileno()).st_mtime)
+            last_mtime = max(last_mtime, mtime)
+            members.append({
+                'filename': logfile.filename,
+                'offset': _add_member(tar, logfile.filename, data, mtime),
+                'size': len(data),
+                'md5': hashlib.md5(data).hexdigest(),
+            })
+
+        toc = {'members': members}
+        _add_member(tar, TOC_NAME, json.dumps(toc, sort_keys=True),
+                    last_mtime)
+        tar.close()
+        os.rename(tmp_path, path)
+    finally:
+        tar.close()
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    return toc
+
+
+def read_toc(f):
+    """
+    Takes a bundle, open for reading. Returns its table of contents.
+    """
+    tar = tarfile.open(fileobj=f, mode='r:')
+    try:
+        return json.load(tar.extractfile(TOC_NAME))
+    finally:
+        tar.close()
+
+
+def read_member(f, member):
+    """
+    Takes a bundle, open for reading, and one of the members listed in
+    its table of contents. Returns that member's data.
+    """
+    f.seek(member['offset'])
+    return f.read(member['size'])
+
+
+#
+# Bundler
+#
+
+class Bundler(object):
+    def __init__(self, max_size=DEFAULT_MAX_SIZE,
+                 min_count=DEFAULT_MIN_COUNT, max_count=DEFAULT_MAX_COUNT,
+                 max_delay=DEFAULT_MAX_DELAY, journal=None,
+                 utcnow=datetime.datetime.utcnow):
+        """
+        Bundles archives smaller than max_size bytes, up to max_count of
+        them per bundle, with others of their prefix and day.
+
+        A bundle is only made of at least min_count archives, unless the
+        oldest of them is max_delay seconds old: until then, fewer are
+        held back in the hope of more. An archive that is too old to
+        hold back, and has nothing to be bundled with, is left to be
+        uploaded on its own.
+
+        Args:
+            journal: (optional) state.UploadJournal in which to record
+                the members of each bundle uploaded.
+            utcnow: for dependency injection during tests.
+        """
+        self.max_size = max_size
+        self.min_count = min_count
+        self.max_count = max_count
+        self.max_delay = datetime.timedelta(seconds=max_delay)
+        self.journal = journal
+        self.utcnow = utcnow
+
+    def _is_small(self, log_archive_dir, logfile):
+        try:
+            return os.path.getsize(os.path.join(
+                log_archive_dir, logfile.filename)) < self.max_size
+        except OSError:
+            return False  # let its upload report the error
+
+    def group(self, log_archive_dir, logfiles):
+        """
+        Takes logfiles of log_archive_dir. Returns a tuple of:
+
+            - a list of lists of logfiles to bundle together,
+            - the set of logfiles held back for a later bundle,
+            - the set of logfiles to upload on their own.
+        """
+        by_day = {}
+        singles = set()
+        for logfile in logfiles:
+            if self._is_small(log_archive_dir, logfile):
+                day = (logfile.prefix, logfile.timestamp.date())
+                by_day.setdefault(day, []).append(logfile)
+            else:
+                singles.add(logfile)
+
+        groups = []
+        held = set()
+        oldest = self.utcnow() - self.max_delay
+        for day in sorted(by_day):
+            day_logfiles = sorted(by_day[day], key=parse.logfile_keyfunc)
+            for i in range(0, len(day_logfiles), self.max_count):
+                chunk = day_logfiles[i:i + self.max_count]
+                if len(chunk) >= self.min_count:
+                    groups.append(chunk)
+                elif chunk[0].timestamp > oldest:
+                    held.update(chunk)
+                elif len(chunk) > 1:
+                    groups.append(chunk)
+                else:
+                    singles.update(chunk)
+        return groups, held, singles
+
+    def get_bundle_dir(self, log_archive_dir):
+        return os.path.join(
+            log_archive_dir, state.STATE_DIRNAME, BUNDLES_DIRNAME)
+
+    def bundle(self, log_archive_dir, logfiles):
+        """
+        Takes logfiles of log_archive_dir waiting to be uploaded, and
+        writes bundles of the small ones to get_bundle_dir(). Bundles
+        left there by earlier calls that are no longer wanted are
+        deleted.
+
+        Returns a tuple of:
+
+            - a dict of the members of each bundle written, by its
+              LogFile,
+            - the set of logfiles held back for a later bundle,
+            - the set of logfiles to upload on their own.
+        """
+        groups, held, singles = self.group(log_archive_dir, logfiles)
+        bundle_dir = self.get_bundle_dir(log_archive_dir)
+        if not os.path.isdir(bundle_dir):
+            os.makedirs(bundle_dir)
+
+        bundles = {}
+        for members in groups:
+            filename = get_bundle_filename(
+                members[0].prefix, members[0].timestamp.date(),
+                [logfile.filename for logfile in members])
+            path = os.path.join(bundle_dir, filename)
+            if not os.path.exists(path):
+                try:
+                    write_bundle(path, log_archive_dir, members)
+                except EnvironmentError, e:
+                    logging.error(
+                        'bundle.Bundler: failed to write %s: %s',
+                        filename, e)
+                    singles.update(members)
+                    continue
+            bundles[parse.parse_filename(filename)] = members
+
+        wanted = set(logfile.filename for logfile in bundles)
+        for filename in os.listdir(bundle_dir):
+            path = os.path.join(bundle_dir, filename)
+            if (filename not in wanted and not filename.startswith('.') and
+                    os.path.isfile(path)):
+                os.unlink(path)
+
+        return bundles, held, singles
+
+    def mark_uploaded(self, log_archive_dir, bundle, members):
+        """
+        Marks every member of a bundle as uploaded, then deletes the
+        bundle.
+        """
+        if self.journal is not None:
+            self.journal.add_bundle(
+                bundle.filename, [logfile.filename for logfile in members])
+        os.unlink(os.path.join(
+            self.get_bundle_dir(log_archive_dir), bundle.filename))
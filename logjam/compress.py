@@ -5,15 +5,48 @@ Logfile compressor
 from __future__ import absolute_import
 
 import argparse
+import collections
 import datetime
+import errno
+import functools
+import hashlib
+import io
 import logging
+import multiprocessing
+import multiprocessing.pool
 import os
 import os.path
+import re
 import subprocess
 import tempfile
+import threading
+import time
+import zlib
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+from . import inotify
+from . import online
 from . import parse
+from . import seekable
 from . import service
+from . import state
 
 
 COMMAND_DESCRIPTION = """
@@ -26,13 +59,49 @@ Sample usage:
 
 """[1:]
 
+ONE_HOUR = datetime.timedelta(hours=1)
 ONE_HOUR_PLUS = datetime.timedelta(hours=1, minutes=5)
 
+# With --writer-closed, how long a logfile must go unmodified before
+# it's considered closed.
+DEFAULT_CLOSED_GRACE = 60
+
+O_ACCMODE = 3  # mask for O_RDONLY, O_WRONLY and O_RDWR
+
+DEFAULT_GZIP_LEVEL = 6
+GZIP_WBITS = 16 + zlib.MAX_WBITS  # zlib writes a gzip header & trailer
+MB = 1024 * 1024
+STREAM_BUFFER_SIZE = 256 * 1024
+DEFAULT_BLOCK_SIZE = 4 * MB
+
+# Matches s3_uploader.DEFAULT_PART_SIZE, so that multipart uploads can
+# use the part checksums computed while compressing.
+DEFAULT_CHECKSUM_PART_SIZE = 16 * MB
+PIPE_BUFFER_SIZE = 256 * 1024
+
+# Ends the names of compress_path()'s temporary files in log_dir, which
+# would otherwise parse as logfiles.
+TEMP_SUFFIX = '.logjam-tmp'
+
+# Serializes the check-for-existing-archive-then-rename step of
+# compress_path(), so that concurrent workers never race each other
+# into the same destination path.
+_RENAME_LOCK = threading.Lock()
+
 
 #
 # Helpers
 #
 
+def is_logfile_name(filename):
+    """
+    Returns whether filename is that of a logfile, rather than of one
+    of compress_path()'s temporary files.
+    """
+    return (not filename.endswith(TEMP_SUFFIX) and
+            parse.parse_filename(filename) is not None)
+
+
 def select_superseded_by_new_file(logfiles):
     """
     Takes a list of LogFiles of the same prefix. Returns those files
@@ -54,8 +123,37 @@ def select_superseded_by_timestamp(logfiles, current_timestamp):
     ]
 
 
-def yield_old_logfiles(filenames, current_timestamp):
-    logfiles_by_group = parse.group_filenames(filenames)
+def select_closed_by_writers(logfiles, open_filenames, current_timestamp):
+    """
+    Takes a list of LogFiles of the same prefix, a set of filenames that
+    are still open for writing, and a DateTime. Returns those files
+    whose hour has ended and that are no longer open for writing.
+    """
+    return [
+        lf for lf in logfiles
+        if lf.filename not in open_filenames and
+        current_timestamp - lf.timestamp >= ONE_HOUR
+    ]
+
+
+def yield_old_logfiles(filenames, current_timestamp, open_filenames=None):
+    """
+    Takes an iterable of filenames and a DateTime. Yields LogFiles that
+    are superseded, either by a newer file or by the passage of time.
+
+    If open_filenames (the set of filenames still open for writing) is
+    given, also yields files that their writers have finished with.
+    """
+    return yield_old_logfiles_by_group(
+        parse.group_filenames(filenames), current_timestamp, open_filenames)
+
+
+def yield_old_logfiles_by_group(logfiles_by_group, current_timestamp,
+                                open_filenames=None):
+    """
+    As yield_old_logfiles(), but takes LogFiles already grouped by
+    parse.group_logfiles().
+    """
     # logging.debug('compress.yield_old_logfiles: group %r',
     # logfiles_by_group
     # )
@@ -66,10 +164,94 @@ def yield_old_logfiles(filenames, current_timestamp):
         old_logfiles.update(
             select_superseded_by_timestamp(logfiles, current_timestamp)
         )
+        if open_filenames is not None:
+            old_logfiles.update(select_closed_by_writers(
+                logfiles, open_filenames, current_timestamp))
         for logfile in sorted(old_logfiles, key=parse.logfile_keyfunc):
             yield logfile
 
 
+def _is_open_for_writing(fdinfo_path):
+    try:
+        with open(fdinfo_path) as f:
+            for line in f:
+                if line.startswith('flags:'):
+                    flags = int(line.split()[1], 8)
+                    return (flags & O_ACCMODE) != os.O_RDONLY
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return False  # closed since we listed it
+    return True  # assume the worst
+
+
+def find_filenames_open_for_writing(log_dir, proc_dir='/proc'):
+    """
+    Scans proc_dir/*/fd for files directly within log_dir that some
+    process has open for writing. Returns a set of their filenames.
+
+    Returns None if some process's file descriptors can't be read
+    (e.g. when not running as root), since the answer is then unknown.
+    """
+    log_dir = os.path.realpath(log_dir)
+    filenames = set()
+    for pid in os.listdir(proc_dir):
+        if not pid.isdigit():
+            continue
+        fd_dir = os.path.join(proc_dir, pid, 'fd')
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError, e:
+            if e.errno == errno.EACCES:
+                return
+            continue  # process exited
+        for fd in fds:
+            try:
+                target = os.readlink(os.path.join(fd_dir, fd))
+            except OSError:
+                continue
+            if os.path.dirname(target) != log_dir:
+                continue
+            fdinfo_path = os.path.join(proc_dir, pid, 'fdinfo', fd)
+            if _is_open_for_writing(fdinfo_path):
+                filenames.add(os.path.basename(target))
+    return filenames
+
+
+def find_filenames_in_use(log_dir, filenames, current_time, grace,
+                          proc_dir='/proc'):
+    """
+    Returns the subset of filenames in log_dir that are open for
+    writing, or that were modified within the last grace seconds.
+    Returns None if open files can't be determined.
+    """
+    in_use = find_filenames_open_for_writing(log_dir, proc_dir=proc_dir)
+    if in_use is None:
+        return
+    for filename in filenames:
+        try:
+            mtime = os.path.getmtime(os.path.join(log_dir, filename))
+        except OSError:
+            continue
+        if current_time - mtime < grace:
+            in_use.add(filename)
+    return in_use
+
+
+def default_workers():
+    """
+    Returns the number of CPUs usable by this process, or 1 if that
+    cannot be determined.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        pass
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
 def duplicate_timestamp_path(existing_path):
     """
     Takes the path to a logfile.
@@ -100,61 +282,480 @@ def duplicate_timestamp_path(existing_path):
     raise Exception('%d duplicate timestamp paths detected.' % index)
 
 
+def gzip_compressobj(level=DEFAULT_GZIP_LEVEL):
+    """
+    Returns a zlib compressobj whose output is a complete gzip stream,
+    readable by gunzip.
+    """
+    return zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+
+
+class CompressError(Exception):
+    pass
+
+
+class CommandEngine(object):
+    """
+    Compresses a file by running an external command, such as
+    ('gzip', '-c'), that writes the compressed file to its stdout.
+    """
+
+    def __init__(self, compress_cmd_args):
+        self.compress_cmd_args = tuple(compress_cmd_args)
+
+    def __call__(self, src_path, dst_file):
+        args = self.compress_cmd_args + (src_path,)
+        logging.debug('compress.CommandEngine: %s', ' '.join(args))
+        if hasattr(dst_file, 'fileno'):
+            p = subprocess.Popen(args, stdout=dst_file)
+        else:
+            # dst_file is a wrapper like ChecksumWriter, so everything
+            # must pass through its write().
+            p = subprocess.Popen(args, stdout=subprocess.PIPE)
+            try:
+                for data in iter(
+                        lambda: p.stdout.read(PIPE_BUFFER_SIZE), ''):
+                    dst_file.write(data)
+            finally:
+                p.stdout.close()
+        retcode = p.wait()  # set timeout?
+        if retcode:
+            raise CompressError('%s exited %d' % (
+                ' '.join(self.compress_cmd_args), retcode))
+
+
+class StreamEngine(object):
+    """
+    In-process alternative to running an external compress command.
+
+    Takes a factory for compressobjs (anything with compress() and
+    flush() methods, like those returned by zlib.compressobj()). When
+    called with a source path and a destination file, streams the
+    source through a fresh compressobj into the destination, reading
+    through a fixed-size buffer that each thread reuses between calls.
+    """
+
+    def __init__(self, compressobj_factory=gzip_compressobj,
+                 buffer_size=STREAM_BUFFER_SIZE):
+        self.compressobj_factory = compressobj_factory
+        self.buffer_size = buffer_size
+        self._local = threading.local()
+
+    def _get_buffer(self):
+        buf = getattr(self._local, 'buf', None)
+        if buf is None:
+            buf = self._local.buf = bytearray(self.buffer_size)
+        return buf
+
+    def __call__(self, src_path, dst_file):
+        compressobj = self.compressobj_factory()
+        buf = self._get_buffer()
+        with io.open(src_path, 'rb', buffering=0) as src:
+            while True:
+                n = src.readinto(buf)
+                if not n:
+                    break
+                dst_file.write(compressobj.compress(buffer(buf, 0, n)))
+        dst_file.write(compressobj.flush())
+
+
+class ChecksumWriter(object):
+    """
+    Wraps a file object, computing the MD5 of everything written
+    through it, as well as of each part_size part, as it goes. With an f
+    of None, what's written is only checksummed.
+    """
+
+    def __init__(self, f, part_size=DEFAULT_CHECKSUM_PART_SIZE):
+        self.f = f
+        self.part_size = part_size
+        self.size = 0
+        self.md5 = hashlib.md5()
+        self.part_md5s = []
+        self._part_md5 = hashlib.md5()
+        self._part_remaining = part_size
+
+    def write(self, data):
+        if self.f is not None:
+            self.f.write(data)
+        self.md5.update(data)
+        self.size += len(data)
+        offset = 0
+        while offset < len(data):
+            n = min(self._part_remaining, len(data) - offset)
+            self._part_md5.update(buffer(data, offset, n))
+            offset += n
+            self._part_remaining -= n
+            if self._part_remaining == 0:
+                self.part_md5s.append(self._part_md5.hexdigest())
+                self._part_md5 = hashlib.md5()
+                self._part_remaining = self.part_size
+
+    def checksum(self, mtime):
+        """
+        Returns a state.Checksum of everything written, for a file last
+        modified at mtime.
+        """
+        part_md5s = list(self.part_md5s)
+        if self._part_remaining < self.part_size:
+            part_md5s.append(self._part_md5.hexdigest())
+        return state.Checksum(
+            self.size, mtime, self.md5.hexdigest(), self.part_size,
+            part_md5s
+        )
+
+
+def checksum_path(path, part_size=DEFAULT_CHECKSUM_PART_SIZE):
+    """
+    Returns a state.Checksum of the file at path, as a ChecksumWriter
+    would have computed while it was written.
+    """
+    writer = ChecksumWriter(None, part_size)
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(STREAM_BUFFER_SIZE), ''):
+            writer.write(data)
+        return writer.checksum(os.fstat(f.fileno()).st_mtime)
+
+
+#
+# Codecs
+#
+
+Codec = collections.namedtuple(
+    'Codec',
+    ('name', 'extension', 'compressobj_factory', 'default_level',
+     'levels')  # levels: the (lowest, highest) level accepted
+)
+
+
+class _LZ4Compressobj(object):
+    """
+    Adapts lz4.frame.LZ4FrameCompressor to the compressobj interface,
+    writing the frame header ahead of the first block.
+    """
+
+    def __init__(self, level):
+        self.compressor = lz4.frame.LZ4FrameCompressor(
+            compression_level=level)
+        self.header = self.compressor.begin()
+
+    def _take_header(self):
+        header, self.header = self.header, ''
+        return header
+
+    def compress(self, data):
+        return self._take_header() + self.compressor.compress(data)
+
+    def flush(self):
+        return self._take_header() + self.compressor.flush()
+
+
+def _zstd_compressobj(level):
+    return zstandard.ZstdCompressor(level=level).compressobj()
+
+
+def _xz_compressobj(level):
+    return lzma.LZMACompressor(preset=level)
+
+
+# All codecs that logjam knows of, in order of preference for the CLI.
+CODEC_NAMES = ('gzip', 'zstd', 'lz4', 'xz')
+
+# The codecs that are actually available, given what could be imported.
+CODECS = {
+    'gzip': Codec(
+        'gzip', '.gz', gzip_compressobj, DEFAULT_GZIP_LEVEL, (1, 9)),
+}
+
+# The module each codec needs, for saying which failed to import.
+CODEC_MODULES = {
+    'zstd': 'zstandard',
+    'lz4': 'lz4.frame',
+    'xz': 'lzma',
+}
+
+if zstandard is not None:
+    CODECS['zstd'] = Codec('zstd', '.zst', _zstd_compressobj, 3, (1, 22))
+
+if lz4 is not None:
+    CODECS['lz4'] = Codec('lz4', '.lz4', _LZ4Compressobj, 0, (0, 16))
+
+if lzma is not None:
+    CODECS['xz'] = Codec('xz', '.xz', _xz_compressobj, 6, (0, 9))
+
+
+def get_codec(name, codecs=CODECS):
+    """
+    Returns the Codec registered under name. If that codec's library
+    could not be imported, logs a warning and falls back to gzip.
+    """
+    codec = codecs.get(name)
+    if codec is None:
+        if name not in CODEC_NAMES:
+            raise ValueError('Unknown codec {}'.format(name))
+        logging.warning(
+            'compress.get_codec: failed to import %s, so %s is not '
+            'available. Using gzip.', CODEC_MODULES[name], name)
+        codec = codecs['gzip']
+    return codec
+
+
+def check_level(codec, level):
+    """
+    Raises ValueError if level isn't a compression level codec accepts.
+    """
+    lowest, highest = codec.levels
+    if not lowest <= level <= highest:
+        raise ValueError(
+            '{} compression level must be from {} to {}, not {}'.format(
+                codec.name, lowest, highest, level))
+
+
+def _compress_block(codec_name, level, data):
+    """
+    Runs in a ParallelEngine's worker processes. Returns data
+    compressed as a complete, standalone stream.
+    """
+    compressobj = CODECS[codec_name].compressobj_factory(level)
+    return compressobj.compress(data) + compressobj.flush()
+
+
+class ParallelEngine(object):
+    """
+    Compresses files of at least threshold bytes pigz-style: the file is
+    split into block_size blocks, which are compressed across a pool of
+    processes and written out in order. Each block becomes a complete
+    gzip member (or zstd/lz4 frame, or xz stream), and since standard
+    decompressors read concatenated members as one stream, the output
+    stays readable by gunzip & co.
+
+    Smaller files are handed to the fallback engine.
+    """
+
+    def __init__(self, codec_name, level, fallback, threshold,
+                 block_size=DEFAULT_BLOCK_SIZE, processes=None):
+        self.codec_name = codec_name
+        self.level = level
+        self.fallback = fallback
+        self.threshold = threshold
+        self.block_size = block_size
+        self.processes = processes or default_workers()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.processes)
+            return self._pool
+
+    def __call__(self, src_path, dst_file):
+        if os.path.getsize(src_path) < self.threshold:
+            return self.fallback(src_path, dst_file)
+
+        logging.debug(
+            'compress.ParallelEngine: compressing %s in %d processes',
+            src_path, self.processes)
+        pool = self._get_pool()
+
+        # Bound the number of blocks in flight, so that memory use
+        # doesn't grow with the size of the file.
+        max_pending = 2 * self.processes
+        pending = collections.deque()
+        with open(src_path, 'rb') as src:
+            while True:
+                data = src.read(self.block_size)
+                if data:
+                    pending.append(pool.apply_async(
+                        _compress_block,
+                        (self.codec_name, self.level, data)
+                    ))
+                while pending and (
+                        len(pending) >= max_pending or not data):
+                    dst_file.write(self._get_block(pending.popleft()))
+                if not data:
+                    break
+
+    def _get_block(self, result):
+        """
+        Returns the compressed block of a worker's result, raising
+        whatever the worker raised (a codec error, MemoryError...) as a
+        CompressError.
+        """
+        try:
+            return result.get()
+        except Exception, e:
+            raise CompressError('compressing a block failed: {!r}'.format(e))
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+
+def make_compressor(codec_name='gzip', level=None, engine='subprocess',
+                    parallel_threshold=None,
+                    block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Returns (compress_cmd_args, compress_extension) for compress_path(),
+    given a codec name, an optional compression level, and an engine
+    (either 'subprocess' or 'stream').
+
+    Only gzip can run as a subprocess; other codecs always stream.
+
+    If parallel_threshold is given, files of at least that many bytes
+    are compressed in block_size blocks by a ParallelEngine.
+
+    Raises ValueError if level isn't one the codec accepts.
+    """
+    codec = get_codec(codec_name)
+    if level is None:
+        level = codec.default_level
+    check_level(codec, level)
+
+    if engine == 'subprocess' and codec.name == 'gzip':
+        compress_cmd_args = ('gzip', '-c', '-{:d}'.format(level))
+    else:
+        compress_cmd_args = StreamEngine(
+            functools.partial(codec.compressobj_factory, level))
+
+    if parallel_threshold is not None:
+        if not callable(compress_cmd_args):
+            compress_cmd_args = CommandEngine(compress_cmd_args)
+        compress_cmd_args = ParallelEngine(
+            codec.name, level, compress_cmd_args, parallel_threshold,
+            block_size=block_size
+        )
+    return compress_cmd_args, codec.extension
+
+
+def _rename_into_archive(tmp_path, path, dst_path, os_rename,
+                         sidecar_paths=None):
+    """
+    Renames the compressed tmp_path for the logfile at path into
+    dst_path, or into a duplicate timestamp path if dst_path already
+    exists. Returns the path actually used.
+
+    sidecar_paths is an optional dict of {extension: tmp_path} for
+    files to be renamed alongside, to the used path plus extension.
+    """
+    if os.path.exists(dst_path):
+        # This is a difficult position: the compressed file already
+        # exists, but we have a new, uncompressed file that must
+        # be dealt with.
+        #
+        # Although not perfect, the course below (make a special
+        # logfile name for it) makes sure that the file is archived
+        # and (eventually) uploaded into its own folder for later
+        # reconciliation by the operator.
+        logging.error(
+            (
+                'compress.compress_path: compress %s failed. '
+                '%s already exists!'
+            ),
+            path, dst_path
+        )
+        orig_dst_path = dst_path
+        dst_path = duplicate_timestamp_path(dst_path)
+
+        if os.path.exists(dst_path):
+            raise RuntimeError(
+                'Unable to recover from pre-existing logfile %s' %
+                orig_dst_path)
+
+    for extension, sidecar_path in sorted((sidecar_paths or {}).items()):
+        os_rename(sidecar_path, dst_path + extension)
+    os_rename(tmp_path, dst_path)
+    return dst_path
+
+
 def compress_path(path, compress_cmd_args, compress_extension,
-                  archive_dir, os_rename=os.rename):
+                  archive_dir, os_rename=os.rename, checksums=None,
+                  checksum_part_size=DEFAULT_CHECKSUM_PART_SIZE):
+    """
+    Compresses the logfile at path into archive_dir, then deletes it.
+    Returns the path of the compressed file, or None on failure.
+
+    compress_cmd_args is either a tuple of arguments for an external
+    command that writes the compressed file to stdout (such as
+    ('gzip', '-c')), or a callable engine like StreamEngine that takes
+    the path and a destination file, and raises CompressError or
+    EnvironmentError on failure. An engine may return a dict of
+    {extension: contents} for sidecar files to be archived alongside,
+    such as the index written by seekable.BlockEngine.
+
+    If checksums (a state.ChecksumStore) is given, the checksum of the
+    compressed file is computed as it's written, and stored there.
+    """
     log_dir = os.path.dirname(path)
     log_filename = os.path.basename(path)
-    dst_path = os.path.join(
-        archive_dir, log_filename + compress_extension)
     f = None
+    sidecar_paths = {}
     try:
         with tempfile.NamedTemporaryFile(
                 'wb', dir=log_dir, prefix=log_filename + '.',
-                delete=False
+                suffix=TEMP_SUFFIX, delete=False
         ) as f:
-            args = compress_cmd_args + (path,)
-            logging.debug('compress.compress_path: %s', ' '.join(args))
-            p = subprocess.Popen(args, stdout=f)
-            retcode = p.wait()  # set timeout?
-
-            if retcode:
+            if callable(compress_cmd_args):
+                engine = compress_cmd_args
+            else:
+                engine = CommandEngine(compress_cmd_args)
+            dst_file = f
+            if checksums is not None:
+                dst_file = ChecksumWriter(f, checksum_part_size)
+            try:
+                sidecars = engine(path, dst_file)
+            except (CompressError, EnvironmentError), e:
                 logging.error(
-                    'compress.compress_path: %s exited %d',
-                    ' '.join(compress_cmd_args), retcode)
+                    'compress.compress_path: compress %s failed: %s',
+                    path, e)
                 return
 
-        if os.path.exists(dst_path):
-            # This is a difficult position: the compressed file already
-            # exists, but we have a new, uncompressed file that must
-            # be dealt with.
-            #
-            # Although not perfect, the course below (make a special
-            # logfile name for it) makes sure that the file is archived
-            # and (eventually) uploaded into its own folder for later
-            # reconciliation by the operator.
-            logging.error(
-                (
-                    'compress.compress_path: compress %s failed. '
-                    '%s already exists!'
-                ),
-                path, dst_path
+        for extension, contents in (sidecars or {}).items():
+            with tempfile.NamedTemporaryFile(
+                    'wb', dir=log_dir, prefix=log_filename + '.',
+                    suffix=TEMP_SUFFIX, delete=False
+            ) as sidecar_f:
+                sidecar_paths[extension] = sidecar_f.name
+                sidecar_f.write(contents)
+
+        dst_path = archive_path(
+            path, f.name, compress_extension, archive_dir, os_rename,
+            sidecar_paths=sidecar_paths)
+
+        if checksums is not None:
+            checksums.put(
+                os.path.basename(dst_path),
+                dst_file.checksum(os.stat(dst_path).st_mtime)
             )
-            orig_dst_path = dst_path
-            dst_path = duplicate_timestamp_path(dst_path)
 
-            if os.path.exists(dst_path):
-                raise RuntimeError(
-                    'Unable to recover from pre-existing logfile %s' %
-                    orig_dst_path)
+    finally:
+        for tmp_path in [f and f.name] + sidecar_paths.values():
+            if tmp_path and os.path.isfile(tmp_path):
+                os.unlink(tmp_path)
 
-        os_rename(f.name, dst_path)
+    return dst_path
 
-        if os.path.isfile(path):
-            os.unlink(path)
 
-    finally:
-        if f and os.path.isfile(f.name):
-            os.unlink(f.name)
+def archive_path(path, compressed_path, compress_extension, archive_dir,
+                 os_rename=os.rename, sidecar_paths=None):
+    """
+    Takes the path to a logfile and to a compressed copy of it. Moves
+    the copy (and any sidecar_paths, as for _rename_into_archive()) into
+    archive_dir, then deletes the logfile. Returns the path of the
+    archived copy.
+    """
+    dst_path = os.path.join(
+        archive_dir, os.path.basename(path) + compress_extension)
+    with _RENAME_LOCK:
+        dst_path = _rename_into_archive(
+            compressed_path, path, dst_path, os_rename,
+            sidecar_paths=sidecar_paths)
+
+    if os.path.isfile(path):
+        os.unlink(path)
 
     return dst_path
 
@@ -163,31 +764,126 @@ def compress_path(path, compress_cmd_args, compress_extension,
 # Core functions
 #
 
-def scan_and_compress(log_dir, compress_cmd_args, compress_extension):
+def scan_and_compress(log_dir, compress_cmd_args, compress_extension,
+                      workers=1, closed_grace=None,
+                      online_compressor=None, scan_cache=None,
+                      checksums=None, on_compressed=None):
+    """
+    Compresses every superseded logfile in log_dir into log_dir/archive.
+
+    With workers > 1, up to that many logfiles are compressed at once.
+
+    If closed_grace is given, logfiles whose hour has ended are also
+    compressed once no process has them open for writing and they've
+    gone unmodified for closed_grace seconds.
+
+    If online_compressor (an online.OnlineCompressor) is given, logfiles
+    it has already compressed incrementally are finished off by it, and
+    the logfiles still being written are ticked.
+
+    If scan_cache (a state.ScanCache) is given, log_dir is only listed
+    and parsed when it has changed.
+
+    If checksums (a state.ChecksumStore) is given, the checksum of each
+    compressed logfile is stored there, as for compress_path().
+
+    If on_compressed is given, it's called with the path of each
+    archived logfile as soon as it's archived (from a worker thread,
+    when workers > 1), rather than after the whole scan.
+    """
     logging.debug(
-        'compress.scan_and_compress: %r %r %r',
-        log_dir, compress_cmd_args, compress_extension)
+        'compress.scan_and_compress: %r %r %r %r',
+        log_dir, compress_cmd_args, compress_extension, workers)
     archive_dir = os.path.join(log_dir, 'archive')
     if not os.path.isdir(archive_dir):
         os.mkdir(archive_dir)
 
-    filenames = os.listdir(log_dir)
+    if scan_cache is not None:
+        logfiles = scan_cache.list_logfiles(log_dir)
+        filenames = [lf.filename for lf in logfiles]
+        logfiles_by_group = parse.group_logfiles(logfiles)
+    else:
+        filenames = os.listdir(log_dir)
+        logfiles_by_group = parse.group_filenames(filenames)
     current_timestamp = datetime.datetime.utcnow()
-    for logfile in yield_old_logfiles(filenames, current_timestamp):
-        compressed_path = compress_path(
-            os.path.join(log_dir, logfile.filename),
-            compress_cmd_args,
-            compress_extension,
-            archive_dir,
-        )
-        if compressed_path is None:
-            pass
+    open_filenames = None
+    if closed_grace is not None:
+        open_filenames = find_filenames_in_use(
+            log_dir, filenames, time.time(), closed_grace)
+        if open_filenames is None:
+            logging.debug(
+                'compress.scan_and_compress: cannot tell which files '
+                'are open for writing')
+    paths = [
+        os.path.join(log_dir, logfile.filename)
+        for logfile in yield_old_logfiles_by_group(
+            logfiles_by_group, current_timestamp, open_filenames)
+    ]
+
+    def _finish_online(path):
+        finished_path = online_compressor.finish(path)
+        if finished_path is None:
+            return
+        checksum = None
+        if checksums is not None:
+            # Compressed over many ticks, so checksummed here. Renaming
+            # it into the archive keeps its mtime.
+            checksum = checksum_path(finished_path)
+        dst_path = archive_path(
+            path, finished_path, compress_extension, archive_dir)
+        if checksum is not None:
+            checksums.put(os.path.basename(dst_path), checksum)
+        return dst_path
+
+    def _compress_path(path):
+        dst_path = None
+        if online_compressor is not None:
+            try:
+                dst_path = _finish_online(path)
+            except EnvironmentError, e:
+                logging.error(
+                    'compress.scan_and_compress: finishing %s failed, '
+                    'compressing it afresh: %s', path, e)
+        if dst_path is None:
+            dst_path = compress_path(
+                path,
+                compress_cmd_args,
+                compress_extension,
+                archive_dir,
+                checksums=checksums,
+            )
+        if dst_path is not None and on_compressed is not None:
+            on_compressed(dst_path)
+        return dst_path
+
+    if workers > 1 and len(paths) > 1:
+        # Each job spends its time waiting on its compressor, so a
+        # pool of threads is enough to keep that many CPUs busy.
+        pool = multiprocessing.pool.ThreadPool(min(workers, len(paths)))
+        try:
+            compressed_paths = pool.map(_compress_path, paths, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        compressed_paths = map(_compress_path, paths)
+
+    if online_compressor is not None:
+        compressed_filenames = set(os.path.basename(p) for p in paths)
+        online_compressor.tick(log_dir, [
+            fn for fn in filenames if fn not in compressed_filenames
+        ])
+
+    return compressed_paths
 
 
 #
 # CLI functions
 #
 
+ENGINES = ('subprocess', 'stream')
+
+
 def make_parser():
     parser = argparse.ArgumentParser(
         description=COMMAND_DESCRIPTION,
@@ -208,6 +904,148 @@ def make_parser():
             'running continuously.'
         )
     )
+    parser.add_argument(
+        '--workers', '-w',
+        type=int,
+        default=None,
+        help=(
+            'Number of logfiles to compress in parallel. Defaults to '
+            'the number of usable CPUs.'
+        )
+    )
+    parser.add_argument(
+        '--engine',
+        choices=ENGINES,
+        default='subprocess',
+        help=(
+            'How to compress: "subprocess" runs gzip once per logfile, '
+            '"stream" compresses in-process. Codecs other than gzip '
+            'always stream.'
+        )
+    )
+    parser.add_argument(
+        '--codec',
+        choices=CODEC_NAMES,
+        default='gzip',
+        help=(
+            'Compression codec. Falls back to gzip if the codec\'s '
+            'library is not installed.'
+        )
+    )
+    parser.add_argument(
+        '--level',
+        type=int,
+        default=None,
+        help='Compression level. Defaults to the codec\'s own default.',
+    )
+    parser.add_argument(
+        '--parallel-threshold',
+        type=int,
+        default=None,
+        metavar='MB',
+        help=(
+            'Compress logfiles of at least this many MB in blocks, '
+            'across all CPUs, as concatenated gzip members. Disabled '
+            'by default.'
+        )
+    )
+    parser.add_argument(
+        '--block-size',
+        type=int,
+        default=DEFAULT_BLOCK_SIZE // MB,
+        metavar='MB',
+        help='Block size for --parallel-threshold, in MB.',
+    )
+    parser.add_argument(
+        '--writer-closed',
+        action='store_true',
+        help=(
+            'Also compress logfiles whose hour has ended as soon as no '
+            'process has them open for writing, rather than waiting '
+            'for a newer logfile or for an hour and five minutes. '
+            'Requires permission to read /proc/*/fd.'
+        )
+    )
+    parser.add_argument(
+        '--closed-grace',
+        type=int,
+        default=DEFAULT_CLOSED_GRACE,
+        metavar='SECS',
+        help=(
+            'With --writer-closed, how long a logfile must go '
+            'unmodified before it is considered closed.'
+        )
+    )
+    parser.add_argument(
+        '--seekable',
+        action='store_true',
+        help=(
+            'Write archives as independently compressed blocks, plus a '
+            'sidecar .idx index of the timestamps in each block, so '
+            'that time windows can be read without decompressing whole '
+            'archives.'
+        )
+    )
+    parser.add_argument(
+        '--index-block-size',
+        type=int,
+        default=seekable.DEFAULT_BLOCK_SIZE // 1024,
+        metavar='KB',
+        help='Block size for --seekable, in KB.',
+    )
+    parser.add_argument(
+        '--index-timestamp-pattern',
+        default=seekable.DEFAULT_TIMESTAMP_PATTERN,
+        metavar='REGEX',
+        help=(
+            'Regular expression for the timestamps of log lines, for '
+            '--seekable. Must have the named groups year, month, day, '
+            'hour, minute and second.'
+        )
+    )
+    parser.add_argument(
+        '--online',
+        action='store_true',
+        help=(
+            'Compress the logfiles still being written incrementally, '
+            'every cycle, so that only their last bytes are left to '
+            'compress once they are superseded.'
+        )
+    )
+    parser.add_argument(
+        '--state-cache',
+        action='store_true',
+        help=(
+            'Cache the parsed contents of log_dir in '
+            'archive/.logjam/state.db, so that it is only re-read '
+            'when it changes.'
+        )
+    )
+    parser.add_argument(
+        '--checksums',
+        action='store_true',
+        help=(
+            'Compute the MD5 of each archive while compressing it, and '
+            'keep it in archive/.logjam/state.db so that logjam-upload '
+            'needn\'t read the archive again to compute it.'
+        )
+    )
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help=(
+            'Use inotify to compress logfiles as soon as log_dir '
+            'changes, rescanning it every --rescan-interval seconds '
+            'regardless.'
+        )
+    )
+    parser.add_argument(
+        '--rescan-interval',
+        type=int,
+        default=service.DEFAULT_RESCAN_INTERVAL,
+        metavar='SECS',
+        help='With --watch, how often to rescan log_dir anyway.',
+    )
     parser.add_argument(
         '--log-level', '-l',
         choices=('debug', 'info', 'warning', 'error', 'critical'),
@@ -221,21 +1059,122 @@ def main():
     parser = make_parser()
     args = parser.parse_args()
 
-    compress_cmd_args = ('gzip', '-c')
-    compress_extension = '.gz'
-
     service.configure_logging(args.log_level)
 
+    if args.block_size < 1:
+        parser.error('--block-size must be at least 1')
+    parallel_threshold = None
+    if args.parallel_threshold is not None:
+        parallel_threshold = args.parallel_threshold * MB
+
+    if args.seekable and (args.online or parallel_threshold is not None):
+        parser.error(
+            '--seekable cannot be combined with --online or '
+            '--parallel-threshold')
+
+    codec = get_codec(args.codec)
+    level = args.level
+    if level is None:
+        level = codec.default_level
+    try:
+        check_level(codec, level)
+    except ValueError, e:
+        parser.error('--level: {}'.format(e))
+    compressobj_factory = functools.partial(codec.compressobj_factory, level)
+
+    compress_cmd_args, compress_extension = make_compressor(
+        codec.name, level, args.engine,
+        parallel_threshold=parallel_threshold,
+        block_size=args.block_size * MB
+    )
+
+    if args.seekable:
+        try:
+            compress_cmd_args = seekable.BlockEngine(
+                compressobj_factory,
+                block_size=args.index_block_size * 1024,
+                timestamp_pattern=args.index_timestamp_pattern
+            )
+        except (ValueError, re.error), e:
+            parser.error(
+                'invalid --index-timestamp-pattern: {}'.format(e))
+
+    online_compressor = None
+    if args.online:
+        online_compressor = online.OnlineCompressor(
+            os.path.join(args.log_dir, 'archive'),
+            compressobj_factory,
+            codec.extension
+        )
+
+    scan_cache = None
+    checksums = None
+    if args.state_cache or args.checksums:
+        archive_dir = os.path.join(args.log_dir, 'archive')
+        if not os.path.isdir(archive_dir):
+            os.mkdir(archive_dir)
+        store = state.open_store(archive_dir)
+        if args.state_cache:
+            scan_cache = state.ScanCache(store)
+        if args.checksums:
+            checksums = state.ChecksumStore(store)
+
+    workers = args.workers
+    if workers is None:
+        workers = default_workers()
+    elif workers < 1:
+        parser.error('--workers must be at least 1')
+
+    closed_grace = None
+    if args.writer_closed:
+        closed_grace = args.closed_grace
+        if find_filenames_open_for_writing(args.log_dir) is None:
+            logging.warning(
+                'compress.main: cannot read open files of all '
+                'processes. --writer-closed will have no effect.')
+
+    watcher = None
+    if args.watch and not args.once:
+        if not inotify.is_available():
+            logging.warning(
+                'compress.main: inotify is not available. Polling '
+                'every %d seconds instead.', service.DEFAULT_INTERVAL)
+        else:
+            try:
+                watcher = inotify.DirectoryWatcher(
+                    args.log_dir, name_filter=is_logfile_name)
+            except OSError, e:
+                logging.warning(
+                    'compress.main: cannot watch %s: %s. Polling every %d '
+                    'seconds instead.',
+                    args.log_dir, e, service.DEFAULT_INTERVAL)
+
     if args.once:
         service.do_once(
             scan_and_compress,
-            args.log_dir, compress_cmd_args, compress_extension
+            args.log_dir, compress_cmd_args, compress_extension,
+            workers=workers, closed_grace=closed_grace,
+            online_compressor=online_compressor, scan_cache=scan_cache,
+            checksums=checksums
+        )
+    elif watcher is not None:
+        service.do_on_change(
+            scan_and_compress,
+            watcher.wait,
+            args.rescan_interval,
+            args.log_dir, compress_cmd_args, compress_extension,
+            workers=workers, closed_grace=closed_grace,
+            online_compressor=online_compressor, scan_cache=scan_cache,
+            checksums=checksums
         )
     else:
         service.do_forever(
             scan_and_compress,
             service.DEFAULT_INTERVAL,
-            args.log_dir, compress_cmd_args, compress_extension
+            args.log_dir, compress_cmd_args, compress_extension,
+            workers=workers, closed_grace=closed_grace,
+            online_compressor=online_compressor, scan_cache=scan_cache,
+            checksums=checksums
         )
 
 
@@ -0,0 +1,318 @@
+"""
+A minimal, single-threaded event loop for generator-based coroutines.
+
+A coroutine is a generator that yields:
+
+    - another coroutine, to run it and get back what it returns,
+    - gather(coroutines), to run several at once and get back the list
+      of what they return,
+    - readable(sock, timeout) or writable(sock, timeout), to wait until
+      a non-blocking socket is ready (or have socket.timeout thrown in
+      after timeout seconds),
+
+and that returns a value by raising Return(value). run() drives
+coroutines from one thread, using poll() where available and select()
+elsewhere.
+
+The socket helpers below (connect(), send_all(), recv()) are themselves
+coroutines, so that HTTP can be spoken over plain or TLS sockets without
+a thread per connection.
+"""
+
+import collections
+import errno
+import select
+import socket
+import ssl
+import sys
+import time
+import types
+
+#
+# Globals
+#
+
+RECV_SIZE = 64 * 1024
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS)
+
+
+class Return(Exception):
+    """ Raised by a coroutine to return a value. """
+
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class _Wait(object):
+    def __init__(self, events, sock, timeout):
+        self.events = events
+        self.sock = sock
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = time.time() + timeout
+
+
+def readable(sock, timeout=None):
+    return _Wait('r', sock, timeout)
+
+
+def writable(sock, timeout=None):
+    return _Wait('w', sock, timeout)
+
+
+class _Gather(object):
+    def __init__(self, coroutines, limit):
+        self.pending = collections.deque(enumerate(coroutines))
+        self.results = [None] * len(self.pending)
+        self.left = len(self.pending)
+        self.limit = limit
+        self.running = 0
+        self.parent = None
+
+
+def gather(coroutines, limit=None):
+    """
+    Yielded from a coroutine, runs coroutines at most limit at a time,
+    and resumes with the list of the values they returned, in order.
+    """
+    return _Gather(list(coroutines), limit)
+
+
+#
+# The loop
+#
+
+class _Task(object):
+    def __init__(self, coroutine, gather, index):
+        self.stack = [coroutine]
+        self.gather = gather
+        self.index = index
+        self.wait = None
+
+
+class _Poller(object):
+    """ Waits on sockets with poll(), or with select() if need be. """
+
+    def __init__(self):
+        self.waits = {}
+        self.poll = select.poll() if hasattr(select, 'poll') else None
+
+    def register(self, fd, events):
+        self.waits[fd] = events
+        if self.poll is not None:
+            self.poll.register(fd, {
+                'r': select.POLLIN,
+                'w': select.POLLOUT,
+            }[events])
+
+    def unregister(self, fd):
+        del self.waits[fd]
+        if self.poll is not None:
+            self.poll.unregister(fd)
+
+    def wait(self, timeout):
+        """ Returns the fds that are ready within timeout seconds. """
+        if self.poll is not None:
+            return [fd for fd, _ in self.poll.poll(
+                None if timeout is None else timeout * 1000)]
+        readers = [fd for fd, e in self.waits.iteritems() if e == 'r']
+        writers = [fd for fd, e in self.waits.iteritems() if e == 'w']
+        r, w, _ = select.select(readers, writers, [], timeout)
+        return r + w
+
+
+def run(coroutines, limit=None):
+    """
+    Runs coroutines to completion, at most limit at a time. Returns the
+    list of the values they returned, in order.
+
+    An exception escaping any coroutine is raised from run().
+    """
+    ready = collections.deque()
+    waiting = {}  # fd -> _Task
+    poller = _Poller()
+
+    def start(gathering):
+        while gathering.pending and (
+                gathering.limit is None or
+                gathering.running < gathering.limit):
+            index, coroutine = gathering.pending.popleft()
+            gathering.running += 1
+            ready.append((_Task(coroutine, gathering, index), None, None))
+
+    def finish(task, value):
+        gathering = task.gather
+        gathering.results[task.index] = value
+        gathering.running -= 1
+        gathering.left -= 1
+        start(gathering)
+        if not gathering.left and gathering.parent is not None:
+            ready.append((gathering.parent, gathering.results, None))
+
+    def step(task, value, exc_info):
+        while True:
+            gen = task.stack[-1]
+            try:
+                if exc_info is not None:
+                    yielded = gen.throw(*exc_info)
+                else:
+                    yielded = gen.send(value)
+            except (Return, StopIteration), e:
+                task.stack.pop()
+                value = getattr(e, 'value', None)
+                exc_info = None
+                if not task.stack:
+                    finish(task, value)
+                    return
+                continue
+            except Exception:
+                task.stack.pop()
+                if not task.stack:
+                    raise
+                value, exc_info = None, sys.exc_info()
+                continue
+
+            value, exc_info = None, None
+            if isinstance(yielded, types.GeneratorType):
+                task.stack.append(yielded)
+            elif isinstance(yielded, _Gather):
+                if not yielded.left:
+                    value = []
+                    continue
+                yielded.parent = task
+                start(yielded)
+                return
+            elif isinstance(yielded, _Wait):
+                fd = yielded.sock.fileno()
+                task.wait = yielded
+                waiting[fd] = task
+                poller.register(fd, yielded.events)
+                return
+            else:
+                exc_info = (TypeError, TypeError(
+                    'coroutine yielded {!r}'.format(yielded)), None)
+
+    root = gather(coroutines, limit)
+    start(root)
+    try:
+        while ready or waiting:
+            while ready:
+                step(*ready.popleft())
+            if not waiting:
+                break
+
+            deadlines = [t.wait.deadline for t in waiting.itervalues()
+                         if t.wait.deadline is not None]
+            timeout = None
+            if deadlines:
+                timeout = max(min(deadlines) - time.time(), 0)
+
+            for fd in poller.wait(timeout):
+                if fd in waiting:
+                    poller.unregister(fd)
+                    ready.append((waiting.pop(fd), None, None))
+
+            now = time.time()
+            for fd, task in waiting.items():
+                deadline = task.wait.deadline
+                if deadline is not None and now >= deadline:
+                    poller.unregister(fd)
+                    del waiting[fd]
+                    ready.append((task, None, (
+                        socket.timeout, socket.timeout('timed out'), None)))
+    finally:
+        # If a coroutine raised, close the rest, so that their sockets
+        # are closed too.
+        for task in waiting.values() + [t for t, _, _ in ready]:
+            for gen in reversed(task.stack):
+                gen.close()
+
+    return root.results
+
+
+#
+# Socket coroutines
+#
+
+def connect(host, port, timeout, ssl_context=None):
+    """
+    Connects a non-blocking socket to host:port, over TLS if given an
+    ssl_context. Returns the socket.
+    """
+    family, socktype, proto, _, address = socket.getaddrinfo(
+        host, port, 0, socket.SOCK_STREAM)[0]
+    sock = socket.socket(family, socktype, proto)
+    try:
+        sock.setblocking(0)
+        err = sock.connect_ex(address)
+        if err and err not in _WOULD_BLOCK:
+            raise socket.error(err, errno.errorcode.get(err, err))
+        if err:
+            yield writable(sock, timeout)
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise socket.error(err, errno.errorcode.get(err, err))
+
+        if ssl_context is not None:
+            sock = ssl_context.wrap_socket(
+                sock, server_hostname=host, do_handshake_on_connect=False)
+            while True:
+                try:
+                    sock.do_handshake()
+                    break
+                except ssl.SSLError, e:
+                    if e.errno == ssl.SSL_ERROR_WANT_READ:
+                        yield readable(sock, timeout)
+                    elif e.errno == ssl.SSL_ERROR_WANT_WRITE:
+                        yield writable(sock, timeout)
+                    else:
+                        raise
+    except:
+        sock.close()
+        raise
+    raise Return(sock)
+
+
+def send_all(sock, data, timeout):
+    """ Sends all of data. """
+    data = buffer(data)
+    while data:
+        try:
+            sent = sock.send(data)
+        except ssl.SSLError, e:
+            if e.errno == ssl.SSL_ERROR_WANT_READ:
+                yield readable(sock, timeout)
+                continue
+            if e.errno != ssl.SSL_ERROR_WANT_WRITE:
+                raise
+            sent = 0
+        except socket.error, e:
+            if e.errno not in _WOULD_BLOCK:
+                raise
+            sent = 0
+        if not sent:
+            yield writable(sock, timeout)
+            continue
+        data = buffer(data, sent)
+
+
+def recv(sock, timeout, size=RECV_SIZE):
+    """ Returns up to size bytes, or '' at EOF. """
+    while True:
+        try:
+            raise Return(sock.recv(size))
+        except ssl.SSLError, e:
+            if e.errno == ssl.SSL_ERROR_WANT_READ:
+                yield readable(sock, timeout)
+            elif e.errno == ssl.SSL_ERROR_WANT_WRITE:
+                yield writable(sock, timeout)
+            elif e.errno == ssl.SSL_ERROR_ZERO_RETURN:
+                raise Return('')
+            else:
+                raise
+        except socket.error, e:
+            if e.errno not in _WOULD_BLOCK:
+                raise
+            yield readable(sock, timeout)
@@ -0,0 +1,168 @@
+"""
+Minimal ctypes wrapper for Linux's inotify(7), used to wake up as soon
+as a log directory changes instead of polling it.
+"""
+
+import collections
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+
+#
+# Globals
+#
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# The events that mean a logfile in a directory may need processing.
+LOGFILE_EVENTS = IN_CLOSE_WRITE | IN_CREATE | IN_MOVED_TO
+
+READ_SIZE = 64 * 1024
+
+# struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+_EVENT_HEADER = struct.Struct('iIII')
+
+Event = collections.namedtuple('Event', ('wd', 'mask', 'cookie', 'name'))
+
+
+#
+# Functions
+#
+
+def _load_libc():
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name:
+        return
+    try:
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+    except OSError:
+        return
+    if not hasattr(libc, 'inotify_init1'):
+        return
+    return libc
+
+
+_libc = _load_libc()
+
+
+def is_available():
+    """ Returns True if inotify can be used on this system. """
+    return _libc is not None
+
+
+def parse_events(data):
+    """
+    Takes a buffer read from an inotify file descriptor. Returns a list
+    of Events.
+    """
+    events = []
+    offset = 0
+    while offset + _EVENT_HEADER.size <= len(data):
+        wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+        offset += _EVENT_HEADER.size
+        name = data[offset:offset + length].rstrip('\0')
+        offset += length
+        events.append(Event(wd, mask, cookie, name))
+    return events
+
+
+class Inotify(object):
+    def __init__(self, libc=None):
+        if libc is None:
+            libc = _libc
+        if libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """ Watches path for events in mask. Returns the watch descriptor. """
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def read_events(self, timeout=None):
+        """
+        Waits up to timeout seconds (or forever, if None) for events.
+        Returns a list of all Events available, which may be empty.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        chunks = []
+        while True:
+            try:
+                chunk = os.read(self.fd, READ_SIZE)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return parse_events(''.join(chunks))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class DirectoryWatcher(object):
+    """
+    Watches a single directory for events in mask. Events for names
+    that name_filter rejects are ignored.
+    """
+
+    def __init__(self, path, mask=LOGFILE_EVENTS, name_filter=None):
+        self.path = path
+        self.name_filter = name_filter
+        self.inotify = Inotify()
+        try:
+            self.inotify.add_watch(path, mask)
+        except OSError:
+            self.inotify.close()
+            raise
+
+    def wait(self, timeout):
+        """
+        Waits up to timeout seconds for a change. Returns True if a
+        change happened (including a lost one, on queue overflow),
+        consuming all pending events.
+        """
+        changed = False
+        for event in self.inotify.read_events(timeout):
+            if event.mask & IN_Q_OVERFLOW:
+                logging.warning(
+                    'inotify.DirectoryWatcher: event queue overflowed '
+                    'for %s', self.path)
+                changed = True
+            elif self.name_filter is None or self.name_filter(event.name):
+                logging.debug(
+                    'inotify.DirectoryWatcher: %s 0x%x',
+                    event.name, event.mask)
+                changed = True
+        return changed
+
+    def close(self):
+        self.inotify.close()
@@ -0,0 +1,186 @@
+"""
+Online compression of logfiles that are still being written.
+
+Rather than compressing a whole logfile in one burst once it's been
+superseded, an OnlineCompressor compresses whatever has been appended to
+each active logfile since its last tick, and appends the result to a
+partial archive as one more complete compressed member. Since gunzip &
+co. read concatenated members as a single stream, the partial archive
+is always a valid archive of the logfile's first `offset` bytes.
+
+Once a logfile is superseded, finish() compresses its last few bytes and
+hands back the partial archive, ready to be renamed into archive/.
+
+Progress is persisted after every member, so that a restarted daemon
+picks up where it left off.
+"""
+
+from __future__ import absolute_import
+
+import io
+import json
+import logging
+import os
+import os.path
+
+from . import parse
+
+#
+# Globals
+#
+
+# Don't bother appending a member for less than this many new bytes,
+# except when finishing a logfile.
+DEFAULT_MIN_CHUNK_SIZE = 1024 * 1024
+
+READ_SIZE = 256 * 1024
+
+STATE_DIRNAME = os.path.join('.logjam', 'online')
+
+
+#
+# Helpers
+#
+
+def _write_json_atomically(path, obj):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+class OnlineCompressor(object):
+    def __init__(self, archive_dir, compressobj_factory, extension,
+                 min_chunk_size=DEFAULT_MIN_CHUNK_SIZE):
+        """
+        Args:
+            archive_dir: the archive/ directory that finished logfiles
+                will be renamed into. Partial archives and state are
+                kept in a hidden directory therein.
+            compressobj_factory: returns a fresh compressobj, as for
+                compress.StreamEngine.
+            extension: the extension of the codec, such as '.gz'.
+            min_chunk_size: the minimum number of new bytes worth
+                compressing during a tick.
+        """
+        self.state_dir = os.path.join(archive_dir, STATE_DIRNAME)
+        self.compressobj_factory = compressobj_factory
+        self.extension = extension
+        self.min_chunk_size = min_chunk_size
+
+    def _paths(self, filename):
+        partial_path = os.path.join(
+            self.state_dir, filename + self.extension + '.partial')
+        state_path = os.path.join(self.state_dir, filename + '.json')
+        return partial_path, state_path
+
+    def _load_state(self, path):
+        """
+        Returns the persisted state for the logfile at path, discarding
+        it (and any partial archive) if the logfile has since been
+        replaced or truncated.
+        """
+        partial_path, state_path = self._paths(os.path.basename(path))
+        st = os.stat(path)
+        state = None
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+            if (state['inode'] != st.st_ino or
+                    state['offset'] > st.st_size or
+                    not os.path.exists(partial_path) or
+                    os.path.getsize(partial_path) < state['size']):
+                logging.warning(
+                    'online.OnlineCompressor: discarding state for %s',
+                    path)
+                state = None
+
+        if state is None:
+            state = {'inode': st.st_ino, 'offset': 0, 'size': 0}
+        return state, st.st_size
+
+    def _append_member(self, path, state, end):
+        """
+        Compresses bytes [state['offset'], end) of the logfile at path,
+        and appends them to its partial archive as one member. Then
+        persists the new state.
+        """
+        partial_path, state_path = self._paths(os.path.basename(path))
+        compressobj = self.compressobj_factory()
+        buf = bytearray(READ_SIZE)
+        with io.open(path, 'rb', buffering=0) as src:
+            with open(partial_path, 'ab') as dst:
+                # Drop anything written after our last checkpoint.
+                dst.truncate(state['size'])
+                dst.seek(state['size'])
+                src.seek(state['offset'])
+                remaining = end - state['offset']
+                while remaining > 0:
+                    n = src.readinto(buf)
+                    if not n:
+                        break
+                    n = min(n, remaining)
+                    dst.write(compressobj.compress(buffer(buf, 0, n)))
+                    remaining -= n
+                dst.write(compressobj.flush())
+                dst.flush()
+                os.fsync(dst.fileno())
+                size = dst.tell()
+
+        state = dict(state, offset=end - remaining, size=size)
+        _write_json_atomically(state_path, state)
+        return state
+
+    def tick(self, log_dir, filenames):
+        """
+        Takes a log directory and the filenames of its active logfiles.
+        Compresses whatever has been appended to each since the last
+        tick, and forgets about logfiles that are no longer active.
+        """
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+
+        active_filenames = set()
+        for filename in filenames:
+            if parse.parse_filename(filename) is None:
+                continue
+            path = os.path.join(log_dir, filename)
+            try:
+                state, size = self._load_state(path)
+                if size - state['offset'] >= self.min_chunk_size:
+                    logging.debug(
+                        'online.OnlineCompressor.tick: %s %d-%d',
+                        path, state['offset'], size)
+                    self._append_member(path, state, size)
+            except EnvironmentError, e:
+                logging.error(
+                    'online.OnlineCompressor.tick: %s failed: %s', path, e)
+            active_filenames.add(filename)
+
+        for name in os.listdir(self.state_dir):
+            if name.endswith('.json'):
+                filename = name[:-len('.json')]
+            elif name.endswith(self.extension + '.partial'):
+                filename = name[:-len(self.extension + '.partial')]
+            else:
+                continue
+            if filename not in active_filenames:
+                os.unlink(os.path.join(self.state_dir, name))
+
+    def finish(self, path):
+        """
+        Takes the path of a logfile that's done being written. Compresses
+        its remaining bytes, and returns the path of its now complete
+        partial archive, or None if it was never ticked.
+        """
+        partial_path, state_path = self._paths(os.path.basename(path))
+        if not os.path.exists(state_path):
+            return
+
+        state, size = self._load_state(path)
+        if size > state['offset'] or state['size'] == 0:
+            self._append_member(path, state, size)
+        os.unlink(state_path)
+        return partial_path
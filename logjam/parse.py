@@ -106,13 +106,22 @@ def group_filenames(filenames):
 
     Filenames that don't parse are excluded from the dict.
     """
+    return group_logfiles(
+        lf for lf in (parse_filename(fn) for fn in filenames)
+        if lf is not None
+    )
+
+
+def group_logfiles(logfiles):
+    """
+    Takes an iterable of LogFiles. Groups them as group_filenames()
+    does.
+    """
 
     result = {}
-    for filename in filenames:
-        lf = parse_filename(filename)
-        if lf is not None:
-            key = (lf.prefix, lf.suffix, lf.extension)
-            result.setdefault(key, []).append(lf)
+    for lf in logfiles:
+        key = (lf.prefix, lf.suffix, lf.extension)
+        result.setdefault(key, []).append(lf)
     for group in result.itervalues():
         group.sort(key=logfile_keyfunc)
     return result
@@ -0,0 +1,410 @@
+"""
+Compress-then-upload pipeline, as a single daemon
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import logging
+import os
+import os.path
+import Queue
+import threading
+
+from . import compress
+from . import parse
+from . import seekable
+from . import service
+from . import state
+from . import upload
+
+
+COMMAND_DESCRIPTION = """
+Takes a directory of ISO8601 logfiles and a URL to upload them to.
+Compresses superseded logfiles into log_dir/archive, as logjam-compress
+does, and hands each archive straight to an upload stage, which uploads
+it as logjam-upload would.
+
+Sample usage:
+
+    logjam-pipeline /var/log/hourly/ \
+    s3://my-log-bucket/{prefix}/{year}/{month}/{day}/{filename}
+
+Uploaded logfiles are recorded in archive/.logjam/state.db, which
+logjam-upload shares.
+
+"""[1:]
+
+# How many archives may wait for the upload stage before the compress
+# stage blocks.
+DEFAULT_QUEUE_DEPTH = 16
+
+# Sidecar files archived next to a logfile, which are uploaded with it.
+SIDECAR_EXTENSIONS = (seekable.INDEX_EXTENSION,)
+
+
+#
+# Core functions
+#
+
+class PipelineService(object):
+    def __init__(self, log_dir, log_upload_uri, compress_cmd_args,
+                 compress_extension, workers=1, closed_grace=None,
+                 concurrency=1, queue_depth=DEFAULT_QUEUE_DEPTH,
+                 uploader=None, journal=None, checksums=None,
+                 uploader_kwargs=None):
+        """
+        Args:
+            log_dir: path to a directory of logfiles,
+            log_upload_uri: an upload URI,
+            compress_cmd_args: as for compress.compress_path(),
+            compress_extension: the extension of compressed logfiles,
+            workers: (optional) number of logfiles to compress at once.
+            closed_grace: (optional) as for compress.scan_and_compress().
+            concurrency: (optional) number of logfiles to upload at
+                once, each upload thread with its own uploader.clone().
+            queue_depth: (optional) number of archives that may wait to
+                be uploaded before compression waits for the upload
+                stage to catch up.
+            uploader: (optional) uploader instance. Generally used for
+                injecting an uploader when testing.
+            journal: (optional) state.UploadJournal of uploaded
+                logfiles. Defaults to that of log_dir/archive, into
+                which any old .uploaded/ marker directory is migrated.
+            checksums: (optional) state.ChecksumStore, as for
+                compress.scan_and_compress().
+            uploader_kwargs: (optional) dict of keyword arguments for
+                the uploader found by upload.get_uploader().
+        """
+        self.log_dir = log_dir
+        self.archive_dir = os.path.join(log_dir, 'archive')
+        if not os.path.isdir(self.archive_dir):
+            os.mkdir(self.archive_dir)
+        self.log_upload_uri = log_upload_uri
+        self.compress_cmd_args = compress_cmd_args
+        self.compress_extension = compress_extension
+        self.workers = workers
+        self.closed_grace = closed_grace
+        self.concurrency = concurrency
+        self.uploader = uploader
+        if journal is None:
+            journal = state.UploadJournal(state.open_store(self.archive_dir))
+        marker_dir = os.path.join(self.archive_dir, upload.MARKER_DIRNAME)
+        if os.path.isdir(marker_dir):
+            journal.migrate_marker_dir(marker_dir)
+        self.journal = journal
+        self.checksums = checksums
+        self.uploader_kwargs = uploader_kwargs or {}
+
+        self.queue = Queue.Queue(maxsize=queue_depth)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.failed = set()
+        self.caught_up = False
+
+    #
+    # Upload stage
+    #
+
+    def start(self):
+        """
+        Connects the uploader and starts the upload stage's threads.
+        """
+        uploader = self.uploader or upload.get_uploader(
+            self.log_upload_uri, **self.uploader_kwargs)
+        uploader.connect()
+        error = uploader.check_uri()
+        if error:
+            logging.error(
+                'Invalid upload_uri %s: %s', self.log_upload_uri, error
+            )
+            raise Exception('Invalid upload_uri %s: %s' % (
+                self.log_upload_uri, error
+            ))
+
+        for i in range(self.concurrency):
+            if i == 0:
+                thread_uploader = uploader
+            else:
+                thread_uploader = uploader.clone()
+                thread_uploader.connect()
+            thread = threading.Thread(
+                target=self._upload_forever,
+                args=(thread_uploader,),
+                name='logjam-upload-{}'.format(i)
+            )
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """
+        Waits for the upload stage to upload everything queued so far,
+        then stops its threads.
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _upload_forever(self, uploader):
+        while True:
+            filename = self.queue.get()
+            try:
+                if filename is None:
+                    return
+                self._upload_filename(uploader, filename)
+            except Exception:
+                # Keep the thread alive: if it died, a full queue would
+                # block the compress stage for good.
+                logging.exception('pipeline: error handling %s', filename)
+                with self.lock:
+                    self.failed.add(filename)
+            finally:
+                self.queue.task_done()
+
+    def _upload_filename(self, uploader, filename):
+        logfile = parse.parse_filename(filename)
+        if logfile is None:
+            return
+        try:
+            # Reconnects after errors, or when credentials near expiry.
+            uploader.connect()
+            error = uploader.upload_logfile(self.archive_dir, logfile)
+            if not error:
+                # If this fails (say, state.db is locked), the file is
+                # uploaded again next time. S3Uploader finds it there.
+                self.journal.add([filename])
+        except Exception, e:
+            logging.exception(
+                'pipeline: error uploading %s', filename)
+            error = e
+
+        if error:
+            logging.warning('pipeline: failed to upload %s', filename)
+            uploader.disconnect()
+            with self.lock:
+                self.failed.add(filename)
+        else:
+            logging.info('pipeline: uploaded %s', filename)
+
+    #
+    # Compress stage
+    #
+
+    def _hand_off(self, path):
+        """
+        Queues an archived logfile (and any sidecars) for upload,
+        blocking while the queue is full.
+        """
+        for extension in SIDECAR_EXTENSIONS:
+            if os.path.isfile(path + extension):
+                self.queue.put(os.path.basename(path + extension))
+        self.queue.put(os.path.basename(path))
+
+    def _get_backlog(self):
+        """
+        Returns the sorted list of filenames to upload before any newly
+        compressed ones: on the first run, every archived file not yet
+        uploaded, and after that, those whose uploads failed.
+        """
+        with self.lock:
+            filenames = set(self.failed)
+            self.failed.clear()
+        if not self.caught_up:
+            filenames.update(os.listdir(self.archive_dir))
+            filenames -= self.journal.get_uploaded(filenames)
+            self.caught_up = True
+        return sorted(filenames)
+
+    def run(self):
+        """
+        Queues any backlog for upload, then compresses every superseded
+        logfile in log_dir, queueing each archive for upload as soon as
+        it's written. Returns the list of archived paths.
+
+        Uploads carry on in the background; see stop().
+        """
+        if not self.threads:
+            self.start()
+
+        for filename in self._get_backlog():
+            self.queue.put(filename)
+
+        return filter(None, compress.scan_and_compress(
+            self.log_dir,
+            self.compress_cmd_args,
+            self.compress_extension,
+            workers=self.workers,
+            closed_grace=self.closed_grace,
+            checksums=self.checksums,
+            on_compressed=self._hand_off
+        ))
+
+    def run_once(self):
+        """ Runs once, then waits for every upload to finish. """
+        try:
+            return self.run()
+        finally:
+            self.stop()
+
+
+#
+# CLI functions
+#
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description=COMMAND_DESCRIPTION,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        'log_dir',
+        help='Directory in which to scan for hourly log files',
+    )
+    parser.add_argument(
+        'log_upload_uri',
+        help=(
+            'Upload URI. Must contain {prefix}, {year}, {month}, '
+            '{day}, and {filename}.'
+        )
+    )
+    parser.add_argument(
+        '--once',
+        action='store_true',
+        help=(
+            'Compress and upload once, then exit, instead of running '
+            'continuously.'
+        )
+    )
+    parser.add_argument(
+        '--workers', '-w',
+        type=int,
+        default=None,
+        help=(
+            'Number of logfiles to compress in parallel. Defaults to '
+            'the number of usable CPUs.'
+        )
+    )
+    parser.add_argument(
+        '--concurrency', '-c',
+        type=int,
+        default=1,
+        help='Number of logfiles to upload in parallel. Defaults to 1.'
+    )
+    parser.add_argument(
+        '--queue-depth',
+        type=int,
+        default=DEFAULT_QUEUE_DEPTH,
+        metavar='N',
+        help=(
+            'Number of archives that may wait to be uploaded before '
+            'compression pauses. Defaults to {}.'.format(
+                DEFAULT_QUEUE_DEPTH)
+        )
+    )
+    parser.add_argument(
+        '--engine',
+        choices=compress.ENGINES,
+        default='subprocess',
+        help=(
+            'How to compress: "subprocess" runs an external command, '
+            '"stream" compresses in-process. Defaults to subprocess.'
+        )
+    )
+    parser.add_argument(
+        '--codec',
+        choices=compress.CODEC_NAMES,
+        default='gzip',
+        help='Compression codec to use. Defaults to gzip.'
+    )
+    parser.add_argument(
+        '--level',
+        type=int,
+        help='Compression level. Defaults to the codec\'s own default.'
+    )
+    parser.add_argument(
+        '--writer-closed',
+        action='store_true',
+        help=(
+            'Also compress logfiles whose hour has ended as soon as no '
+            'process has them open for writing. As for '
+            'logjam-compress.'
+        )
+    )
+    parser.add_argument(
+        '--closed-grace',
+        type=int,
+        default=compress.DEFAULT_CLOSED_GRACE,
+        metavar='SECS',
+        help=(
+            'With --writer-closed, how long a logfile must go '
+            'unmodified before it\'s compressed. Defaults to {}.'.format(
+                compress.DEFAULT_CLOSED_GRACE)
+        )
+    )
+    parser.add_argument(
+        '--log-level', '-l',
+        choices=('debug', 'info', 'warning', 'error', 'critical'),
+        default='info',
+        help='Log level to use for logjam\'s own logging',
+    )
+    return parser
+
+
+def main():
+    parser = make_parser()
+    args = parser.parse_args()
+
+    service.configure_logging(args.log_level)
+
+    # Tune down boto logging
+    logging.getLogger('boto').setLevel(logging.WARNING)
+
+    workers = args.workers
+    if workers is None:
+        workers = compress.default_workers()
+    elif workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+    if args.queue_depth < 1:
+        parser.error('--queue-depth must be at least 1')
+
+    closed_grace = None
+    if args.writer_closed:
+        closed_grace = args.closed_grace
+
+    try:
+        compress_cmd_args, compress_extension = compress.make_compressor(
+            args.codec, args.level, args.engine)
+    except ValueError, e:
+        parser.error('--level: {}'.format(e))
+
+    archive_dir = os.path.join(args.log_dir, 'archive')
+    if not os.path.isdir(archive_dir):
+        os.mkdir(archive_dir)
+    store = state.open_store(archive_dir)
+
+    pipeline_service = PipelineService(
+        args.log_dir,
+        args.log_upload_uri,
+        compress_cmd_args,
+        compress_extension,
+        workers=workers,
+        closed_grace=closed_grace,
+        concurrency=args.concurrency,
+        queue_depth=args.queue_depth,
+        journal=state.UploadJournal(store),
+        checksums=state.ChecksumStore(store)
+    )
+
+    if args.once:
+        service.do_once(pipeline_service.run_once)
+    else:
+        service.do_forever(pipeline_service.run, service.DEFAULT_INTERVAL)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+"""
+Retrying, and backing off from, failed uploads.
+
+RetryPolicy retries an upload that failed for a transient reason, with
+exponential backoff and jitter, up to a limit per class of error.
+CircuitBreaker pauses uploads altogether once too many recent ones have
+failed. AIMDController limits how many uploads are in flight at once,
+adding to the limit as uploads succeed and halving it when S3 throttles
+us, so that concurrency settles at what S3 will accept.
+"""
+
+import collections
+import errno
+import logging
+import random
+import socket
+import threading
+import time
+
+#
+# Classes of error
+#
+
+THROTTLED = 'throttled'      # 503 SlowDown, or 429
+SERVER_ERROR = 'server'      # other 5xx
+NETWORK_ERROR = 'network'    # socket errors, timeouts and the like
+FATAL = 'fatal'              # anything else: not worth retrying
+
+TRANSIENT = (THROTTLED, SERVER_ERROR, NETWORK_ERROR)
+
+# Errnos of EnvironmentErrors that come from the network, rather than
+# from reading the local file being uploaded.
+NETWORK_ERRNOS = frozenset([
+    errno.ECONNABORTED, errno.ECONNREFUSED, errno.ECONNRESET,
+    errno.EHOSTUNREACH, errno.ENETDOWN, errno.ENETRESET,
+    errno.ENETUNREACH, errno.EPIPE, errno.ETIMEDOUT,
+])
+
+# How many times to try an upload, by class of error.
+DEFAULT_MAX_ATTEMPTS = {
+    THROTTLED: 6,
+    SERVER_ERROR: 3,
+    NETWORK_ERROR: 3,
+    FATAL: 1,
+}
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 30
+
+DEFAULT_BREAKER_WINDOW = 20
+DEFAULT_BREAKER_THRESHOLD = 0.5
+DEFAULT_BREAKER_MIN_RESULTS = 5
+DEFAULT_BREAKER_COOLDOWN = 60
+
+
+def classify(error):
+    """
+    Takes an error, as returned by an Uploader's upload_logfile(), and
+    returns its class, or None if there was no error.
+    """
+    if error is None:
+        return
+    status = getattr(error, 'status', None)
+    if status in (429, 503) or \
+            getattr(error, 'error_code', None) == 'SlowDown':
+        return THROTTLED
+    if isinstance(status, int):
+        return SERVER_ERROR if status >= 500 else FATAL
+    if isinstance(error, socket.error):  # including timeouts and SSL
+        return NETWORK_ERROR
+    if isinstance(error, EnvironmentError):
+        # Without an errno, it's one we raised about a broken response.
+        if error.errno is None or error.errno in NETWORK_ERRNOS:
+            return NETWORK_ERROR
+    return FATAL
+
+
+class CircuitOpenError(Exception):
+    """ Returned in place of an upload the CircuitBreaker disallowed. """
+
+
+#
+# Retries
+#
+
+class RetryPolicy(object):
+    def __init__(self, max_attempts=None, base_delay=DEFAULT_BASE_DELAY,
+                 max_delay=DEFAULT_MAX_DELAY, sleep=time.sleep,
+                 random_func=random.random):
+        """
+        Args:
+            max_attempts: (optional) dict of how many times to try,
+                by class of error, overriding DEFAULT_MAX_ATTEMPTS.
+            base_delay: seconds to wait, at most, before the first
+                retry. Each retry after that waits up to twice as long.
+            max_delay: the longest to wait before any retry.
+            sleep, random_func: for dependency injection during tests.
+        """
+        self.max_attempts = dict(DEFAULT_MAX_ATTEMPTS)
+        self.max_attempts.update(max_attempts or {})
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.random_func = random_func
+
+    def get_delay(self, attempt):
+        """
+        Returns how long to wait after the given attempt (from 1): a
+        random time up to the exponential backoff, so that retries from
+        many threads and hosts spread out ("full jitter").
+        """
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return backoff * self.random_func()
+
+    def call(self, func, args=(), observe=None):
+        """
+        Calls func(*args), which returns an error or None, until it
+        succeeds, fails with an error not worth retrying, or has been
+        tried as many times as its class of error allows. Returns the
+        last error, if any.
+
+        observe, if given, is called with the class of error (or None)
+        of each attempt.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            error = func(*args)
+            error_class = classify(error)
+            if observe is not None:
+                observe(error_class)
+            if error_class is None or \
+                    attempt >= self.max_attempts.get(error_class, 1):
+                return error
+
+            delay = self.get_delay(attempt)
+            logging.info(
+                'retry.RetryPolicy: attempt %d failed (%s: %s). '
+                'Retrying in %.2fs', attempt, error_class, error, delay)
+            self.sleep(delay)
+
+
+#
+# Circuit breaker
+#
+
+class CircuitBreaker(object):
+    def __init__(self, window=DEFAULT_BREAKER_WINDOW,
+                 threshold=DEFAULT_BREAKER_THRESHOLD,
+                 min_results=DEFAULT_BREAKER_MIN_RESULTS,
+                 cooldown=DEFAULT_BREAKER_COOLDOWN, time_func=time.time):
+        """
+        Opens -- disallowing uploads -- once at least threshold of the
+        last window attempts (and at least min_results of them) have
+        failed for transient reasons. After cooldown seconds, one upload
+        is allowed through: the breaker closes if it succeeds, and opens
+        again if not.
+
+        A CircuitBreaker may be shared between threads.
+        """
+        self.threshold = threshold
+        self.min_results = min_results
+        self.cooldown = cooldown
+        self.time_func = time_func
+        self.results = collections.deque(maxlen=window)
+        self.opened = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """ Returns whether an upload may go ahead. """
+        with self.lock:
+            if self.opened is None:
+                return True
+            if self.probing or \
+                    self.time_func() - self.opened < self.cooldown:
+                return False
+            self.probing = True
+            return True
+
+    def record(self, error_class):
+        """ Records the class of error (or None) of an attempt. """
+        failed = error_class in TRANSIENT
+        with self.lock:
+            if self.opened is not None:
+                if not self.probing:
+                    return
+                self.probing = False
+                if failed:
+                    self.opened = self.time_func()
+                else:
+                    logging.info('retry.CircuitBreaker: closed')
+                    self.opened = None
+                    self.results.clear()
+                return
+
+            self.results.append(failed)
+            failures = sum(self.results)
+            if len(self.results) >= self.min_results and \
+                    failures >= self.threshold * len(self.results):
+                logging.warning(
+                    'retry.CircuitBreaker: %d of the last %d uploads '
+                    'failed. Pausing uploads for %ds.',
+                    failures, len(self.results), self.cooldown)
+                self.opened = self.time_func()
+
+
+#
+# Concurrency control
+#
+
+class AIMDController(object):
+    def __init__(self, maximum, minimum=1, initial=None, increase=1.0,
+                 decrease=0.5):
+        """
+        Limits how many uploads are in flight at once, between minimum
+        and maximum, starting at initial (by default, maximum).
+
+        Each success adds increase / limit to the limit, so that it
+        grows by about increase for every limit uploads. Being
+        throttled multiplies it by decrease, at most once for each
+        limit uploads, so that one burst of throttling counts once.
+
+        An AIMDController may be shared between threads.
+        """
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(maximum if initial is None else initial)
+        self.increase = increase
+        self.decrease = decrease
+        self.in_flight = 0
+        self.since_decrease = self.limit
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        """ Waits until another upload may be in flight. """
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, error_class):
+        """
+        Marks an upload as no longer in flight, adjusting the limit by
+        its class of error (or None).
+        """
+        with self.cond:
+            self.in_flight -= 1
+            self.since_decrease += 1
+            if error_class == THROTTLED:
+                if self.since_decrease >= self.limit:
+                    self.limit = max(
+                        self.minimum, self.limit * self.decrease)
+                    self.since_decrease = 0
+                    logging.info(
+                        'retry.AIMDController: throttled. Limit now %d',
+                        int(self.limit))
+            elif error_class is None:
+                self.limit = min(
+                    self.maximum, self.limit + self.increase / self.limit)
+            self.cond.notify_all()
@@ -4,22 +4,34 @@ Uploader for uploading logs to S3.
 
 from __future__ import absolute_import
 
+import base64
+import calendar
+import collections
+import contextlib
+import cStringIO
 import json
 import logging
+import multiprocessing.pool
 import os
 import socket
 import string
+import sys
+import threading
+import time
 
 # NB: Although not used directly, boto.storage_uri_for_key() depends on
 # boto.s3.key being imported.
 import boto
 import boto.s3
 import boto.s3.key
+import boto.s3.multipart
 import boto.exception
 import boto.utils
 
 from .base_uploader import BaseUploader
 from . import parse
+from . import state
+from . import throttle
 
 #
 # S3 connection helpers
@@ -27,6 +39,10 @@ from . import parse
 
 EC2_METADATA_TIMEOUT = 0.2
 
+# Reconnect with fresh IAM role credentials this long before the old
+# ones expire.
+CREDENTIALS_REFRESH_SECS = 5 * 60
+
 
 def _get_ec2_metadata(timeout=EC2_METADATA_TIMEOUT):
     """
@@ -47,10 +63,10 @@ def _get_ec2_metadata(timeout=EC2_METADATA_TIMEOUT):
     return boto.utils.get_instance_metadata()
 
 
-def _get_iam_role(get_ec2_metadata):
+def _get_iam_cred(get_ec2_metadata):
     """
-    Fetches the first IAM role present in our local EC2 instance
-    metadata, if available. Else returns None.
+    Fetches the credential of the first IAM role present in our local
+    EC2 instance metadata, as a dict, if available. Else returns None.
     """
 
     ec2_metadata = get_ec2_metadata()
@@ -65,24 +81,51 @@ def _get_iam_role(get_ec2_metadata):
         # earlier versions of boto (including 2.2.2) don't parse the
         # cred but return a list of JSON fragments.
         cred = json.loads(''.join(cred))
+    return cred
+
+
+def _get_iam_role(get_ec2_metadata):
+    """
+    Fetches the first IAM role present in our local EC2 instance
+    metadata, if available. Else returns None.
+    """
+    cred = _get_iam_cred(get_ec2_metadata)
+    if cred is None:
+        return
     return cred['AccessKeyId'], cred['SecretAccessKey'], cred['Token']
 
 
+def _get_cred_expiration(cred):
+    """
+    Returns when an IAM role credential expires, in seconds since the
+    epoch, or None if it doesn't say.
+    """
+    try:
+        return calendar.timegm(
+            time.strptime(cred['Expiration'], '%Y-%m-%dT%H:%M:%SZ'))
+    except (KeyError, ValueError):
+        return
+
+
+def _get_region(os_environ, get_ec2_metadata):
+    """
+    Returns the region to connect to S3 in: $AWS_DEFAULT_REGION if
+    available, else the EC2 region, else None.
+    """
+    if os_environ.get('AWS_DEFAULT_REGION'):
+        return os_environ['AWS_DEFAULT_REGION']
+    ec2_metadata = get_ec2_metadata()
+    if ec2_metadata is not None:
+        return ec2_metadata['placement']['availability-zone'][:-1]
+
+
 def _get_s3_endpoint(os_environ, get_ec2_metadata):
     """
     Returns the S3 endpoint to use when connecting to S3, using
     $AWS_DEFAULT_REGION if available, else the EC2 region, else the
     default region (us-east-1).
     """
-    region_name = None
-    if os_environ.get('AWS_DEFAULT_REGION'):
-        region_name = os_environ['AWS_DEFAULT_REGION']
-    else:
-        ec2_metadata = get_ec2_metadata()
-        if ec2_metadata is not None:
-            region_name = \
-                ec2_metadata['placement']['availability-zone'][:-1]
-
+    region_name = _get_region(os_environ, get_ec2_metadata)
     if region_name is None:
         return 's3.amazonaws.com'
     return 's3-{}.amazonaws.com'.format(region_name)
@@ -95,6 +138,9 @@ def _connect_s3(os_environ=None, get_ec2_metadata=None,
     either credentials in the standard environment variable or else, if
     called from an EC2 instance, in the first IAM role found in
     the instance metadata.
+
+    A connection made with IAM role credentials that expire has their
+    expiration as its credentials_expiration attribute.
     """
 
     # Dependencies
@@ -111,21 +157,98 @@ def _connect_s3(os_environ=None, get_ec2_metadata=None,
             's3_uploader._connect_s3: connecting to %s', s3_endpoint)
         return boto_connect_s3(host=s3_endpoint)
     except boto.exception.NoAuthHandlerFound:
-        tup = _get_iam_role(get_ec2_metadata)
-        if tup is None:
+        cred = _get_iam_cred(get_ec2_metadata)
+        if cred is None:
             raise Exception('No credentials found for connecting to S3')
 
-        aws_access_key_id, aws_secret_access_key, security_token = tup
         logging.debug(
             's3_uploader._connect_s3: connecting to %s with IAM role',
             s3_endpoint
         )
-        return boto_connect_s3(
-            aws_access_key_id,
-            aws_secret_access_key,
-            security_token=security_token,
+        s3_conn = boto_connect_s3(
+            cred['AccessKeyId'],
+            cred['SecretAccessKey'],
+            security_token=cred['Token'],
             host=s3_endpoint,
         )
+        expiration = _get_cred_expiration(cred)
+        if expiration is not None:
+            # Lets S3Uploader.connect() tell when to reconnect.
+            s3_conn.credentials_expiration = expiration
+        return s3_conn
+
+
+#
+# Multipart helpers
+#
+
+MB = 1024 * 1024
+
+# S3 rejects parts smaller than this, other than the last one.
+MIN_PART_SIZE = 5 * MB
+MAX_PARTS = 10000
+
+DEFAULT_MULTIPART_THRESHOLD = 100 * MB
+DEFAULT_PART_SIZE = 16 * MB
+DEFAULT_PART_CONCURRENCY = 4
+
+# How many times to try sending a part before giving up for this cycle.
+PART_ATTEMPTS = 3
+
+DEFAULT_LIST_CONCURRENCY = 4
+
+# How often scan_remote() relists a directory it has a manifest of.
+DEFAULT_RECONCILE_INTERVAL = 24 * 60 * 60
+
+# Multipart uploads older than this are restarted rather than resumed.
+MAX_MULTIPART_AGE = 7 * 24 * 60 * 60
+
+
+def get_parts(size, part_size):
+    """
+    Takes the size of a file and a part size. Returns a list of
+    (part_num, offset, length) tuples covering the file, growing the
+    part size if need be to stay within MAX_PARTS.
+    """
+    part_size = max(part_size, -(-size // MAX_PARTS))
+    return [
+        (i + 1, offset, min(part_size, size - offset))
+        for i, offset in enumerate(xrange(0, size, part_size))
+    ]
+
+
+def _md5_arg(hex_md5):
+    """
+    Takes a hex MD5. Returns the (hex, base64) tuple boto accepts as a
+    precomputed md5= argument.
+    """
+    return hex_md5, base64.b64encode(hex_md5.decode('hex'))
+
+
+def _throttle(f, rate_limiter, md5, size=None):
+    """
+    Takes a file to upload, a throttle.TokenBucket (or None) and the
+    md5= argument for boto. Returns the file and md5 to upload with
+    instead: the file wrapped so that reading it is rate limited, and
+    its MD5 computed up front, so that boto's own reading of it to do
+    so isn't limited too.
+    """
+    if rate_limiter is None:
+        return f, md5
+    if md5 is None:
+        md5 = boto.utils.compute_md5(f, size=size)[:2]
+    return throttle.ThrottledFile(f, rate_limiter), md5
+
+
+def _bind_multipart_upload(bucket, key_name, upload_id):
+    """
+    Returns a boto MultiPartUpload for an upload initiated elsewhere,
+    bound to bucket (and so to bucket's connection).
+    """
+    mp = boto.s3.multipart.MultiPartUpload(bucket)
+    mp.key_name = key_name
+    mp.id = upload_id
+    return mp
 
 
 #
@@ -189,16 +312,183 @@ def get_parent_dir_uris(logfile_uris):
     )
 
 
+class StreamUpload(object):
+    """
+    A write-only file object that uploads what's written to it to S3,
+    as returned by S3Uploader.open_stream().
+
+    Writes are buffered into parts of at least part_size bytes, which
+    are sent as a multipart upload, up to part_concurrency at a time,
+    while more is written. If everything written fits in one part, it's
+    sent as a single PUT instead.
+
+    write() raises IOError if a part fails. close() returns an error,
+    if any, cancelling the upload if so.
+    """
+
+    def __init__(self, uploader, bucket, key_name):
+        self.uploader = uploader
+        self.bucket = bucket
+        self.key_name = key_name
+        self.buf = []
+        self.buf_size = 0
+        self.mp = None
+        self.pool = None
+        self.pending = collections.deque()
+        self.part_num = 0
+
+    def write(self, data):
+        self.buf.append(str(data))
+        self.buf_size += len(data)
+        if self.buf_size >= self.uploader.part_size:
+            try:
+                self._send_part()
+            except (boto.exception.BotoServerError, EnvironmentError), e:
+                raise IOError('upload of {} failed: {}'.format(
+                    self.key_name, e))
+
+    def _take_buffer(self):
+        data = ''.join(self.buf)
+        self.buf = []
+        self.buf_size = 0
+        return data
+
+    def _upload_part(self, part_num, data):
+        with self.uploader.worker_connection() as s3_conn:
+            mp = self.uploader.bind_multipart_upload(
+                s3_conn.get_bucket(self.bucket.name, validate=False),
+                self.key_name,
+                self.mp.id
+            )
+            for attempt in range(1, PART_ATTEMPTS + 1):
+                try:
+                    f, md5 = _throttle(
+                        cStringIO.StringIO(data), self.uploader.rate_limiter,
+                        None)
+                    mp.upload_part_from_file(
+                        f, part_num, md5=md5, size=len(data))
+                    return
+                except (boto.exception.BotoServerError,
+                        EnvironmentError), e:
+                    logging.warning(
+                        'StreamUpload: part %d of %s failed (attempt %d of '
+                        '%d): %s',
+                        part_num, self.key_name, attempt, PART_ATTEMPTS, e)
+                    if attempt == PART_ATTEMPTS:
+                        raise
+
+    def _wait(self, max_pending):
+        while len(self.pending) > max_pending:
+            self.pending.popleft().get()
+
+    def _send_part(self):
+        if self.mp is None:
+            self.mp = self.bucket.initiate_multipart_upload(self.key_name)
+            self.pool = multiprocessing.pool.ThreadPool(
+                self.uploader.part_concurrency)
+        # Bound what's buffered in memory to part_concurrency parts.
+        self._wait(self.uploader.part_concurrency - 1)
+        self.part_num += 1
+        self.pending.append(self.pool.apply_async(
+            self._upload_part, (self.part_num, self._take_buffer())))
+
+    def close(self):
+        try:
+            if self.mp is None:
+                key = self.bucket.new_key(self.key_name)
+                data = self._take_buffer()
+                if self.uploader.rate_limiter is None:
+                    key.set_contents_from_string(data)
+                else:
+                    f, md5 = _throttle(
+                        cStringIO.StringIO(data),
+                        self.uploader.rate_limiter, None)
+                    key.set_contents_from_file(f, md5=md5)
+                return
+            if self.buf_size:
+                self._send_part()
+            self._wait(0)
+            self.mp.complete_upload()
+        except (boto.exception.BotoServerError, EnvironmentError), e:
+            logging.error('StreamUpload: upload of %s failed: %s',
+                          self.key_name, e)
+            self.cancel()
+            return e
+        finally:
+            self._close_pool()
+
+    def cancel(self):
+        """ Abandons the upload. """
+        self.buf = []
+        self.buf_size = 0
+        self._close_pool()
+        if self.mp is not None:
+            try:
+                self.mp.cancel_upload()
+            except boto.exception.BotoServerError, e:
+                logging.error('StreamUpload: failed to cancel %s: %s',
+                              self.mp.id, e)
+            self.mp = None
+
+    def _close_pool(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self.pending.clear()
+
+
 class S3Uploader(BaseUploader):
     def __init__(self, upload_uri, connect_s3=None,
-                 storage_uri_for_key=None):
+                 storage_uri_for_key=None, bind_multipart_upload=None,
+                 multipart_threshold=DEFAULT_MULTIPART_THRESHOLD,
+                 part_size=DEFAULT_PART_SIZE,
+                 part_concurrency=DEFAULT_PART_CONCURRENCY,
+                 multipart_state=None, checksums=None, manifest=None,
+                 reconcile_interval=DEFAULT_RECONCILE_INTERVAL,
+                 trust_scan=False,
+                 list_concurrency=DEFAULT_LIST_CONCURRENCY,
+                 rate_limiter=None):
         """
-        Takes an upload_uri, and two optional arguments for dependency
+        Takes an upload_uri, and three optional arguments for dependency
         injection during test runs:
 
             - connect_s3: a suitable implementation of _connect_s3()
             - storage_uri_for_key: a suitable implementation of
                                    boto.storage_uri_for_key()
+            - bind_multipart_upload: a suitable implementation of
+                                     _bind_multipart_upload()
+
+        Files of at least multipart_threshold bytes are sent as a
+        multipart upload of part_size parts, part_concurrency of them at
+        a time. A multipart_threshold of None disables multipart uploads.
+
+        Progress of multipart uploads is kept in multipart_state, a
+        state.MultipartState, which defaults to that of the archive
+        directory being uploaded.
+
+        Checksums computed by logjam-compress --checksums are read from
+        checksums, a state.ChecksumStore, which likewise defaults to
+        that of the archive directory (if it has one). Files without a
+        checksum have theirs computed by boto, at the cost of reading
+        them twice.
+
+        If manifest (a state.Manifest) is given, uploads are recorded in
+        it, and scan_remote() consults it before listing the bucket.
+        Each directory is listed again, to reconcile the manifest with
+        the bucket, once its last listing is reconcile_interval seconds
+        old.
+
+        Unless trust_scan is set, upload_logfile() checks that each file
+        isn't already uploaded before sending it. With trust_scan, it
+        relies on scan_remote() having just done so, saving a round
+        trip per file, and sends single PUTs with If-None-Match: * so
+        that S3 still refuses to overwrite an existing file.
+
+        scan_remote() lists up to list_concurrency directories at once.
+
+        If rate_limiter (a throttle.TokenBucket) is given, uploads are
+        limited to its rate. Clones share it, and so share its rate.
         """
         super(S3Uploader, self).__init__(upload_uri)
 
@@ -212,13 +502,102 @@ class S3Uploader(BaseUploader):
         else:
             self.storage_uri_for_key = storage_uri_for_key
 
+        if bind_multipart_upload is None:
+            self.bind_multipart_upload = _bind_multipart_upload
+        else:
+            self.bind_multipart_upload = bind_multipart_upload
+
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.part_concurrency = part_concurrency
+        self.multipart_state = multipart_state
+        self.checksums = checksums
+        self.manifest = manifest
+        self.reconcile_interval = reconcile_interval
+        self.trust_scan = trust_scan
+        self.list_concurrency = list_concurrency
+        self.rate_limiter = rate_limiter
+
         self.s3_conn = None
         self.bucket_cache = None
+        self.uri_checked = False
+        self._idle_conns = []
+        self._idle_conns_lock = threading.Lock()
+
+    def clone(self):
+        return self.__class__(
+            self.upload_uri,
+            connect_s3=self.connect_s3,
+            storage_uri_for_key=self.storage_uri_for_key,
+            bind_multipart_upload=self.bind_multipart_upload,
+            multipart_threshold=self.multipart_threshold,
+            part_size=self.part_size,
+            part_concurrency=self.part_concurrency,
+            multipart_state=self.multipart_state,
+            checksums=self.checksums,
+            manifest=self.manifest,
+            reconcile_interval=self.reconcile_interval,
+            trust_scan=self.trust_scan,
+            list_concurrency=self.list_concurrency,
+            rate_limiter=self.rate_limiter
+        )
 
     def connect(self):
+        """
+        Connects to S3, unless already connected. The connection, and
+        its cache of buckets, is kept until disconnect() or until its
+        IAM role credentials are about to expire.
+        """
+        if self.s3_conn is not None and not self._credentials_expiring():
+            return
+        if self.s3_conn is not None:
+            logging.info(
+                's3_uploader.S3Uploader.connect: refreshing credentials')
         self.s3_conn = self.connect_s3()
         self.bucket_cache = {}
 
+    def _credentials_expiring(self, s3_conn=None):
+        if s3_conn is None:
+            s3_conn = self.s3_conn
+        expiration = getattr(s3_conn, 'credentials_expiration', None)
+        return (expiration is not None and
+                time.time() >= expiration - CREDENTIALS_REFRESH_SECS)
+
+    @contextlib.contextmanager
+    def worker_connection(self):
+        """
+        Yields a connection to S3 for use by one worker thread (listing
+        a directory, or sending a part) while it's in the with block.
+
+        The connection is kept afterwards for the next worker, across
+        upload cycles, so that each one doesn't have to find the S3
+        endpoint and credentials and make a new TLS connection again.
+        Like connect(), a connection whose IAM role credentials are
+        about to expire is replaced.
+        """
+        s3_conn = None
+        with self._idle_conns_lock:
+            while self._idle_conns and s3_conn is None:
+                s3_conn = self._idle_conns.pop()
+                if self._credentials_expiring(s3_conn):
+                    s3_conn = None
+        if s3_conn is None:
+            s3_conn = self.connect_s3()
+        yield s3_conn
+        # Not reached if the worker raised: like disconnect(), that
+        # drops a connection that may be broken.
+        with self._idle_conns_lock:
+            self._idle_conns.append(s3_conn)
+
+    def disconnect(self):
+        self.s3_conn = None
+        self.bucket_cache = None
+        self.uri_checked = False
+        with self._idle_conns_lock:
+            self._idle_conns = []
+        with self._idle_clones_lock:
+            self._idle_clones = []
+
     def _get_bucket(self, bucket_name):
         logging.debug('s3_uploader.S3Uploader._get_bucket: %s',
                       bucket_name)
@@ -232,8 +611,11 @@ class S3Uploader(BaseUploader):
         """
         Attempts to connect to S3 using our upload_uri.
 
-        Returns a string if any error occurred.
+        Returns a string if any error occurred. Once the URI has checked
+        out, it isn't checked again until disconnect().
         """
+        if self.uri_checked:
+            return
         try:
             logfile_uri = get_logfile_uri(self.upload_uri,
                                           parse.SAMPLE_LOGFILE)
@@ -243,15 +625,21 @@ class S3Uploader(BaseUploader):
         u = boto.storage_uri(logfile_uri)
 
         try:
-            self.s3_conn.get_bucket(u.bucket_name)
+            self.bucket_cache[u.bucket_name] = self.s3_conn.get_bucket(
+                u.bucket_name)
         except boto.exception.S3ResponseError:
             return 'Failed to find bucket {}'.format(u.bucket_name)
+        self.uri_checked = True
 
     def scan_remote(self, logfiles):
         """
         Takes a list of LogFile's. Returns back as two lists of
         LogFiles: those that have been uploaded already, and those that
         have not.
+
+        With a manifest, only the parent directories it hasn't listed
+        within reconcile_interval seconds are listed; the uploads in the
+        rest are taken from the manifest.
         """
 
         uploaded_set = set()
@@ -259,24 +647,109 @@ class S3Uploader(BaseUploader):
             (get_logfile_uri(self.upload_uri, logfile), logfile)
             for logfile in logfiles
         )
+        uris_by_parent = collections.defaultdict(set)
+        for logfile_uri in logfile_uris:
+            uris_by_parent[logfile_uri.rsplit('/', 1)[0] + '/'].add(
+                logfile_uri)
 
-        parent_dir_uris = get_parent_dir_uris(logfile_uris)
-        for uri in parent_dir_uris:
+        parent_dir_uris = set(uris_by_parent)
+        if self.manifest is not None:
+            listed_uris = self.manifest.get_listed(
+                parent_dir_uris, self.reconcile_interval)
+            known_uris = set()
+            for uri in listed_uris:
+                known_uris.update(uris_by_parent[uri])
+            uploaded_set.update(
+                logfile_uris[logfile_uri]
+                for logfile_uri in self.manifest.get_uploaded(known_uris)
+            )
+            parent_dir_uris -= listed_uris
+            logging.debug(
+                'S3Uploader.scan_remote: %d of %d directories known from '
+                'manifest', len(listed_uris), len(uris_by_parent))
+
+        main_thread = threading.current_thread()
+
+        def _list_dir(uri):
+            if threading.current_thread() is main_thread:
+                return _list_dir_with(
+                    self._get_bucket(boto.storage_uri(uri).bucket_name), uri)
+            with self.worker_connection() as s3_conn:
+                return _list_dir_with(s3_conn.get_bucket(
+                    boto.storage_uri(uri).bucket_name, validate=False), uri)
+
+        def _list_dir_with(bucket, uri):
             u = boto.storage_uri(uri)
-            bucket = self._get_bucket(u.bucket_name)
-            logging.debug('S3Uploader.scan_remote: listing %r', uri)
-            for key in bucket.list(prefix=u.object_name):
-                logfile_uri = str(self.storage_uri_for_key(key))
-                logging.debug('found %r', logfile_uri)
-                logfile = logfile_uris.get(logfile_uri)
+            object_names = set(
+                boto.storage_uri(logfile_uri).object_name
+                for logfile_uri in uris_by_parent[uri]
+            )
+            found_uris, fetched = self._list_object_names(
+                bucket, u.object_name, object_names)
+            if self.manifest is not None:
+                self.manifest.set_listing(
+                    uri, found_uris, uris_by_parent[uri] - found_uris)
+            return found_uris, fetched
+
+        parent_dir_uris = sorted(parent_dir_uris)
+        if self.list_concurrency > 1 and len(parent_dir_uris) > 1:
+            pool = multiprocessing.pool.ThreadPool(
+                min(self.list_concurrency, len(parent_dir_uris)))
+            try:
+                results = pool.map(_list_dir, parent_dir_uris, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_list_dir, parent_dir_uris)
+
+        fetched = matched = 0
+        for found_uris, dir_fetched in results:
+            for uri in found_uris:
+                logfile = logfile_uris.get(uri)
                 if logfile is not None:
-                    logging.debug('added to uploaded_set')
                     uploaded_set.add(logfile)
+                    matched += 1
+            fetched += dir_fetched
+        if parent_dir_uris:
+            logging.info(
+                'S3Uploader.scan_remote: listed %d directories, fetching '
+                '%d keys to match %d logfiles',
+                len(parent_dir_uris), fetched, matched)
 
         not_uploaded_set = set(logfiles) - uploaded_set
 
         return uploaded_set, not_uploaded_set
 
+    def _list_object_names(self, bucket, dir_name, object_names):
+        """
+        Lists which of object_names, all within the directory dir_name,
+        are in bucket. Returns their URIs as a set, along with the
+        number of keys fetched to find them.
+
+        The listing is narrowed to the common prefix of object_names,
+        starts just before the first of them, and stops after the last.
+        """
+        prefix = os.path.commonprefix(list(object_names))
+        if not prefix.startswith(dir_name):
+            prefix = dir_name
+        first, last = min(object_names), max(object_names)
+        logging.debug(
+            'S3Uploader.scan_remote: listing %r from %r', prefix, first)
+
+        found_uris = set()
+        fetched = 0
+        for key in bucket.list(prefix=prefix, marker=first[:-1]):
+            fetched += 1
+            if key.name > last:
+                break
+            if key.name not in object_names:
+                continue  # someone else's
+            logfile_uri = str(self.storage_uri_for_key(key))
+            logging.debug('found %r', logfile_uri)
+            found_uris.add(logfile_uri)
+        return found_uris, fetched
+
     def upload_logfile(self, log_archive_dir, logfile):
         """
         Takes the path to the log archive directory and a LogFile
@@ -287,16 +760,269 @@ class S3Uploader(BaseUploader):
         logfile_uri = get_logfile_uri(self.upload_uri, logfile)
         u = boto.storage_uri(logfile_uri)
         bucket = self._get_bucket(u.bucket_name)
-        key = bucket.get_key(u.object_name)
-        if key is not None:
+        if not self.trust_scan:
+            key = bucket.get_key(u.object_name)
+            if key is not None:
+                logging.warning(
+                    'S3Uploader.upload_logfile: %s already uploaded',
+                    logfile_uri)
+                if self.manifest is not None:
+                    self.manifest.add_uploaded([logfile_uri])
+                return
+        path = os.path.join(log_archive_dir, logfile.filename)
+        checksum = self._get_checksum(log_archive_dir, path)
+        if self._wants_multipart(path):
+            error = self._upload_multipart(
+                bucket, u.object_name, path,
+                self._get_multipart_state(log_archive_dir),
+                checksum=checksum
+            )
+        else:
+            key = bucket.new_key(u.object_name)
+            md5 = None
+            if checksum is not None:
+                md5 = _md5_arg(checksum.md5)
+            headers = None
+            if self.trust_scan:
+                # Rather than check first, have S3 refuse to overwrite.
+                headers = {'If-None-Match': '*'}
+            try:
+                if self.rate_limiter is None:
+                    key.set_contents_from_filename(
+                        path, headers=headers, md5=md5)
+                else:
+                    with open(path, 'rb') as f:
+                        f, md5 = _throttle(f, self.rate_limiter, md5)
+                        key.set_contents_from_file(
+                            f, headers=headers, md5=md5)
+                error = None
+            except boto.exception.BotoServerError, e:
+                error = e
+                if self.trust_scan and e.status == 412:
+                    logging.warning(
+                        'S3Uploader.upload_logfile: %s already uploaded',
+                        logfile_uri)
+                    error = None
+
+        if error is None:
+            if checksum is not None:
+                self.checksums.delete(logfile.filename)
+            if self.manifest is not None:
+                self.manifest.add_uploaded([logfile_uri])
+        return error
+
+    def open_stream(self, logfile):
+        """
+        Takes a LogFile that has yet to be written. Returns a
+        StreamUpload to write its contents to.
+        """
+        logfile_uri = get_logfile_uri(self.upload_uri, logfile)
+        u = boto.storage_uri(logfile_uri)
+        return StreamUpload(
+            self, self._get_bucket(u.bucket_name), u.object_name)
+
+    def _get_checksum(self, log_archive_dir, path):
+        """
+        Returns the state.Checksum logjam-compress stored for the file
+        at path, or None if there is none or the file has since changed.
+        """
+        if self.checksums is None:
+            if not os.path.exists(state.store_path(log_archive_dir)):
+                return
+            self.checksums = state.ChecksumStore(
+                state.open_store(log_archive_dir))
+
+        checksum = self.checksums.get(os.path.basename(path))
+        if checksum is None:
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        if (st.st_size, st.st_mtime) != (checksum.size, checksum.mtime):
             logging.warning(
-                'S3Uploader.upload_logfile: %s already uploaded',
-                logfile_uri)
+                'S3Uploader._get_checksum: ignoring stale checksum of %s',
+                path)
             return
-        key = bucket.new_key(u.object_name)
+        return checksum
+
+    def _wants_multipart(self, path):
+        if self.multipart_threshold is None:
+            return False
+        try:
+            return os.path.getsize(path) >= self.multipart_threshold
+        except OSError:
+            return False  # let the single PUT report the error
+
+    def _get_multipart_state(self, log_archive_dir):
+        if self.multipart_state is None:
+            self.multipart_state = state.MultipartState(
+                state.open_store(log_archive_dir))
+        return self.multipart_state
+
+    def _list_parts(self, mp):
+        """
+        Returns the {part_num: etag} of the parts S3 has for a multipart
+        upload, or None if S3 no longer knows of the upload.
+        """
         try:
-            key.set_contents_from_filename(
-                os.path.join(log_archive_dir, logfile.filename)
+            return dict(
+                (part.part_number, part.etag.strip('"')) for part in mp
             )
-        except boto.exception.BotoServerError, e:
+        except boto.exception.S3ResponseError, e:
+            if e.status == 404:
+                return
+            raise
+
+    def _cancel_stale_uploads(self, bucket, key_name):
+        """
+        Cancels any multipart uploads to key_name that S3 still has, such
+        as those whose local state was lost.
+        """
+        for mp in bucket.get_all_multipart_uploads(prefix=key_name):
+            if mp.key_name != key_name:
+                continue
+            logging.warning(
+                'S3Uploader._cancel_stale_uploads: cancelling %s for %s',
+                mp.id, key_name)
+            mp.cancel_upload()
+
+    def _resume_or_initiate(self, bucket, key_name, st, mp_state):
+        """
+        Returns a (MultiPartUpload, part_size, {part_num: etag}) tuple
+        for an upload of a file with stat result st to key_name,
+        resuming the upload in mp_state if S3 still has it and the file
+        hasn't changed since it started.
+        """
+        record = mp_state.get(bucket.name, key_name)
+        if record is not None:
+            expired = (
+                mp_state.time_func() - record.initiated > MAX_MULTIPART_AGE)
+            changed = (record.file_size, record.file_mtime) != \
+                (st.st_size, st.st_mtime)
+            if not expired and not changed:
+                mp = self.bind_multipart_upload(
+                    bucket, key_name, record.upload_id)
+                remote_etags = self._list_parts(mp)
+                if remote_etags is not None:
+                    etags = dict(
+                        (part_num, etag)
+                        for part_num, etag in record.etags.iteritems()
+                        if remote_etags.get(part_num) == etag
+                    )
+                    logging.info(
+                        'S3Uploader._resume_or_initiate: resuming %s for '
+                        '%s with %d parts done',
+                        record.upload_id, key_name, len(etags))
+                    return mp, record.part_size, etags
+            logging.warning(
+                'S3Uploader._resume_or_initiate: discarding %s for %s',
+                record.upload_id, key_name)
+            mp_state.finish(bucket.name, key_name)
+
+        self._cancel_stale_uploads(bucket, key_name)
+        mp = bucket.initiate_multipart_upload(key_name)
+        mp_state.start(
+            bucket.name, key_name, mp.id, self.part_size, st.st_size,
+            st.st_mtime)
+        return mp, self.part_size, {}
+
+    def _upload_multipart(self, bucket, key_name, path, mp_state,
+                          checksum=None):
+        """
+        Uploads the file at path to key_name as a multipart upload,
+        sending parts in parallel, each sending thread over its own
+        connection.
+
+        Progress is recorded in mp_state, so that if a part fails, or
+        we're killed, the next call resumes the upload from its last
+        completed part. Uploads that fail unexpectedly are cancelled, so
+        that S3 doesn't keep (and bill for) their orphaned parts.
+
+        If checksum (a state.Checksum) has part MD5s for our part size,
+        they're sent with each part instead of being computed.
+
+        Returns an error, if any.
+        """
+        try:
+            st = os.stat(path)
+            mp, part_size, etags = self._resume_or_initiate(
+                bucket, key_name, st, mp_state)
+        except (boto.exception.BotoServerError, EnvironmentError), e:
             return e
+        all_parts = get_parts(st.st_size, part_size)
+        part_md5s = {}
+        if (checksum is not None and checksum.part_size == part_size and
+                len(checksum.part_md5s) == len(all_parts)):
+            part_md5s = dict(enumerate(checksum.part_md5s, 1))
+        parts = [part for part in all_parts if part[0] not in etags]
+        logging.debug(
+            'S3Uploader._upload_multipart: %s in %d parts as %s',
+            path, len(parts), mp.id)
+
+        def _upload_part(part):
+            with self.worker_connection() as s3_conn:
+                _upload_part_with(
+                    self.bind_multipart_upload(
+                        s3_conn.get_bucket(bucket.name, validate=False),
+                        key_name,
+                        mp.id
+                    ),
+                    part
+                )
+
+        def _upload_part_with(part_mp, part):
+            part_num, offset, length = part
+            for attempt in range(1, PART_ATTEMPTS + 1):
+                try:
+                    with open(path, 'rb') as f:
+                        f.seek(offset)
+                        md5 = None
+                        if part_num in part_md5s:
+                            md5 = _md5_arg(part_md5s[part_num])
+                        f, md5 = _throttle(
+                            f, self.rate_limiter, md5, size=length)
+                        key = part_mp.upload_part_from_file(
+                            f, part_num, md5=md5, size=length)
+                    mp_state.add_part(mp.id, part_num, key.etag.strip('"'))
+                    return
+                except (boto.exception.BotoServerError,
+                        EnvironmentError), e:
+                    logging.warning(
+                        'S3Uploader._upload_multipart: part %d of %s '
+                        'failed (attempt %d of %d): %s',
+                        part_num, path, attempt, PART_ATTEMPTS, e)
+                    if attempt == PART_ATTEMPTS:
+                        raise
+
+        pool = multiprocessing.pool.ThreadPool(
+            max(1, min(self.part_concurrency, len(parts))))
+        try:
+            pool.map(_upload_part, parts, chunksize=1)
+            mp.complete_upload()
+        except (boto.exception.BotoServerError, EnvironmentError), e:
+            if getattr(e, 'status', None) == 404:
+                # S3 no longer has the upload; start afresh next time.
+                mp_state.finish(bucket.name, key_name)
+            logging.error(
+                'S3Uploader._upload_multipart: %s for %s failed, will '
+                'resume: %s', mp.id, path, e)
+            return e
+        except Exception:
+            exc_info = sys.exc_info()
+            logging.error(
+                'S3Uploader._upload_multipart: cancelling %s for %s',
+                mp.id, path)
+            try:
+                mp.cancel_upload()
+                mp_state.finish(bucket.name, key_name)
+            except boto.exception.BotoServerError, cancel_e:
+                logging.error(
+                    'S3Uploader._upload_multipart: failed to cancel %s: '
+                    '%s', mp.id, cancel_e)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            pool.close()
+            pool.join()
+
+        mp_state.finish(bucket.name, key_name)
@@ -0,0 +1,94 @@
+"""
+Ordering the logfiles waiting to be uploaded.
+"""
+
+import calendar
+import os
+import os.path
+
+# Policies by which to order uploads:
+#
+#   - newest: newest first, for freshness,
+#   - oldest: oldest first, so that what's been waiting longest (and is
+#     likeliest to be pruned) goes first,
+#   - smallest: smallest first, to upload the most logfiles soonest.
+POLICIES = ('newest', 'oldest', 'smallest')
+
+
+def _get_size(log_archive_dir, logfile):
+    try:
+        return os.path.getsize(
+            os.path.join(log_archive_dir, logfile.filename))
+    except OSError:
+        return 0
+
+
+def get_sort_key(policy, log_archive_dir):
+    """
+    Returns a function giving the sort key of a LogFile under a policy.
+    """
+    if policy == 'newest':
+        return lambda lf: (
+            -calendar.timegm(lf.timestamp.utctimetuple()), lf.filename)
+    if policy == 'oldest':
+        return lambda lf: (lf.timestamp, lf.filename)
+    if policy == 'smallest':
+        return lambda lf: (_get_size(log_archive_dir, lf), lf.filename)
+    raise ValueError('Unknown upload order {!r}'.format(policy))
+
+
+class Scheduler(object):
+    def __init__(self, default_policy='oldest', policies_by_prefix=None):
+        """
+        Orders logfiles by default_policy, or by the policy in the dict
+        policies_by_prefix for their prefix.
+        """
+        for policy in [default_policy] + (policies_by_prefix or {}).values():
+            get_sort_key(policy, None)  # raises ValueError if unknown
+        self.default_policy = default_policy
+        self.policies_by_prefix = policies_by_prefix or {}
+
+    def get_policy(self, prefix):
+        return self.policies_by_prefix.get(prefix, self.default_policy)
+
+    def order(self, log_archive_dir, logfiles):
+        """
+        Returns a list of logfiles in the order to upload them.
+
+        When all their prefixes share a policy, logfiles are sorted by
+        it. Otherwise each prefix's logfiles are sorted by its own
+        policy, and the prefixes take turns.
+        """
+        by_prefix = {}
+        for logfile in logfiles:
+            by_prefix.setdefault(logfile.prefix, []).append(logfile)
+
+        policies = set(self.get_policy(prefix) for prefix in by_prefix)
+        if len(policies) <= 1:
+            key = get_sort_key(
+                policies.pop() if policies else self.default_policy,
+                log_archive_dir)
+            return sorted(logfiles, key=key)
+
+        queues = []
+        for prefix in sorted(by_prefix):
+            key = get_sort_key(self.get_policy(prefix), log_archive_dir)
+            queues.append(sorted(by_prefix[prefix], key=key))
+
+        ordered = []
+        for i in range(max(len(queue) for queue in queues)):
+            ordered.extend(queue[i] for queue in queues if i < len(queue))
+        return ordered
+
+
+def parse_prefix_policy(arg):
+    """
+    Parses a PREFIX=POLICY command line argument into a tuple.
+    Raises ValueError if it's invalid.
+    """
+    prefix, sep, policy = arg.partition('=')
+    if not sep or not prefix or policy not in POLICIES:
+        raise ValueError(
+            'expected PREFIX=POLICY, where POLICY is one of {}'.format(
+                ', '.join(POLICIES)))
+    return prefix, policy
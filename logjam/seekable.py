@@ -0,0 +1,197 @@
+"""
+Seekable, block-compressed archives.
+
+A BlockEngine compresses a logfile as a series of independently
+compressed blocks (BGZF-style gzip members), each starting on a line
+boundary, and writes a sidecar index next to the archive. The index maps
+the first timestamp found in each block, and the block's uncompressed
+offset, to its compressed offset, so that a time window can be read
+without decompressing the archive from byte zero.
+
+The sidecar is named after its archive, e.g.
+haproxy-20130727T1400Z.log.gz.idx, so logjam-upload uploads it into the
+same place as the archive.
+"""
+
+import bisect
+import json
+import re
+import zlib
+
+#
+# Globals
+#
+
+INDEX_EXTENSION = '.idx'
+INDEX_VERSION = 1
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+# Matches timestamps like 2013-07-27T14:37:00 or 2013-07-27 14:37:00.
+DEFAULT_TIMESTAMP_PATTERN = (
+    r'(?P<year>\d{4})-(?P<month>\d\d)-(?P<day>\d\d)[T ]'
+    r'(?P<hour>\d\d):(?P<minute>\d\d):(?P<second>\d\d)'
+)
+
+TIMESTAMP_FIELDS = ('year', 'month', 'day', 'hour', 'minute', 'second')
+TIMESTAMP_FORMAT = '{year}-{month}-{day}T{hour}:{minute}:{second}'
+
+
+#
+# Writing
+#
+
+class BlockEngine(object):
+    """
+    An engine for compress.compress_path() that writes seekable
+    archives. Returns the sidecar index as {INDEX_EXTENSION: contents}.
+
+    timestamp_pattern must have the named groups in TIMESTAMP_FIELDS.
+    """
+
+    def __init__(self, compressobj_factory, block_size=DEFAULT_BLOCK_SIZE,
+                 timestamp_pattern=DEFAULT_TIMESTAMP_PATTERN):
+        self.compressobj_factory = compressobj_factory
+        self.block_size = block_size
+        self.timestamp_re = re.compile(timestamp_pattern)
+        missing = set(TIMESTAMP_FIELDS) - set(self.timestamp_re.groupindex)
+        if missing:
+            raise ValueError(
+                'timestamp_pattern lacks groups: {}'.format(
+                    ', '.join(sorted(missing))))
+
+    def first_timestamp(self, data):
+        """
+        Returns the first timestamp in data, as an ISO8601 string that
+        sorts lexically, or None.
+        """
+        match = self.timestamp_re.search(data)
+        if match is None:
+            return
+        return TIMESTAMP_FORMAT.format(**match.groupdict())
+
+    def _compress(self, data):
+        compressobj = self.compressobj_factory()
+        return compressobj.compress(data) + compressobj.flush()
+
+    def __call__(self, src_path, dst_file):
+        blocks = []
+        compressed_offset = 0
+        uncompressed_offset = 0
+        with open(src_path, 'rb') as src:
+            while True:
+                data = src.read(self.block_size)
+                if not data:
+                    break
+                if not data.endswith('\n'):
+                    data += src.readline()
+
+                compressed = self._compress(data)
+                dst_file.write(compressed)
+                blocks.append([
+                    compressed_offset,
+                    uncompressed_offset,
+                    self.first_timestamp(data),
+                ])
+                compressed_offset += len(compressed)
+                uncompressed_offset += len(data)
+
+        if not blocks:
+            # An empty archive still needs to be a valid one.
+            dst_file.write(self._compress(''))
+
+        index = {
+            'version': INDEX_VERSION,
+            'block_size': self.block_size,
+            'blocks': blocks,
+        }
+        return {INDEX_EXTENSION: json.dumps(index)}
+
+
+#
+# Reading
+#
+
+def load_index(f):
+    """ Takes a file object for a sidecar index. Returns the index. """
+    index = json.load(f)
+    if index.get('version') != INDEX_VERSION:
+        raise ValueError(
+            'Unsupported index version {!r}'.format(index.get('version')))
+    return index
+
+
+def select_blocks(index, start, end):
+    """
+    Takes an index and a [start, end) window of ISO8601 timestamp
+    strings. Returns the (first, last) indices of the blocks that may
+    hold lines in that window, or None if none can.
+
+    Blocks without a timestamp inherit the one of the block before.
+    """
+    blocks = index['blocks']
+    if not blocks:
+        return
+
+    timestamps = []
+    previous = ''
+    for _, _, timestamp in blocks:
+        previous = timestamp or previous
+        timestamps.append(previous)
+
+    # The window may start midway through the last block that starts
+    # at or before it...
+    first = max(bisect.bisect_right(timestamps, start) - 1, 0)
+    # ... and ends before the first block that starts at or after end.
+    last = bisect.bisect_left(timestamps, end) - 1
+    if last < first:
+        return
+    return first, last
+
+
+def read_blocks(archive_file, index, first, last,
+                decompressobj_factory=None):
+    """
+    Takes a seekable archive file object, its index, and a range of
+    block indices. Yields the decompressed contents of each block.
+    """
+    if decompressobj_factory is None:
+        decompressobj_factory = lambda: zlib.decompressobj(
+            16 + zlib.MAX_WBITS)
+
+    blocks = index['blocks']
+    for i in range(first, last + 1):
+        start = blocks[i][0]
+        archive_file.seek(start)
+        if i + 1 < len(blocks):
+            data = archive_file.read(blocks[i + 1][0] - start)
+        else:
+            data = archive_file.read()
+        decompressobj = decompressobj_factory()
+        yield decompressobj.decompress(data) + decompressobj.flush()
+
+
+def read_window(archive_file, index, start, end, timestamp_re=None):
+    """
+    Yields the lines of a seekable archive whose timestamps fall within
+    [start, end), decompressing only the blocks that may hold them.
+    Lines without a timestamp are yielded along with the line before.
+    """
+    if timestamp_re is None:
+        timestamp_re = re.compile(DEFAULT_TIMESTAMP_PATTERN)
+
+    selected = select_blocks(index, start, end)
+    if selected is None:
+        return
+
+    in_window = False
+    for data in read_blocks(archive_file, index, *selected):
+        for line in data.splitlines(True):
+            match = timestamp_re.search(line)
+            if match is not None:
+                timestamp = TIMESTAMP_FORMAT.format(**match.groupdict())
+                if timestamp >= end:
+                    return
+                in_window = timestamp >= start
+            if in_window:
+                yield line
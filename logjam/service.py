@@ -11,7 +11,9 @@ except ImportError:
     raven = None
 
 MIN_SLEEP_TIME = 1
+MIN_CHANGE_INTERVAL = 0.25
 DEFAULT_INTERVAL = 60
+DEFAULT_RESCAN_INTERVAL = 300
 
 
 def configure_logging(log_level):
@@ -86,3 +88,38 @@ def do_forever(do_func, interval_secs, *args, **kwargs):
             logging.debug(
                 'service.do_forever: sleeping %.2f', sleep_time)
             time.sleep(sleep_time)
+
+
+def do_on_change(do_func, wait_for_change, interval_secs, *args,
+                 **kwargs):
+    """
+    Calls do_func(*args, **kwargs) whenever wait_for_change(timeout)
+    returns True, and at least every interval_secs regardless.
+
+    wait_for_change() is usually the wait() method of an
+    inotify.DirectoryWatcher, and must return False if nothing changed
+    within timeout seconds.
+
+    As in do_forever(), exceptions are reported to sentry if possible.
+    Bursts of changes are coalesced so that do_func() runs at most once
+    every MIN_CHANGE_INTERVAL seconds.
+    """
+
+    with sentry_context({'logjam': do_func.__name__}):
+        while True:
+            start = time.time()
+            do_func(*args, **kwargs)
+
+            deadline = start + interval_secs
+            while True:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    logging.debug('service.do_on_change: rescanning')
+                    break
+                if wait_for_change(timeout):
+                    sleep_time = MIN_CHANGE_INTERVAL - (time.time() - start)
+                    if sleep_time > 0:
+                        time.sleep(sleep_time)
+                    # Consume whatever else changed while we slept.
+                    wait_for_change(0)
+                    break
@@ -0,0 +1,330 @@
+"""
+Streaming compression straight into S3 (multipart) uploads
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import datetime
+import logging
+import os
+import os.path
+import tempfile
+
+from . import compress
+from . import parse
+from . import service
+from . import state
+from . import throttle
+from . import upload
+
+
+COMMAND_DESCRIPTION = """
+Takes a directory of ISO8601 logfiles and a URL to upload them to.
+Compresses each superseded logfile straight into an upload to that URL,
+without writing the compressed file to disk first.
+
+Sample usage:
+
+    logjam-ship /var/log/hourly/ \
+    s3://my-log-bucket/{prefix}/{year}/{month}/{day}/{filename}
+
+Shipped logfiles are recorded in archive/.logjam/state.db, so that
+logjam-upload knows not to upload them again.
+
+"""[1:]
+
+
+#
+# Helpers
+#
+
+class _TeeWriter(object):
+    """ Writes everything written to it to each of a list of files. """
+
+    def __init__(self, *files):
+        self.files = files
+
+    def write(self, data):
+        for f in self.files:
+            f.write(data)
+
+
+#
+# Core functions
+#
+
+def ship_path(path, compress_cmd_args, compress_extension, uploader,
+              journal, archive_dir=None):
+    """
+    Compresses the logfile at path into an upload opened by
+    uploader.open_stream(), then deletes it. Records the upload in
+    journal (a state.UploadJournal).
+
+    compress_cmd_args is as for compress.compress_path(). If archive_dir
+    is given, a compressed copy of the logfile is kept there too.
+
+    Returns the filename of the compressed logfile, or None on failure.
+    """
+    log_dir = os.path.dirname(path)
+    filename = os.path.basename(path) + compress_extension
+    if journal.get_uploaded([filename]):
+        logging.warning(
+            'ship.ship_path: %s already shipped. Deleting %s.',
+            filename, path)
+        os.unlink(path)
+        return filename
+
+    logfile = parse.parse_filename(filename)
+    if callable(compress_cmd_args):
+        engine = compress_cmd_args
+    else:
+        engine = compress.CommandEngine(compress_cmd_args)
+
+    stream = uploader.open_stream(logfile)
+    local_f = None
+    try:
+        dst_file = stream
+        if archive_dir is not None:
+            local_f = tempfile.NamedTemporaryFile(
+                'wb', dir=log_dir, prefix=os.path.basename(path) + '.',
+                delete=False)
+            dst_file = _TeeWriter(stream, local_f)
+
+        try:
+            engine(path, dst_file)
+            if local_f is not None:
+                local_f.close()
+        except (compress.CompressError, EnvironmentError), e:
+            logging.error('ship.ship_path: ship %s failed: %s', path, e)
+            stream.cancel()
+            return
+
+        error = stream.close()
+        if error:
+            logging.error(
+                'ship.ship_path: upload of %s failed: %s', path, error)
+            return
+
+        if local_f is not None:
+            filename = os.path.basename(compress.archive_path(
+                path, local_f.name, compress_extension, archive_dir))
+        else:
+            os.unlink(path)
+        journal.add([filename])
+        logging.info('ship.ship_path: shipped %s', filename)
+
+    finally:
+        if local_f is not None:
+            local_f.close()
+            if os.path.isfile(local_f.name):
+                os.unlink(local_f.name)
+
+    return filename
+
+
+class ShipService(object):
+    def __init__(self, log_dir, log_upload_uri, compress_cmd_args,
+                 compress_extension, keep=False, uploader=None,
+                 journal=None, uploader_kwargs=None):
+        """
+        Args:
+            log_dir: path to a directory of logfiles,
+            log_upload_uri: an upload URI,
+            compress_cmd_args: as for compress.compress_path(),
+            compress_extension: the extension of compressed logfiles,
+            keep: (optional) if set, keep a compressed copy of each
+                logfile in log_dir/archive, as logjam-compress would.
+            uploader: (optional) uploader instance. Generally used for
+                injecting an uploader when testing.
+            journal: (optional) state.UploadJournal of shipped
+                logfiles. Defaults to that of log_dir/archive.
+            uploader_kwargs: (optional) dict of keyword arguments for
+                the uploader found by upload.get_uploader().
+        """
+        self.log_dir = log_dir
+        self.archive_dir = os.path.join(log_dir, 'archive')
+        if not os.path.isdir(self.archive_dir):
+            os.mkdir(self.archive_dir)
+        self.log_upload_uri = log_upload_uri
+        self.compress_cmd_args = compress_cmd_args
+        self.compress_extension = compress_extension
+        self.keep = keep
+        self.uploader = uploader
+        if journal is None:
+            journal = state.UploadJournal(state.open_store(self.archive_dir))
+        self.journal = journal
+        self.uploader_kwargs = uploader_kwargs or {}
+
+    def run(self):
+        """
+        Ships every superseded logfile in log_dir. Returns the list of
+        shipped filenames.
+        """
+        if self.uploader is None:
+            self.uploader = upload.get_uploader(
+                self.log_upload_uri, **self.uploader_kwargs)
+        uploader = self.uploader
+        uploader.connect()
+        error = uploader.check_uri()
+        if error:
+            logging.error(
+                'Invalid upload_uri %s: %s', self.log_upload_uri, error
+            )
+            raise Exception('Invalid upload_uri %s: %s' % (
+                self.log_upload_uri, error
+            ))
+
+        archive_dir = self.archive_dir if self.keep else None
+        shipped = []
+        failed = False
+        for logfile in compress.yield_old_logfiles(
+                os.listdir(self.log_dir), datetime.datetime.utcnow()):
+            filename = ship_path(
+                os.path.join(self.log_dir, logfile.filename),
+                self.compress_cmd_args,
+                self.compress_extension,
+                uploader,
+                self.journal,
+                archive_dir=archive_dir
+            )
+            if filename is not None:
+                shipped.append(filename)
+            else:
+                failed = True
+        # Reconnect, and check the URI again, on the next run.
+        if failed:
+            uploader.disconnect()
+        return shipped
+
+
+#
+# CLI functions
+#
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description=COMMAND_DESCRIPTION,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        'log_dir',
+        help='Directory in which to scan for hourly log files',
+    )
+    parser.add_argument(
+        'log_upload_uri',
+        help=(
+            'Upload URI. Must contain {prefix}, {year}, {month}, '
+            '{day}, and {filename}.'
+        )
+    )
+    parser.add_argument(
+        '--once',
+        action='store_true',
+        help=(
+            'Scan and ship directory once, then exit, instead of '
+            'running continuously.'
+        )
+    )
+    parser.add_argument(
+        '--keep',
+        action='store_true',
+        help=(
+            'Also keep a compressed copy of each logfile in '
+            'log_dir/archive.'
+        )
+    )
+    parser.add_argument(
+        '--engine',
+        choices=compress.ENGINES,
+        default='stream',
+        help=(
+            'How to compress: "stream" compresses in-process, '
+            '"subprocess" runs an external command. Defaults to stream.'
+        )
+    )
+    parser.add_argument(
+        '--codec',
+        choices=compress.CODEC_NAMES,
+        default='gzip',
+        help='Compression codec to use. Defaults to gzip.'
+    )
+    parser.add_argument(
+        '--level',
+        type=int,
+        help='Compression level. Defaults to the codec\'s own default.'
+    )
+    parser.add_argument(
+        '--part-size',
+        type=int,
+        metavar='MB',
+        help='Size of each part of an upload. Defaults to 16.'
+    )
+    parser.add_argument(
+        '--part-concurrency',
+        type=int,
+        metavar='N',
+        help='Send up to N parts of an upload at once. Defaults to 4.'
+    )
+    parser.add_argument(
+        '--bandwidth-limit',
+        type=int,
+        metavar='KB',
+        help='Upload at most KB kilobytes per second.'
+    )
+    parser.add_argument(
+        '--log-level', '-l',
+        choices=('debug', 'info', 'warning', 'error', 'critical'),
+        default='info',
+        help='Log level to use for logjam\'s own logging',
+    )
+    return parser
+
+
+def main():
+    parser = make_parser()
+    args = parser.parse_args()
+
+    service.configure_logging(args.log_level)
+
+    # Tune down boto logging
+    logging.getLogger('boto').setLevel(logging.WARNING)
+
+    uploader_kwargs = {}
+    if args.part_size is not None:
+        if args.part_size < 5:
+            parser.error('--part-size must be at least 5 (MB)')
+        uploader_kwargs['part_size'] = args.part_size * upload.MB
+    if args.part_concurrency is not None:
+        if args.part_concurrency < 1:
+            parser.error('--part-concurrency must be at least 1')
+        uploader_kwargs['part_concurrency'] = args.part_concurrency
+    if args.bandwidth_limit is not None:
+        if args.bandwidth_limit < 1:
+            parser.error('--bandwidth-limit must be at least 1 (KB)')
+        uploader_kwargs['rate_limiter'] = throttle.TokenBucket(
+            args.bandwidth_limit * 1024)
+
+    try:
+        compress_cmd_args, compress_extension = compress.make_compressor(
+            args.codec, args.level, args.engine)
+    except ValueError, e:
+        parser.error('--level: {}'.format(e))
+
+    ship_service = ShipService(
+        args.log_dir,
+        args.log_upload_uri,
+        compress_cmd_args,
+        compress_extension,
+        keep=args.keep,
+        uploader_kwargs=uploader_kwargs
+    )
+
+    if args.once:
+        service.do_once(ship_service.run)
+    else:
+        service.do_forever(ship_service.run, service.DEFAULT_INTERVAL)
+
+
+if __name__ == '__main__':
+    main()
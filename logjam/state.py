@@ -0,0 +1,593 @@
+"""
+Persistent state for logjam, kept in a sqlite database in the .logjam/
+directory of a log archive directory.
+"""
+
+import calendar
+import collections
+import contextlib
+import datetime
+import logging
+import os
+import os.path
+import shutil
+import sqlite3
+import threading
+import time
+
+from . import parse
+
+#
+# Globals
+#
+
+STATE_DIRNAME = '.logjam'
+STATE_FILENAME = 'state.db'
+
+# How long to wait on another process's lock on the database.
+LOCK_TIMEOUT = 30
+
+# A directory modified this recently may be modified again within the
+# resolution of its mtime, so its mtime can't be trusted yet.
+RACY_MTIME_SECS = 2
+
+STAGE_NEW = 'new'
+STAGE_UPLOADED = 'uploaded'
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS directories (
+        path TEXT PRIMARY KEY,
+        mtime REAL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS files (
+        dir TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        prefix TEXT,
+        timestamp INTEGER,
+        suffix TEXT,
+        extension TEXT,
+        stage TEXT NOT NULL,
+        PRIMARY KEY (dir, filename)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS multipart_uploads (
+        bucket TEXT NOT NULL,
+        key_name TEXT NOT NULL,
+        upload_id TEXT NOT NULL,
+        part_size INTEGER NOT NULL,
+        file_size INTEGER NOT NULL,
+        file_mtime REAL NOT NULL,
+        initiated REAL NOT NULL,
+        PRIMARY KEY (bucket, key_name)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS multipart_parts (
+        upload_id TEXT NOT NULL,
+        part_num INTEGER NOT NULL,
+        etag TEXT NOT NULL,
+        PRIMARY KEY (upload_id, part_num)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS checksums (
+        filename TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        md5 TEXT NOT NULL,
+        part_size INTEGER NOT NULL,
+        part_md5s TEXT NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS manifest_uploaded (
+        uri TEXT PRIMARY KEY
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS manifest_listed (
+        dir_uri TEXT PRIMARY KEY,
+        listed REAL NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS uploaded (
+        filename TEXT PRIMARY KEY,
+        uploaded REAL NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS bundled (
+        filename TEXT PRIMARY KEY,
+        bundle TEXT NOT NULL
+    )
+    ''',
+]
+
+# Stay well under sqlite's limit of 999 parameters per statement.
+MAX_PARAMS = 500
+
+
+#
+# The store
+#
+
+class StateStore(object):
+    def __init__(self, path):
+        """
+        Opens (creating, if need be) the sqlite database at path.
+        A StateStore may be shared between threads.
+        """
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(
+            path, timeout=LOCK_TIMEOUT, check_same_thread=False)
+        self.conn.text_factory = str
+        with self.transaction() as conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Context manager yielding the sqlite connection, committing on
+        success and rolling back on error.
+        """
+        with self.lock:
+            with self.conn:
+                yield self.conn
+
+    def query(self, sql, params=()):
+        """ Runs a SELECT, returning all rows. """
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def query_in(self, sql, values, params=()):
+        """
+        Runs a SELECT whose sql has one "IN ({})" clause, once for each
+        batch of values, returning all rows. params follow the values.
+        """
+        values = list(values)
+        rows = []
+        for i in range(0, len(values), MAX_PARAMS):
+            batch = values[i:i + MAX_PARAMS]
+            rows.extend(self.query(
+                sql.format(', '.join('?' * len(batch))),
+                tuple(batch) + tuple(params)
+            ))
+        return rows
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def get_archive_dir(dir_path):
+    """
+    Returns the log archive directory that dir_path belongs to: either
+    dir_path itself or, for a directory kept within an archive
+    directory's STATE_DIRNAME (like bundle.Bundler's), that archive
+    directory.
+    """
+    head = os.path.normpath(dir_path)
+    while True:
+        head, tail = os.path.split(head)
+        if tail == STATE_DIRNAME:
+            return head
+        if not tail:
+            return dir_path
+
+
+def store_path(archive_dir):
+    """ Returns the path of the StateStore of a log archive directory. """
+    return os.path.join(
+        get_archive_dir(archive_dir), STATE_DIRNAME, STATE_FILENAME)
+
+
+def open_store(archive_dir):
+    """ Returns the StateStore of a log archive directory. """
+    state_dir = os.path.join(get_archive_dir(archive_dir), STATE_DIRNAME)
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    return StateStore(store_path(archive_dir))
+
+
+#
+# Scan cache
+#
+
+def _to_epoch(timestamp):
+    return calendar.timegm(timestamp.utctimetuple())
+
+
+def _from_row(filename, prefix, epoch, suffix, extension):
+    if prefix is None:
+        return  # not a logfile
+    return parse.LogFile(
+        prefix,
+        datetime.datetime.utcfromtimestamp(epoch),
+        suffix,
+        extension,
+        filename
+    )
+
+
+class ScanCache(object):
+    """
+    Caches the parsed contents of directories, so that listing an
+    unchanged directory costs one stat(), and listing a changed one
+    only costs parsing the filenames that were added.
+
+    Each file also has a processing stage, STAGE_NEW until set
+    otherwise.
+    """
+
+    def __init__(self, store, stat=os.stat, listdir=os.listdir,
+                 time_func=time.time):
+        self.store = store
+        self.stat = stat
+        self.listdir = listdir
+        self.time_func = time_func
+
+        # {dir_path: [mtime, {filename: [LogFile or None, stage]}]}
+        self._dirs = {}
+
+    def _load(self, dir_path):
+        entry = self._dirs.get(dir_path)
+        if entry is not None:
+            return entry
+
+        rows = self.store.query(
+            'SELECT mtime FROM directories WHERE path = ?', (dir_path,))
+        mtime = rows[0][0] if rows else None
+        files = dict(
+            (filename, [_from_row(filename, *fields), stage])
+            for filename, stage, fields in (
+                (row[0], row[1], row[2:])
+                for row in self.store.query(
+                    'SELECT filename, stage, prefix, timestamp, suffix, '
+                    'extension FROM files WHERE dir = ?',
+                    (dir_path,)
+                )
+            )
+        )
+        entry = self._dirs[dir_path] = [mtime, files]
+        return entry
+
+    def _refresh(self, dir_path):
+        dir_path = os.path.abspath(dir_path)
+        entry = self._load(dir_path)
+        cached_mtime, files = entry
+
+        mtime = self.stat(dir_path).st_mtime
+        if cached_mtime is not None and mtime == cached_mtime:
+            return dir_path, files
+
+        filenames = set(self.listdir(dir_path))
+        added = filenames.difference(files)
+        removed = set(files).difference(filenames)
+        logging.debug(
+            'state.ScanCache: %s changed: %d added, %d removed',
+            dir_path, len(added), len(removed))
+
+        if self.time_func() - mtime < RACY_MTIME_SECS:
+            mtime = None
+
+        with self.store.transaction() as conn:
+            conn.executemany(
+                'DELETE FROM files WHERE dir = ? AND filename = ?',
+                [(dir_path, filename) for filename in removed]
+            )
+            rows = []
+            for filename in added:
+                logfile = parse.parse_filename(filename)
+                files[filename] = [logfile, STAGE_NEW]
+                if logfile is None:
+                    rows.append((
+                        dir_path, filename, None, None, None, None,
+                        STAGE_NEW
+                    ))
+                else:
+                    rows.append((
+                        dir_path, filename, logfile.prefix,
+                        _to_epoch(logfile.timestamp), logfile.suffix,
+                        logfile.extension, STAGE_NEW
+                    ))
+            conn.executemany(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                rows
+            )
+            conn.execute(
+                'INSERT OR REPLACE INTO directories VALUES (?, ?)',
+                (dir_path, mtime)
+            )
+
+        for filename in removed:
+            del files[filename]
+        entry[0] = mtime
+        return dir_path, files
+
+    def list_logfiles(self, dir_path, exclude_stage=None):
+        """
+        Returns a list of the LogFiles in dir_path, excluding those
+        whose stage is exclude_stage.
+        """
+        _, files = self._refresh(dir_path)
+        return [
+            logfile for logfile, stage in files.itervalues()
+            if logfile is not None and stage != exclude_stage
+        ]
+
+    def set_stage(self, dir_path, filenames, stage):
+        """ Sets the stage of the given files in dir_path. """
+        dir_path, files = self._refresh(dir_path)
+        filenames = [fn for fn in filenames if fn in files]
+        with self.store.transaction() as conn:
+            conn.executemany(
+                'UPDATE files SET stage = ? WHERE dir = ? AND filename = ?',
+                [(stage, dir_path, filename) for filename in filenames]
+            )
+        for filename in filenames:
+            files[filename][1] = stage
+
+
+#
+# Multipart uploads
+#
+
+MultipartUpload = collections.namedtuple(
+    'MultipartUpload',
+    'upload_id part_size file_size file_mtime initiated etags'
+)
+
+
+class MultipartState(object):
+    """
+    Remembers in-flight multipart uploads, and the ETags of their
+    completed parts, so that an upload interrupted by a restart can be
+    resumed rather than restarted.
+    """
+
+    def __init__(self, store, time_func=time.time):
+        self.store = store
+        self.time_func = time_func
+
+    def get(self, bucket, key_name):
+        """
+        Returns the MultipartUpload in flight to bucket/key_name, with
+        its etags as {part_num: etag}, or None.
+        """
+        rows = self.store.query(
+            'SELECT upload_id, part_size, file_size, file_mtime, initiated '
+            'FROM multipart_uploads WHERE bucket = ? AND key_name = ?',
+            (bucket, key_name)
+        )
+        if not rows:
+            return
+        upload_id = rows[0][0]
+        etags = dict(self.store.query(
+            'SELECT part_num, etag FROM multipart_parts WHERE upload_id = ?',
+            (upload_id,)
+        ))
+        return MultipartUpload(*(tuple(rows[0]) + (etags,)))
+
+    def start(self, bucket, key_name, upload_id, part_size, file_size,
+              file_mtime):
+        """ Records a newly initiated multipart upload. """
+        self.finish(bucket, key_name)
+        with self.store.transaction() as conn:
+            conn.execute(
+                'INSERT INTO multipart_uploads VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (bucket, key_name, upload_id, part_size, file_size,
+                 file_mtime, self.time_func())
+            )
+
+    def add_part(self, upload_id, part_num, etag):
+        """ Records a completed part of a multipart upload. """
+        with self.store.transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO multipart_parts VALUES (?, ?, ?)',
+                (upload_id, part_num, etag)
+            )
+
+    def finish(self, bucket, key_name):
+        """
+        Forgets the multipart upload to bucket/key_name, whether it was
+        completed or cancelled.
+        """
+        with self.store.transaction() as conn:
+            rows = conn.execute(
+                'SELECT upload_id FROM multipart_uploads '
+                'WHERE bucket = ? AND key_name = ?',
+                (bucket, key_name)
+            ).fetchall()
+            conn.executemany(
+                'DELETE FROM multipart_parts WHERE upload_id = ?', rows)
+            conn.execute(
+                'DELETE FROM multipart_uploads '
+                'WHERE bucket = ? AND key_name = ?',
+                (bucket, key_name)
+            )
+
+
+#
+# Checksums
+#
+
+# part_md5s is a list of the hex MD5s of each part_size part, from which
+# the ETag of a multipart upload of that part size can be derived.
+Checksum = collections.namedtuple(
+    'Checksum', 'size mtime md5 part_size part_md5s')
+
+
+class ChecksumStore(object):
+    """
+    Remembers the checksums of archived files, computed while they were
+    being written, so that they needn't be read again to compute them.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, filename):
+        """ Returns the Checksum of filename, or None. """
+        rows = self.store.query(
+            'SELECT size, mtime, md5, part_size, part_md5s FROM checksums '
+            'WHERE filename = ?',
+            (filename,)
+        )
+        if not rows:
+            return
+        size, mtime, md5, part_size, part_md5s = rows[0]
+        return Checksum(
+            size, mtime, md5, part_size,
+            part_md5s.split(',') if part_md5s else []
+        )
+
+    def put(self, filename, checksum):
+        with self.store.transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?)',
+                (filename, checksum.size, checksum.mtime, checksum.md5,
+                 checksum.part_size, ','.join(checksum.part_md5s))
+            )
+
+    def delete(self, filename):
+        with self.store.transaction() as conn:
+            conn.execute(
+                'DELETE FROM checksums WHERE filename = ?', (filename,))
+
+
+#
+# Manifest of uploads
+#
+
+class Manifest(object):
+    """
+    Remembers which upload URIs are known to have been uploaded, and
+    when each of their parent directory URIs was last listed.
+
+    Until a directory's listing is too old, the manifest is taken to
+    know of every upload in it, as long as whoever uploads into it
+    records their uploads with add_uploaded().
+    """
+
+    def __init__(self, store, time_func=time.time):
+        self.store = store
+        self.time_func = time_func
+
+    def get_listed(self, dir_uris, max_age):
+        """
+        Returns the set of dir_uris that were listed within the last
+        max_age seconds.
+        """
+        return set(row[0] for row in self.store.query_in(
+            'SELECT dir_uri FROM manifest_listed '
+            'WHERE dir_uri IN ({}) AND listed >= ?',
+            dir_uris,
+            (self.time_func() - max_age,)
+        ))
+
+    def get_uploaded(self, uris):
+        """ Returns the set of uris known to have been uploaded. """
+        return set(row[0] for row in self.store.query_in(
+            'SELECT uri FROM manifest_uploaded WHERE uri IN ({})', uris))
+
+    def add_uploaded(self, uris):
+        with self.store.transaction() as conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO manifest_uploaded VALUES (?)',
+                [(uri,) for uri in uris]
+            )
+
+    def set_listing(self, dir_uri, uploaded_uris, not_uploaded_uris):
+        """
+        Records a fresh listing of dir_uri, in which uploaded_uris were
+        found and not_uploaded_uris were not.
+        """
+        with self.store.transaction() as conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO manifest_uploaded VALUES (?)',
+                [(uri,) for uri in uploaded_uris]
+            )
+            conn.executemany(
+                'DELETE FROM manifest_uploaded WHERE uri = ?',
+                [(uri,) for uri in not_uploaded_uris]
+            )
+            conn.execute(
+                'INSERT OR REPLACE INTO manifest_listed VALUES (?, ?)',
+                (dir_uri, self.time_func())
+            )
+
+
+#
+# Journal of uploaded files
+#
+
+class UploadJournal(object):
+    """
+    Records which files of a log archive directory have been uploaded.
+    Replaces the .uploaded/ directory of empty marker files.
+    """
+
+    def __init__(self, store, time_func=time.time):
+        self.store = store
+        self.time_func = time_func
+
+    def get_uploaded(self, filenames):
+        """ Returns the set of filenames that have been uploaded. """
+        return set(row[0] for row in self.store.query_in(
+            'SELECT filename FROM uploaded WHERE filename IN ({})',
+            filenames
+        ))
+
+    def add(self, filenames):
+        """ Records filenames as uploaded, in a single transaction. """
+        now = self.time_func()
+        with self.store.transaction() as conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO uploaded VALUES (?, ?)',
+                [(filename, now) for filename in filenames]
+            )
+
+    def add_bundle(self, bundle, filenames):
+        """
+        Records filenames as uploaded inside the bundle of that
+        filename, in a single transaction.
+        """
+        now = self.time_func()
+        with self.store.transaction() as conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO uploaded VALUES (?, ?)',
+                [(filename, now) for filename in filenames]
+            )
+            conn.executemany(
+                'INSERT OR REPLACE INTO bundled VALUES (?, ?)',
+                [(filename, bundle) for filename in filenames]
+            )
+
+    def get_bundles(self, filenames):
+        """
+        Returns a dict of the bundle each of filenames was uploaded in,
+        for those that were.
+        """
+        return dict(self.store.query_in(
+            'SELECT filename, bundle FROM bundled WHERE filename IN ({})',
+            filenames
+        ))
+
+    def migrate_marker_dir(self, marker_dir):
+        """
+        Records the files marked in an old-style marker directory as
+        uploaded, then removes it.
+        """
+        filenames = os.listdir(marker_dir)
+        logging.info(
+            'state.UploadJournal: migrating %d markers from %s',
+            len(filenames), marker_dir)
+        self.add(filenames)
+        shutil.rmtree(marker_dir)
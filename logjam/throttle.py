@@ -0,0 +1,61 @@
+"""
+Limiting the bandwidth used by uploads.
+"""
+
+import threading
+import time
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None, time_func=time.time,
+                 sleep=time.sleep):
+        """
+        Limits a flow of bytes to rate bytes/sec on average, in bursts
+        of up to burst bytes (by default, a second's worth).
+
+        A TokenBucket may be shared between threads, which then share
+        its rate.
+        """
+        self.rate = float(rate)
+        self.burst = float(rate if burst is None else burst)
+        self.time_func = time_func
+        self.sleep = sleep
+        self.tokens = self.burst
+        self.updated = time_func()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        """
+        Takes n bytes' worth of tokens, sleeping until the bucket has
+        refilled enough to cover them if need be.
+        """
+        with self.lock:
+            now = self.time_func()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Going into debt lets a read larger than the burst through,
+            # and makes whoever comes next wait for it to be repaid.
+            self.tokens -= n
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            self.sleep(wait)
+
+
+class ThrottledFile(object):
+    """
+    Wraps a file object so that what's read from it is limited by a
+    TokenBucket. Everything but read() is passed through.
+    """
+
+    def __init__(self, f, bucket):
+        self.f = f
+        self.bucket = bucket
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.bucket.consume(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
@@ -3,13 +3,22 @@ Uploader
 """
 
 import argparse
+import itertools
 import logging
+import multiprocessing.pool
 import os
 import os.path
+import threading
 import urlparse
 
+from . import base_uploader
+from . import bundle
 from . import parse
+from . import retry
+from . import schedule
 from . import service
+from . import state
+from . import throttle
 
 
 COMMAND_DESCRIPTION = """
@@ -26,6 +35,11 @@ delete older logfiles that have already been uploaded.
 
 """[1:]
 
+MB = 1024 * 1024
+
+# Where uploaded logfiles were marked before state.UploadJournal.
+MARKER_DIRNAME = '.uploaded'
+
 
 #
 # Import helpers
@@ -46,10 +60,16 @@ def boto_exists():
 
 UPLOADERS = {}
 
+# Uploaders based on base_uploader.AsyncBaseUploader, used with
+# --async-io.
+ASYNC_UPLOADERS = {}
+
 if boto_exists():
+    from . import async_s3_uploader
     from . import s3_uploader
 
     UPLOADERS['s3'] = s3_uploader.S3Uploader
+    ASYNC_UPLOADERS['s3'] = async_s3_uploader.AsyncS3Uploader
 else:
     logging.info(
         'upload: failed to import boto. '
@@ -57,70 +77,261 @@ else:
     )
 
 
-def get_uploader(upload_uri, uploaders=UPLOADERS):
+def get_uploader(upload_uri, uploaders=UPLOADERS, **uploader_kwargs):
     u = urlparse.urlparse(upload_uri)
     if u.scheme not in uploaders:
         raise Exception(
             'No uploader found for URI scheme {}'.format(u.scheme)
         )
-    return uploaders[u.scheme](upload_uri)
+    return uploaders[u.scheme](upload_uri, **uploader_kwargs)
 
 
 #
 # Core functions
 #
 
-def scan_and_upload_filenames(log_archive_dir, filenames, uploader):
+def _upload_logfile(uploader, log_archive_dir, logfile, retry_policy=None,
+                    breaker=None, controller=None):
+    """
+    Uploads a logfile, returning the error, if any. Transient errors are
+    retried by retry_policy (a retry.RetryPolicy), if given.
+
+    If breaker (a retry.CircuitBreaker) is given, it's told how each
+    attempt went, and returns retry.CircuitOpenError without uploading
+    while it's open. If controller (a retry.AIMDController) is given,
+    each attempt waits for it to allow another in flight.
+    """
+    if breaker is not None and not breaker.allow():
+        return retry.CircuitOpenError('uploads paused by circuit breaker')
+
+    def _try_upload():
+        try:
+            return uploader.upload_logfile(log_archive_dir, logfile)
+        except EnvironmentError, e:
+            # boto raises socket errors, timeouts and the like, rather
+            # than returning them. Return them to be classified.
+            logging.warning(
+                'scan_and_upload: error uploading %s: %s',
+                logfile.filename, e)
+            return e
+
+    def _attempt():
+        if controller is None:
+            return _try_upload()
+        controller.acquire()
+        error_class = retry.FATAL
+        try:
+            error = _try_upload()
+            error_class = retry.classify(error)
+            return error
+        finally:
+            controller.release(error_class)
+
+    observe = breaker.record if breaker is not None else None
+    if retry_policy is not None:
+        return retry_policy.call(_attempt, observe=observe)
+    error = _attempt()
+    if observe is not None:
+        observe(retry.classify(error))
+    return error
+
+
+def _upload_concurrently(log_archive_dir, logfiles, uploader, concurrency,
+                         **kwargs):
+    """
+    Uploads logfiles across a pool of concurrency threads, each with its
+    own clone of uploader (and so its own connection). The clones are
+    given back to uploader afterwards, to be reused by the next call.
+    Returns a list of the errors (or None) of each logfile's upload, in
+    order.
+
+    kwargs are as for _upload_logfile().
+    """
+    local = threading.local()
+    clones = []
+
+    def _upload_logfile_in_thread(logfile):
+        try:
+            if getattr(local, 'uploader', None) is None:
+                local.uploader = uploader.acquire_clone()
+                clones.append(local.uploader)
+            return _upload_logfile(
+                local.uploader, log_archive_dir, logfile, **kwargs)
+        except Exception, e:
+            logging.exception(
+                'scan_and_upload: error uploading %s', logfile.filename)
+            return e
+
+    pool = multiprocessing.pool.ThreadPool(min(concurrency, len(logfiles)))
+    try:
+        return pool.map(_upload_logfile_in_thread, logfiles, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        for clone in clones:
+            uploader.release_clone(clone)
+
+
+def _upload_all(log_archive_dir, logfiles, uploader, concurrency,
+                **kwargs):
+    """
+    Uploads logfiles, as for scan_and_upload_filenames(). Returns an
+    iterable of the errors (or None) of each logfile's upload, in order.
+    """
+    if isinstance(uploader, base_uploader.AsyncBaseUploader):
+        return uploader.upload_logfiles(log_archive_dir, logfiles)
+    elif concurrency > 1 and len(logfiles) > 1:
+        return _upload_concurrently(
+            log_archive_dir, logfiles, uploader, concurrency, **kwargs)
+    return (
+        _upload_logfile(uploader, log_archive_dir, logfile, **kwargs)
+        for logfile in logfiles
+    )
+
+
+def scan_and_upload_filenames(log_archive_dir, filenames, uploader,
+                              concurrency=1, retry_policy=None,
+                              breaker=None, controller=None,
+                              scheduler=None, bundler=None):
     """
     Args:
 
         - log_archive_dir: path to a directory of archived logfiles
         - filenames: filenames to (possibly) upload within this dir
         - uploader: Uploader instance
+        - concurrency: number of logfiles to upload at once. When more
+          than 1, each upload thread uses its own uploader.clone().
+          Ignored for a base_uploader.AsyncBaseUploader, which uploads
+          up to its own max_in_flight at once from this thread.
+        - retry_policy, breaker, controller: (optional) as for
+          _upload_logfile(). With a controller, concurrency is the
+          most uploads it may allow at once.
+        - scheduler: (optional) schedule.Scheduler giving the order in
+          which to upload. By default, logfiles are uploaded in sorted
+          order.
+        - bundler: (optional) bundle.Bundler, which bundles small
+          logfiles together. Bundles are uploaded first, and every
+          member of one that uploads is marked by the bundler and
+          counted as uploaded.
 
     Returns:
 
         - set of LogFiles that are have been uploaded (now, or earlier)
-        - set of LogFiles that have not yet been uploaded
+        - set of LogFiles that have not yet been uploaded, less any the
+          bundler held back for a later bundle
     """
     logfiles = filter(None, map(parse.parse_filename, filenames))
     if not logfiles:
         return set(), set()  # nothing to do
     uploaded, not_uploaded = uploader.scan_remote(logfiles)
 
-    # Make a fresh, sorted list as we'll be mutating it.
-    for logfile in sorted(not_uploaded):
-        error = uploader.upload_logfile(log_archive_dir, logfile)
-        if error:
+    def _order(dir_path, logfiles):
+        # Make a fresh, ordered list as we'll be mutating the original.
+        if scheduler is not None:
+            return scheduler.order(dir_path, logfiles)
+        return sorted(logfiles)
+
+    bundles = {}
+    singles = not_uploaded
+    if bundler is not None:
+        bundles, held, singles = bundler.bundle(
+            log_archive_dir, not_uploaded)
+        not_uploaded -= held
+        if held:
+            logging.info(
+                'scan_and_upload: holding back %d logfiles to bundle '
+                'later', len(held))
+
+    kwargs = dict(
+        retry_policy=retry_policy, breaker=breaker, controller=controller)
+
+    def _results():
+        # Bundles first, then everything else.
+        for dir_path, logfiles in (
+                (bundler and bundler.get_bundle_dir(log_archive_dir),
+                 bundles),
+                (log_archive_dir, singles)):
+            if not logfiles:
+                continue
+            ordered = _order(dir_path, logfiles)
+            for result in itertools.izip(ordered, _upload_all(
+                    dir_path, ordered, uploader, concurrency, **kwargs)):
+                yield result
+
+    paused = 0
+    for logfile, error in _results():
+        members = bundles.get(logfile, [logfile])
+        if isinstance(error, retry.CircuitOpenError):
+            paused += len(members)
+        elif error:
             logging.warning(
                 'scan_and_upload: failed to upload %s', logfile.filename
             )
         else:
             logging.info(
                 'scan_and_upload: uploaded %s', logfile.filename)
-            not_uploaded.remove(logfile)
-            uploaded.add(logfile)
+            if logfile in bundles:
+                bundler.mark_uploaded(log_archive_dir, logfile, members)
+            for member in members:
+                not_uploaded.remove(member)
+                uploaded.add(member)
+    if paused:
+        logging.warning(
+            'scan_and_upload: circuit breaker open. Left %d logfiles '
+            'for later', paused)
 
     return uploaded, not_uploaded
 
 
 class UploadService(object):
-    def __init__(self, log_archive_dir, log_upload_uri, uploader=None):
+    def __init__(self, log_archive_dir, log_upload_uri, uploader=None,
+                 scan_cache=None, concurrency=1, uploader_kwargs=None,
+                 journal=None, uploaders=None, retry_policy=None,
+                 breaker=None, controller=None, scheduler=None,
+                 bundler=None):
         """
         Args:
             log_archive_dir: path to a directory of archived logfiles,
             log_upload_uri: an upload URI,
             uploader: (optional) uploader instance. Generally used for
                 injecting an uploader when testing.
+            scan_cache: (optional) state.ScanCache, used to avoid
+                re-listing directories that haven't changed.
+            concurrency: (optional) number of logfiles to upload at
+                once.
+            uploader_kwargs: (optional) dict of keyword arguments for
+                the uploader found by get_uploader(), such as
+                multipart_threshold for S3Uploader.
+            journal: (optional) state.UploadJournal of uploaded
+                logfiles. Defaults to that of log_archive_dir, into
+                which any old .uploaded/ marker directory is migrated.
+            uploaders: (optional) dict of uploader classes by URI
+                scheme, such as ASYNC_UPLOADERS. Defaults to UPLOADERS.
+            retry_policy, breaker, controller: (optional) as for
+                scan_and_upload_filenames(). They are kept from one run
+                to the next.
+            scheduler, bundler: (optional) as for
+                scan_and_upload_filenames().
         """
 
         self.log_archive_dir = log_archive_dir
-        self.log_archive_uploaded_dir = os.path.join(
-            log_archive_dir, '.uploaded')
-        if not os.path.exists(self.log_archive_uploaded_dir):
-            os.makedirs(self.log_archive_uploaded_dir)
+        if journal is None:
+            journal = state.UploadJournal(state.open_store(log_archive_dir))
+        marker_dir = os.path.join(log_archive_dir, MARKER_DIRNAME)
+        if os.path.isdir(marker_dir):
+            journal.migrate_marker_dir(marker_dir)
+        self.journal = journal
         self.log_upload_uri = log_upload_uri
         self.uploader = uploader
+        self.scan_cache = scan_cache
+        self.concurrency = concurrency
+        self.uploader_kwargs = uploader_kwargs or {}
+        self.uploaders = UPLOADERS if uploaders is None else uploaders
+        self.retry_policy = retry_policy
+        self.breaker = breaker
+        self.controller = controller
+        self.scheduler = scheduler
+        self.bundler = bundler
 
     def mark_uploaded_filenames(self, uploaded_logfiles):
         """Marks a list of logfiles as having been uploaded.
@@ -129,11 +340,14 @@ class UploadService(object):
             uploaded_logfiles: set of LogFiles that have been uploaded
         """
 
-        for logfile in uploaded_logfiles:
-            marker_path = os.path.join(
-                self.log_archive_uploaded_dir, logfile)
-            with open(marker_path, 'w'):
-                pass
+        uploaded_logfiles = list(uploaded_logfiles)
+        self.journal.add(uploaded_logfiles)
+
+        if self.scan_cache is not None:
+            self.scan_cache.set_stage(
+                self.log_archive_dir, uploaded_logfiles,
+                state.STAGE_UPLOADED
+            )
 
     def run(self):
         """
@@ -142,7 +356,13 @@ class UploadService(object):
         then prunes logfiles that are more than persist_hours hours old.
         """
 
-        uploader = self.uploader or get_uploader(self.log_upload_uri)
+        # The uploader, and its connection, is kept from one run to the
+        # next. The URI is only checked again after errors.
+        if self.uploader is None:
+            self.uploader = get_uploader(
+                self.log_upload_uri, uploaders=self.uploaders,
+                **self.uploader_kwargs)
+        uploader = self.uploader
         uploader.connect()
         error = uploader.check_uri()
         if error:
@@ -153,15 +373,32 @@ class UploadService(object):
                 self.log_upload_uri, error
             ))
 
-        filenames = os.listdir(self.log_archive_dir)
-        filenames = set(filenames) - set(
-            os.listdir(self.log_archive_uploaded_dir)
-        )
-
-        uploaded, not_uploaded = scan_and_upload_filenames(
-            self.log_archive_dir, filenames, uploader
-        )
+        if self.scan_cache is not None:
+            filenames = set(
+                lf.filename for lf in self.scan_cache.list_logfiles(
+                    self.log_archive_dir,
+                    exclude_stage=state.STAGE_UPLOADED
+                )
+            )
+        else:
+            filenames = set(os.listdir(self.log_archive_dir))
+        filenames -= self.journal.get_uploaded(filenames)
+
+        try:
+            uploaded, not_uploaded = scan_and_upload_filenames(
+                self.log_archive_dir, filenames, uploader, self.concurrency,
+                retry_policy=self.retry_policy,
+                breaker=self.breaker,
+                controller=self.controller,
+                scheduler=self.scheduler,
+                bundler=self.bundler
+            )
+        except:
+            uploader.disconnect()
+            raise
         self.mark_uploaded_filenames(lf.filename for lf in uploaded)
+        if not_uploaded:
+            uploader.disconnect()
 
 
 #
@@ -196,6 +433,194 @@ def make_parser():
             'running continuously.'
         )
     )
+    parser.add_argument(
+        '--concurrency', '-c',
+        type=int,
+        default=1,
+        metavar='N',
+        help=(
+            'Upload up to N logfiles at once, each over its own '
+            'connection. Defaults to 1.'
+        )
+    )
+    parser.add_argument(
+        '--adaptive-concurrency',
+        action='store_true',
+        help=(
+            'Treat --concurrency as a ceiling, and adapt how many '
+            'logfiles are uploaded at once to what S3 accepts: adding '
+            'to it as uploads succeed, and halving it when throttled.'
+        )
+    )
+    parser.add_argument(
+        '--no-retry',
+        action='store_true',
+        help=(
+            'Don\'t retry uploads that fail with throttling, server or '
+            'network errors, and don\'t pause uploads when most of '
+            'them fail.'
+        )
+    )
+    parser.add_argument(
+        '--order',
+        choices=schedule.POLICIES,
+        metavar='POLICY',
+        help=(
+            'Order in which to upload logfiles: "newest" first, '
+            '"oldest" first, or "smallest" first. Defaults to sorted '
+            'order, by prefix and then time.'
+        )
+    )
+    parser.add_argument(
+        '--prefix-order',
+        action='append',
+        default=[],
+        metavar='PREFIX=POLICY',
+        help=(
+            'Order logfiles with the given prefix by POLICY, as for '
+            '--order. May be repeated. When prefixes have different '
+            'orders, they take turns.'
+        )
+    )
+    parser.add_argument(
+        '--bandwidth-limit',
+        type=int,
+        metavar='KB',
+        help=(
+            'Upload at most KB kilobytes per second in all, however '
+            'many logfiles or parts are being uploaded at once.'
+        )
+    )
+    parser.add_argument(
+        '--bundle-under',
+        type=int,
+        metavar='KB',
+        help=(
+            'Bundle logfiles smaller than KB kilobytes into one tar file '
+            'per prefix and day, with a table of contents, and upload '
+            'that instead. Off by default.'
+        )
+    )
+    parser.add_argument(
+        '--bundle-min-count',
+        type=int,
+        default=bundle.DEFAULT_MIN_COUNT,
+        metavar='N',
+        help=(
+            'With --bundle-under, the fewest logfiles to bundle. Fewer '
+            'are held back until --bundle-max-delay. Defaults to '
+            '{}.'.format(bundle.DEFAULT_MIN_COUNT)
+        )
+    )
+    parser.add_argument(
+        '--bundle-max-count',
+        type=int,
+        default=bundle.DEFAULT_MAX_COUNT,
+        metavar='N',
+        help=(
+            'With --bundle-under, the most logfiles per bundle. '
+            'Defaults to {}.'.format(bundle.DEFAULT_MAX_COUNT)
+        )
+    )
+    parser.add_argument(
+        '--bundle-max-delay',
+        type=int,
+        default=bundle.DEFAULT_MAX_DELAY // 60,
+        metavar='MINS',
+        help=(
+            'With --bundle-under, the longest to hold back logfiles '
+            'for a fuller bundle, from their timestamps. Defaults to '
+            '{}.'.format(bundle.DEFAULT_MAX_DELAY // 60)
+        )
+    )
+    parser.add_argument(
+        '--async-io',
+        action='store_true',
+        help=(
+            'Scan and upload from a single thread with non-blocking '
+            'I/O, keeping up to --max-in-flight requests in flight at '
+            'once. Logfiles are sent as single PUTs, and the options '
+            'below for multipart uploads, listing, --trust-scan and '
+            '--manifest don\'t apply.'
+        )
+    )
+    parser.add_argument(
+        '--max-in-flight',
+        type=int,
+        default=100,
+        metavar='N',
+        help='With --async-io, the most requests in flight at once.'
+    )
+    parser.add_argument(
+        '--multipart-threshold',
+        type=int,
+        metavar='MB',
+        help=(
+            'Send logfiles of at least MB megabytes as multipart '
+            'uploads. Defaults to 100. 0 disables multipart uploads.'
+        )
+    )
+    parser.add_argument(
+        '--part-size',
+        type=int,
+        metavar='MB',
+        help='Size of each part of a multipart upload. Defaults to 16.'
+    )
+    parser.add_argument(
+        '--part-concurrency',
+        type=int,
+        metavar='N',
+        help=(
+            'Send up to N parts of a multipart upload at once. '
+            'Defaults to 4.'
+        )
+    )
+    parser.add_argument(
+        '--list-concurrency',
+        type=int,
+        metavar='N',
+        help=(
+            'List up to N remote directories at once when scanning for '
+            'uploaded logfiles. Defaults to 4.'
+        )
+    )
+    parser.add_argument(
+        '--trust-scan',
+        action='store_true',
+        help=(
+            'Don\'t check that each logfile is still missing remotely '
+            'just before uploading it, trusting the scan made at the '
+            'start of each cycle instead. Saves a round trip per file.'
+        )
+    )
+    parser.add_argument(
+        '--manifest',
+        action='store_true',
+        help=(
+            'Keep a manifest of uploaded logfiles in '
+            '.logjam/state.db, and only list the remote directories '
+            'it doesn\'t cover instead of listing them every cycle.'
+        )
+    )
+    parser.add_argument(
+        '--reconcile-interval',
+        type=float,
+        default=24,
+        metavar='HOURS',
+        help=(
+            'With --manifest, how often to list each remote directory '
+            'again to reconcile the manifest with it. Defaults to 24.'
+        )
+    )
+    parser.add_argument(
+        '--state-cache',
+        action='store_true',
+        help=(
+            'Cache the parsed contents of log_archive_dir in '
+            '.logjam/state.db therein, so that it is only re-read when '
+            'it changes.'
+        )
+    )
     parser.add_argument(
         '--log-level', '-l',
         choices=('debug', 'info', 'warning', 'error', 'critical'),
@@ -216,14 +641,116 @@ def main():
             )
         )
 
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+
+    uploader_kwargs = {}
+    if args.multipart_threshold is not None:
+        if args.multipart_threshold < 0:
+            parser.error('--multipart-threshold must not be negative')
+        uploader_kwargs['multipart_threshold'] = \
+            args.multipart_threshold * MB or None
+    if args.part_size is not None:
+        if args.part_size < 5:
+            parser.error('--part-size must be at least 5 (MB)')
+        uploader_kwargs['part_size'] = args.part_size * MB
+    if args.part_concurrency is not None:
+        if args.part_concurrency < 1:
+            parser.error('--part-concurrency must be at least 1')
+        uploader_kwargs['part_concurrency'] = args.part_concurrency
+
     service.configure_logging(args.log_level)
 
     # Tune down boto logging
     logging.getLogger('boto').setLevel(logging.WARNING)
 
+    if args.list_concurrency is not None:
+        if args.list_concurrency < 1:
+            parser.error('--list-concurrency must be at least 1')
+        uploader_kwargs['list_concurrency'] = args.list_concurrency
+    if args.trust_scan:
+        uploader_kwargs['trust_scan'] = True
+
+    if args.bandwidth_limit is not None:
+        if args.bandwidth_limit < 1:
+            parser.error('--bandwidth-limit must be at least 1 (KB)')
+        uploader_kwargs['rate_limiter'] = throttle.TokenBucket(
+            args.bandwidth_limit * 1024)
+
+    uploaders = None
+    if args.async_io:
+        if uploader_kwargs or args.manifest:
+            parser.error(
+                '--async-io cannot be combined with --multipart-threshold, '
+                '--part-size, --part-concurrency, --list-concurrency, '
+                '--trust-scan, --manifest or --bandwidth-limit')
+        if args.max_in_flight < 1:
+            parser.error('--max-in-flight must be at least 1')
+        uploaders = ASYNC_UPLOADERS
+        uploader_kwargs['max_in_flight'] = args.max_in_flight
+
+    retry_policy = breaker = controller = None
+    if not args.no_retry:
+        retry_policy = retry.RetryPolicy()
+        breaker = retry.CircuitBreaker()
+    if args.adaptive_concurrency:
+        controller = retry.AIMDController(args.concurrency)
+
+    scheduler = None
+    if args.order or args.prefix_order:
+        policies_by_prefix = {}
+        for arg in args.prefix_order:
+            try:
+                prefix, policy = schedule.parse_prefix_policy(arg)
+            except ValueError, e:
+                parser.error('--prefix-order {!r}: {}'.format(arg, e))
+            policies_by_prefix[prefix] = policy
+        scheduler = schedule.Scheduler(
+            args.order or 'oldest', policies_by_prefix)
+
+    store = state.open_store(args.log_archive_dir)
+    journal = state.UploadJournal(store)
+
+    bundler = None
+    if args.bundle_under is not None:
+        if args.bundle_under < 1:
+            parser.error('--bundle-under must be at least 1 (KB)')
+        if args.bundle_min_count < 2:
+            parser.error('--bundle-min-count must be at least 2')
+        if args.bundle_max_count < args.bundle_min_count:
+            parser.error(
+                '--bundle-max-count must be at least --bundle-min-count')
+        if args.bundle_max_delay < 0:
+            parser.error('--bundle-max-delay must not be negative')
+        bundler = bundle.Bundler(
+            max_size=args.bundle_under * 1024,
+            min_count=args.bundle_min_count,
+            max_count=args.bundle_max_count,
+            max_delay=args.bundle_max_delay * 60,
+            journal=journal
+        )
+
+    scan_cache = None
+    if args.state_cache:
+        scan_cache = state.ScanCache(store)
+    if args.manifest:
+        uploader_kwargs['manifest'] = state.Manifest(store)
+        uploader_kwargs['reconcile_interval'] = \
+            args.reconcile_interval * 60 * 60
+
     upload_service = UploadService(
         args.log_archive_dir,
-        args.log_upload_uri
+        args.log_upload_uri,
+        scan_cache=scan_cache,
+        concurrency=args.concurrency,
+        uploader_kwargs=uploader_kwargs,
+        journal=journal,
+        uploaders=uploaders,
+        retry_policy=retry_policy,
+        breaker=breaker,
+        controller=controller,
+        scheduler=scheduler,
+        bundler=bundler
     )
 
     if args.once:
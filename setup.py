@@ -21,7 +21,12 @@ setup(
         'boto>=2.2.2',
         ],
     packages=['logjam',],
-    scripts=['scripts/logjam-compress', 'scripts/logjam-upload'],
+    scripts=[
+        'scripts/logjam-compress',
+        'scripts/logjam-pipeline',
+        'scripts/logjam-ship',
+        'scripts/logjam-upload',
+        ],
     test_suite='tests.unit',
     tests_require=[
         'boto>=2.2.2',
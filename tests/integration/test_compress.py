@@ -53,7 +53,7 @@ def write_logfiles(temp_dir):
 
 class TestLogjamCompress(unittest.TestCase):
 
-    def test_run_logjam_compress_once(self):
+    def _run_logjam_compress_once(self, *extra_args):
         with temporary_directory() as tempdir:
             filenames = write_logfiles(tempdir)
             expected = [
@@ -66,7 +66,8 @@ class TestLogjamCompress(unittest.TestCase):
             archive_dir = os.path.join(tempdir, 'archive')
 
             subprocess.check_call(
-                ['python', '-m', 'logjam.compress', '--once', tempdir])
+                ['python', '-m', 'logjam.compress', '--once'] +
+                list(extra_args) + [tempdir])
             actual = sorted(os.listdir(archive_dir))
             self.assertEqual(expected, actual)
 
@@ -77,6 +78,13 @@ class TestLogjamCompress(unittest.TestCase):
                     self.assertEqual(expected, f.read())
 
 
+    def test_run_logjam_compress_once(self):
+        self._run_logjam_compress_once()
+
+    def test_run_logjam_compress_once_stream_engine(self):
+        self._run_logjam_compress_once('--engine', 'stream')
+
+
     def test_run_logjam_compress_forever(self):
         MAX_TIME = 5
         with temporary_directory() as tempdir:
@@ -177,3 +185,45 @@ class TestLogjamCompress(unittest.TestCase):
                     else:
                         expected = logfile_contents(name[:-3])
                     self.assertEqual(expected, f.read())
+
+
+    def test_run_logjam_compress_watch(self):
+        MAX_TIME = 5
+        with temporary_directory() as tempdir:
+            utcnow = datetime.datetime.utcnow()
+            current, later = [
+                'haproxy-{}.log'.format(t.strftime(ISO_FORMAT))
+                for t in (utcnow, utcnow + ONE_HOUR)
+            ]
+            with open(os.path.join(tempdir, current), 'w') as f:
+                f.write(logfile_contents(current))
+
+            archive_dir = os.path.join(tempdir, 'archive')
+            p = subprocess.Popen(
+                ['python', '-m', 'logjam.compress', '--watch', tempdir])
+            try:
+                # Wait for the initial scan to create archive/
+                start = time.time()
+                while time.time() - start < MAX_TIME:
+                    if os.path.isdir(archive_dir):
+                        break
+                    time.sleep(0.1)
+                self.assertEqual([], os.listdir(archive_dir))
+
+                # A newer logfile supersedes the current one, which
+                # should be compressed well before the next rescan.
+                with open(os.path.join(tempdir, later), 'w') as f:
+                    f.write(logfile_contents(later))
+
+                expected = [current + '.gz']
+                start = time.time()
+                while time.time() - start < MAX_TIME:
+                    actual = sorted(os.listdir(archive_dir))
+                    if expected == actual:
+                        break
+                    self.assertEqual(None, p.poll())
+                    time.sleep(0.1)
+                self.assertEqual(expected, actual)
+            finally:
+                p.terminate()
+                p.wait()
@@ -0,0 +1,185 @@
+""" tests for logjam.bundle """
+
+import datetime
+import hashlib
+import os
+import os.path
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import logjam.bundle
+import logjam.parse
+import logjam.state
+
+
+NOW = datetime.datetime(2013, 7, 27, 12, 30)
+
+
+def _minutely(prefix, count, hour=12):
+    return [
+        '{}-20130727T{:02d}{:02d}Z.log.gz'.format(prefix, hour, minute)
+        for minute in range(count)
+    ]
+
+
+class TestBundle(unittest.TestCase):
+
+    def setUp(self):
+        self.log_archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.log_archive_dir)
+
+    def _make_files(self, filenames, size=10):
+        for filename in filenames:
+            with open(os.path.join(self.log_archive_dir, filename),
+                      'wb') as f:
+                f.write(filename[:size].ljust(size, 'x'))
+        return set(map(logjam.parse.parse_filename, filenames))
+
+    def _make_bundler(self, **kwargs):
+        kwargs.setdefault('max_size', 100)
+        kwargs.setdefault('min_count', 3)
+        return logjam.bundle.Bundler(utcnow=lambda: NOW, **kwargs)
+
+    #
+    # test_write_bundle_*
+    #
+
+    def test_write_bundle(self):
+        logfiles = self._make_files(_minutely('flask', 3))
+        path = os.path.join(self.log_archive_dir, 'bundle.tar')
+
+        toc = logjam.bundle.write_bundle(
+            path, self.log_archive_dir, logfiles)
+        self.assertEqual(
+            _minutely('flask', 3),
+            [member['filename'] for member in toc['members']])
+
+        with open(path, 'rb') as f:
+            self.assertEqual(toc, logjam.bundle.read_toc(f))
+            for member in toc['members']:
+                with open(os.path.join(
+                        self.log_archive_dir, member['filename']),
+                        'rb') as src:
+                    data = src.read()
+                self.assertEqual(data, logjam.bundle.read_member(f, member))
+                self.assertEqual(hashlib.md5(data).hexdigest(),
+                                 member['md5'])
+
+        # It's a plain tar file, too.
+        tar = tarfile.open(path)
+        self.addCleanup(tar.close)
+        self.assertEqual(
+            _minutely('flask', 3) + [logjam.bundle.TOC_NAME],
+            tar.getnames())
+
+    def test_get_bundle_filename(self):
+        day = datetime.date(2013, 7, 27)
+        filename = logjam.bundle.get_bundle_filename(
+            'flask', day, ['b', 'a'])
+        self.assertEqual(
+            filename,
+            logjam.bundle.get_bundle_filename('flask', day, ['a', 'b']))
+
+        logfile = logjam.parse.parse_filename(filename)
+        self.assertEqual('flask', logfile.prefix)
+        self.assertEqual(datetime.datetime(2013, 7, 27), logfile.timestamp)
+        self.assertEqual('.tar', logfile.extension)
+
+    #
+    # test_group_*
+    #
+
+    def test_group_by_prefix_and_day(self):
+        logfiles = self._make_files(
+            _minutely('flask', 4) + _minutely('haproxy', 3) +
+            ['flask-20130726T2359Z.log.gz'])
+        big = self._make_files(['flask-20130727T1205Z.log.gz'], size=200)
+
+        groups, held, singles = self._make_bundler().group(
+            self.log_archive_dir, logfiles | big)
+        self.assertEqual(
+            [_minutely('flask', 4), _minutely('haproxy', 3)],
+            [[lf.filename for lf in group] for group in groups])
+        self.assertEqual(set(), held)
+        self.assertEqual(
+            set(['flask-20130726T2359Z.log.gz',
+                 'flask-20130727T1205Z.log.gz']),
+            set(lf.filename for lf in singles))
+
+    def test_group_max_count(self):
+        logfiles = self._make_files(_minutely('flask', 7))
+        groups, held, singles = self._make_bundler(max_count=3).group(
+            self.log_archive_dir, logfiles)
+        self.assertEqual([3, 3], [len(group) for group in groups])
+        # The last is too few to bundle yet.
+        self.assertEqual(1, len(held))
+        self.assertEqual(set(), singles)
+
+    def test_group_holds_back_recent(self):
+        recent = self._make_files(_minutely('flask', 2))
+        old = self._make_files(_minutely('haproxy', 2, hour=10))
+        lone = self._make_files(_minutely('nginx', 1, hour=10))
+
+        groups, held, singles = self._make_bundler().group(
+            self.log_archive_dir, recent | old | lone)
+        self.assertEqual(
+            [_minutely('haproxy', 2, hour=10)],
+            [[lf.filename for lf in group] for group in groups])
+        self.assertEqual(recent, held)
+        self.assertEqual(lone, singles)
+
+    #
+    # test_bundle_*
+    #
+
+    def test_bundle_and_mark_uploaded(self):
+        store = logjam.state.open_store(self.log_archive_dir)
+        self.addCleanup(store.close)
+        journal = logjam.state.UploadJournal(store)
+        bundler = self._make_bundler(journal=journal)
+        logfiles = self._make_files(_minutely('flask', 3))
+
+        bundles, held, singles = bundler.bundle(
+            self.log_archive_dir, logfiles)
+        self.assertEqual(1, len(bundles))
+        bundle_logfile, members = bundles.items()[0]
+        self.assertEqual(logfiles, set(members))
+        bundle_dir = bundler.get_bundle_dir(self.log_archive_dir)
+        self.assertEqual(
+            [bundle_logfile.filename], os.listdir(bundle_dir))
+
+        bundler.mark_uploaded(self.log_archive_dir, bundle_logfile, members)
+        filenames = _minutely('flask', 3)
+        self.assertEqual(set(filenames), journal.get_uploaded(filenames))
+        self.assertEqual(
+            dict.fromkeys(filenames, bundle_logfile.filename),
+            journal.get_bundles(filenames))
+        self.assertEqual([], os.listdir(bundle_dir))
+
+    def test_bundle_keeps_dot_entries(self):
+        bundler = self._make_bundler()
+        bundle_dir = bundler.get_bundle_dir(self.log_archive_dir)
+        os.makedirs(os.path.join(bundle_dir, logjam.state.STATE_DIRNAME))
+        with open(os.path.join(bundle_dir, '.keep'), 'w'):
+            pass
+
+        logfiles = self._make_files(_minutely('flask', 3))
+        bundles, _, _ = bundler.bundle(self.log_archive_dir, logfiles)
+        self.assertEqual(
+            sorted(['.keep', logjam.state.STATE_DIRNAME] +
+                   [lf.filename for lf in bundles]),
+            sorted(os.listdir(bundle_dir)))
+
+    def test_bundle_removes_stale_bundles(self):
+        bundler = self._make_bundler()
+        logfiles = self._make_files(_minutely('flask', 3))
+        bundles, _, _ = bundler.bundle(self.log_archive_dir, logfiles)
+
+        logfiles |= self._make_files(_minutely('flask', 4))
+        new_bundles, _, _ = bundler.bundle(self.log_archive_dir, logfiles)
+        self.assertNotEqual(bundles.keys(), new_bundles.keys())
+        self.assertEqual(
+            [lf.filename for lf in new_bundles],
+            os.listdir(bundler.get_bundle_dir(self.log_archive_dir)))
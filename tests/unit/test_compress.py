@@ -1,16 +1,21 @@
 """ tests for logjam.compress """
 
+import StringIO
 import contextlib
 import datetime
+import gzip
+import hashlib
 import os
 import os.path
 import shutil
 import tempfile
 import unittest
+import zlib
 
 from logjam.parse import LogFile
 import logjam.compress
 import logjam.parse
+import logjam.state
 
 
 @contextlib.contextmanager
@@ -28,6 +33,20 @@ class TestCompress(unittest.TestCase):
 
     maxDiff = None
 
+    #
+    # test_is_logfile_name_*
+    #
+
+    def test_is_logfile_name(self):
+        self.assertTrue(
+            logjam.compress.is_logfile_name('haproxy-20130727T1400Z.log'))
+        self.assertFalse(logjam.compress.is_logfile_name('archive'))
+
+    def test_is_logfile_name_temporary_file(self):
+        self.assertFalse(logjam.compress.is_logfile_name(
+            'haproxy-20130727T1400Z.log.abcd12' +
+            logjam.compress.TEMP_SUFFIX))
+
     #
     # test_select_superseded_by_new_file_*
     #
@@ -153,6 +172,68 @@ class TestCompress(unittest.TestCase):
         self.assertEqual(expected, actual)
 
 
+    #
+    # test_select_closed_by_writers_*
+    #
+
+    def test_select_closed_by_writers(self):
+        pf = logjam.parse.parse_filename
+        logfiles = [
+            pf('haproxy-20130727T1100Z.log'),
+            pf('haproxy-20130727T1200Z.log'),
+            pf('haproxy-20130727T1300Z.log'),
+            ]
+        open_filenames = set(['haproxy-20130727T1100Z.log'])
+        current_time = datetime.datetime(2013, 07, 27, 13, 0, 30)
+        expected = [
+            pf('haproxy-20130727T1200Z.log'),
+            ]
+        actual = logjam.compress.select_closed_by_writers(
+            logfiles, open_filenames, current_time
+            )
+        self.assertEqual(expected, actual)
+
+    def test_yield_old_logfiles_closed_by_writers(self):
+        pf = logjam.parse.parse_filename
+        filenames = [
+            'haproxy-20130727T1200Z.log',
+            'flask-20130727T1200Z.log',
+            ]
+        timestamp = datetime.datetime(2013, 07, 27, 13, 1)
+
+        expected = [
+            pf('haproxy-20130727T1200Z.log'),
+            ]
+        actual = list(logjam.compress.yield_old_logfiles(
+            filenames, timestamp, set(['flask-20130727T1200Z.log'])
+            ))
+        self.assertEqual(expected, actual)
+
+        # ... and without open_filenames, neither is old yet.
+        self.assertEqual(
+            [], list(logjam.compress.yield_old_logfiles(filenames, timestamp))
+            )
+
+    def test_find_filenames_open_for_writing(self):
+        if not os.path.isdir('/proc/self/fd'):
+            self.skipTest('/proc is not available')
+        with temporary_directory() as temp_dir:
+            writing_path = os.path.join(temp_dir, 'writing.log')
+            reading_path = os.path.join(temp_dir, 'reading.log')
+            with open(reading_path, 'w'):
+                pass
+            with open(writing_path, 'a') as writing_f:
+                with open(reading_path, 'r'):
+                    actual = logjam.compress.find_filenames_open_for_writing(
+                        temp_dir)
+            if actual is None:
+                self.skipTest('cannot read the open files of all processes')
+            self.assertEqual(set(['writing.log']), actual)
+
+            actual = logjam.compress.find_filenames_open_for_writing(
+                temp_dir)
+            self.assertEqual(set(), actual)
+
     #
     # test_duplicate_timestamp_path
     #
@@ -313,3 +394,304 @@ class TestCompress(unittest.TestCase):
 
             # check that compress_path() deleted the source log file.
             self.assertFalse(os.path.isfile(log_path))
+
+
+    def test_compress_path_engine_success(self):
+        with temporary_directory() as temp_dir:
+            log_path = os.path.join(temp_dir, 'compress-test.log')
+            contents = ''.join('line %d\n' % i for i in range(10000))
+            with open(log_path, 'w') as f:
+                f.write(contents)
+
+            archive_dir = os.path.join(temp_dir, 'archive')
+            os.mkdir(archive_dir)
+            expected = os.path.join(archive_dir, 'compress-test.log.gz')
+            actual = logjam.compress.compress_path(
+                log_path,
+                logjam.compress.StreamEngine(buffer_size=1000),
+                '.gz',
+                archive_dir,
+            )
+            self.assertEqual(expected, actual)
+            self.assertFalse(os.path.isfile(log_path))
+            self.assertEqual(['archive'], os.listdir(temp_dir))
+
+            with gzip.GzipFile(expected, 'r') as f:
+                self.assertEqual(contents, f.read())
+
+    def test_compress_path_engine_fail(self):
+        os_rename, rename_args = self._make_os_rename()
+        with temporary_directory() as temp_dir:
+            log_path = os.path.join(temp_dir, 'compress-test.log')
+            archive_dir = os.path.join(temp_dir, 'archive')
+            actual = logjam.compress.compress_path(
+                log_path,
+                logjam.compress.StreamEngine(),
+                '.gz',
+                archive_dir,
+                os_rename=os_rename
+            )
+            self.assertEqual(None, actual)
+            self.assertEqual([None], rename_args)
+            self.assertEqual([], os.listdir(temp_dir))
+
+    def _assert_compress_path_checksums(self, compress_cmd_args):
+        with temporary_directory() as temp_dir:
+            log_path = os.path.join(temp_dir, 'compress-test.log')
+            contents = ''.join('line %d\n' % i for i in range(10000))
+            with open(log_path, 'w') as f:
+                f.write(contents)
+
+            archive_dir = os.path.join(temp_dir, 'archive')
+            os.mkdir(archive_dir)
+            store = logjam.state.open_store(archive_dir)
+            self.addCleanup(store.close)
+            checksums = logjam.state.ChecksumStore(store)
+
+            actual = logjam.compress.compress_path(
+                log_path,
+                compress_cmd_args,
+                '.gz',
+                archive_dir,
+                checksums=checksums,
+                checksum_part_size=1000,
+            )
+
+            with open(actual, 'rb') as f:
+                compressed = f.read()
+            checksum = checksums.get('compress-test.log.gz')
+            self.assertEqual(len(compressed), checksum.size)
+            self.assertEqual(os.stat(actual).st_mtime, checksum.mtime)
+            self.assertEqual(
+                hashlib.md5(compressed).hexdigest(), checksum.md5)
+            self.assertEqual(1000, checksum.part_size)
+            self.assertEqual(
+                [
+                    hashlib.md5(compressed[i:i + 1000]).hexdigest()
+                    for i in range(0, len(compressed), 1000)
+                ],
+                checksum.part_md5s)
+
+    def test_compress_path_cmd_checksums(self):
+        self._assert_compress_path_checksums(('gzip', '-c'))
+
+    def test_compress_path_engine_checksums(self):
+        self._assert_compress_path_checksums(
+            logjam.compress.StreamEngine(buffer_size=1000))
+
+    #
+    # test_get_codec_*, test_make_compressor_*
+    #
+
+    def test_get_codec_gzip(self):
+        codec = logjam.compress.get_codec('gzip')
+        self.assertEqual('gzip', codec.name)
+        self.assertEqual('.gz', codec.extension)
+
+    def test_get_codec_missing_library_falls_back_to_gzip(self):
+        codecs = {'gzip': logjam.compress.CODECS['gzip']}
+        codec = logjam.compress.get_codec('zstd', codecs=codecs)
+        self.assertEqual('gzip', codec.name)
+
+    def test_get_codec_unknown(self):
+        with self.assertRaisesRegexp(ValueError, '^Unknown codec bz3$'):
+            logjam.compress.get_codec('bz3')
+
+    def test_make_compressor_gzip_subprocess(self):
+        expected = (('gzip', '-c', '-9'), '.gz')
+        actual = logjam.compress.make_compressor('gzip', 9, 'subprocess')
+        self.assertEqual(expected, actual)
+
+    def test_make_compressor_level_out_of_range(self):
+        with self.assertRaisesRegexp(
+                ValueError, '^gzip compression level must be from 1 to 9'):
+            logjam.compress.make_compressor('gzip', 19, 'subprocess')
+
+    def test_make_compressor_level_checked_against_fallback(self):
+        if 'zstd' in logjam.compress.CODECS:
+            self.skipTest('zstd is available')
+        with self.assertRaisesRegexp(ValueError, '^gzip compression'):
+            logjam.compress.make_compressor('zstd', 19, 'stream')
+
+    def _assert_codec_round_trips(self, codec_name, decompress):
+        if codec_name not in logjam.compress.CODECS:
+            self.skipTest('%s is not available' % codec_name)
+
+        engine, extension = logjam.compress.make_compressor(
+            codec_name, engine='stream')
+        self.assertIsInstance(engine, logjam.compress.StreamEngine)
+        self.assertEqual(
+            logjam.compress.CODECS[codec_name].extension, extension)
+
+        with temporary_directory() as temp_dir:
+            log_path = os.path.join(temp_dir, 'compress-test.log')
+            contents = ''.join('line %d\n' % i for i in range(10000))
+            with open(log_path, 'w') as f:
+                f.write(contents)
+
+            archive_dir = os.path.join(temp_dir, 'archive')
+            os.mkdir(archive_dir)
+            dst_path = logjam.compress.compress_path(
+                log_path, engine, extension, archive_dir)
+            self.assertEqual(
+                os.path.join(archive_dir, 'compress-test.log' + extension),
+                dst_path
+            )
+            with open(dst_path, 'rb') as f:
+                self.assertEqual(contents, decompress(f.read()))
+
+    def test_make_compressor_gzip_round_trip(self):
+        self._assert_codec_round_trips(
+            'gzip',
+            lambda data: zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        )
+
+    def test_make_compressor_zstd_round_trip(self):
+        def decompress(data):
+            import zstandard
+            return zstandard.ZstdDecompressor().decompressobj().decompress(
+                data)
+        self._assert_codec_round_trips('zstd', decompress)
+
+    def test_make_compressor_lz4_round_trip(self):
+        def decompress(data):
+            import lz4.frame
+            return lz4.frame.decompress(data)
+        self._assert_codec_round_trips('lz4', decompress)
+
+    def test_make_compressor_xz_round_trip(self):
+        def decompress(data):
+            return logjam.compress.lzma.decompress(data)
+        self._assert_codec_round_trips('xz', decompress)
+
+    #
+    # test_parallel_engine_*
+    #
+
+    def _count_gzip_members(self, data):
+        count = 0
+        while data:
+            d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            d.decompress(data)
+            data = d.unused_data
+            count += 1
+        return count
+
+    def _compress_with_parallel_engine(self, contents, threshold):
+        engine = logjam.compress.ParallelEngine(
+            'gzip', 6, logjam.compress.StreamEngine(), threshold,
+            block_size=1000, processes=2
+        )
+        try:
+            with temporary_directory() as temp_dir:
+                log_path = os.path.join(temp_dir, 'compress-test.log')
+                with open(log_path, 'w') as f:
+                    f.write(contents)
+                archive_dir = os.path.join(temp_dir, 'archive')
+                os.mkdir(archive_dir)
+                dst_path = logjam.compress.compress_path(
+                    log_path, engine, '.gz', archive_dir)
+                with open(dst_path, 'rb') as f:
+                    return f.read()
+        finally:
+            engine.close()
+
+    def test_parallel_engine_above_threshold(self):
+        contents = ''.join('line %d\n' % i for i in range(2000))
+        data = self._compress_with_parallel_engine(contents, 1000)
+
+        # One gzip member per block, which gzip reads as one stream.
+        expected_members = (len(contents) + 999) // 1000
+        self.assertEqual(expected_members, self._count_gzip_members(data))
+        with gzip.GzipFile(fileobj=StringIO.StringIO(data)) as f:
+            self.assertEqual(contents, f.read())
+
+    def test_parallel_engine_below_threshold(self):
+        contents = ''.join('line %d\n' % i for i in range(2000))
+        data = self._compress_with_parallel_engine(
+            contents, len(contents) + 1)
+        self.assertEqual(1, self._count_gzip_members(data))
+        with gzip.GzipFile(fileobj=StringIO.StringIO(data)) as f:
+            self.assertEqual(contents, f.read())
+
+    def test_parallel_engine_block_fails(self):
+        # The workers can't find the codec, so each block raises KeyError.
+        engine = logjam.compress.ParallelEngine(
+            'nonexistent', 6, logjam.compress.StreamEngine(), 1000,
+            block_size=1000, processes=2
+        )
+        self.addCleanup(engine.close)
+        with temporary_directory() as temp_dir:
+            log_path = os.path.join(temp_dir, 'compress-test.log')
+            with open(log_path, 'w') as f:
+                f.write(''.join('line %d\n' % i for i in range(2000)))
+            archive_dir = os.path.join(temp_dir, 'archive')
+            os.mkdir(archive_dir)
+            actual = logjam.compress.compress_path(
+                log_path, engine, '.gz', archive_dir)
+            self.assertIsNone(actual)
+            self.assertEqual(
+                ['archive', 'compress-test.log'], sorted(os.listdir(temp_dir)))
+            self.assertEqual([], os.listdir(archive_dir))
+
+    def test_make_compressor_parallel_threshold(self):
+        engine, extension = logjam.compress.make_compressor(
+            'gzip', 6, 'subprocess', parallel_threshold=1024)
+        self.assertIsInstance(engine, logjam.compress.ParallelEngine)
+        self.assertIsInstance(
+            engine.fallback, logjam.compress.CommandEngine)
+        self.assertEqual(
+            ('gzip', '-c', '-6'), engine.fallback.compress_cmd_args)
+        self.assertEqual('.gz', extension)
+
+    #
+    # test_scan_and_compress_*
+    #
+
+    def _write_old_logfiles(self, temp_dir, count):
+        filenames = [
+            'flask-requests-20130727T%02d00Z-us-west-2-i-ae23fega.log' % i
+            for i in range(count)
+        ]
+        for filename in filenames:
+            with open(os.path.join(temp_dir, filename), 'w') as f:
+                f.write('logfile %s\n' % filename)
+        return filenames
+
+    def test_scan_and_compress_workers(self):
+        with temporary_directory() as temp_dir:
+            filenames = self._write_old_logfiles(temp_dir, 6)
+            archive_dir = os.path.join(temp_dir, 'archive')
+
+            expected = [
+                os.path.join(archive_dir, fn + '.gz') for fn in filenames
+            ]
+            actual = logjam.compress.scan_and_compress(
+                temp_dir, ('gzip', '-c'), '.gz', workers=4)
+            self.assertEqual(expected, actual)
+            self.assertEqual(
+                sorted(fn + '.gz' for fn in filenames),
+                sorted(os.listdir(archive_dir))
+            )
+            self.assertEqual(['archive'], os.listdir(temp_dir))
+
+    def test_default_workers(self):
+        self.assertTrue(logjam.compress.default_workers() >= 1)
+
+    def test_scan_and_compress_scan_cache(self):
+        with temporary_directory() as temp_dir:
+            filenames = self._write_old_logfiles(temp_dir, 2)
+            archive_dir = os.path.join(temp_dir, 'archive')
+            os.mkdir(archive_dir)
+            store = logjam.state.open_store(archive_dir)
+            try:
+                scan_cache = logjam.state.ScanCache(store)
+                expected = [
+                    os.path.join(archive_dir, fn + '.gz') for fn in filenames
+                ]
+                actual = logjam.compress.scan_and_compress(
+                    temp_dir, ('gzip', '-c'), '.gz', scan_cache=scan_cache)
+                self.assertEqual(expected, actual)
+                self.assertEqual([], scan_cache.list_logfiles(temp_dir))
+            finally:
+                store.close()
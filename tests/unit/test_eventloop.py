@@ -0,0 +1,127 @@
+""" tests for logjam.eventloop """
+
+import socket
+import unittest
+
+from logjam.eventloop import Return
+import logjam.eventloop
+
+
+def double(x):
+    raise Return(x * 2)
+    yield
+
+
+def add_doubles(x, y):
+    a = yield double(x)
+    b = yield double(y)
+    raise Return(a + b)
+
+
+class TestEventLoop(unittest.TestCase):
+
+    def _socketpair(self):
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        a.setblocking(0)
+        b.setblocking(0)
+        return a, b
+
+    #
+    # test_run_*
+    #
+
+    def test_run_returns_in_order(self):
+        actual = logjam.eventloop.run(
+            [add_doubles(1, 2), double(5), add_doubles(0, 0)])
+        self.assertEqual([6, 10, 0], actual)
+
+    def test_run_no_coroutines(self):
+        self.assertEqual([], logjam.eventloop.run([]))
+
+    def test_run_raises(self):
+        def fail():
+            raise ValueError('bad')
+            yield
+
+        def catch():
+            try:
+                yield fail()
+            except ValueError, e:
+                raise Return(str(e))
+
+        self.assertEqual(['bad'], logjam.eventloop.run([catch()]))
+        with self.assertRaises(ValueError):
+            logjam.eventloop.run([double(1), fail()])
+
+    def test_run_gather(self):
+        def gathers():
+            results = yield logjam.eventloop.gather(
+                [double(i) for i in range(5)], limit=2)
+            empty = yield logjam.eventloop.gather([])
+            raise Return((results, empty))
+
+        self.assertEqual(
+            [([0, 2, 4, 6, 8], [])], logjam.eventloop.run([gathers()]))
+
+    def test_run_waits_on_sockets(self):
+        a, b = self._socketpair()
+        events = []
+
+        def reader():
+            data = yield logjam.eventloop.recv(a, 5)
+            events.append('read')
+            raise Return(data)
+
+        def writer():
+            events.append('write')
+            yield logjam.eventloop.send_all(b, 'foo', 5)
+
+        self.assertEqual(
+            ['foo', None], logjam.eventloop.run([reader(), writer()]))
+        self.assertEqual(['write', 'read'], events)
+
+    def test_run_limit(self):
+        pairs = [self._socketpair() for _ in range(4)]
+        in_flight = [0]
+        max_in_flight = [0]
+
+        def echo(a, b):
+            in_flight[0] += 1
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+            yield logjam.eventloop.writable(b, 5)
+            yield logjam.eventloop.send_all(b, 'x', 5)
+            data = yield logjam.eventloop.recv(a, 5)
+            in_flight[0] -= 1
+            raise Return(data)
+
+        actual = logjam.eventloop.run(
+            [echo(a, b) for a, b in pairs], limit=2)
+        self.assertEqual(['x'] * 4, actual)
+        self.assertEqual(2, max_in_flight[0])
+
+    def test_run_timeout(self):
+        a, _ = self._socketpair()
+
+        def waits():
+            try:
+                yield logjam.eventloop.readable(a, 0.01)
+            except socket.timeout:
+                raise Return('timed out')
+
+        self.assertEqual(['timed out'], logjam.eventloop.run([waits()]))
+
+    #
+    # test_connect_*
+    #
+
+    def test_connect_refused(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+
+        with self.assertRaises(socket.error):
+            logjam.eventloop.run(
+                [logjam.eventloop.connect('127.0.0.1', port, 5)])
@@ -0,0 +1,99 @@
+""" tests for logjam.inotify """
+
+import contextlib
+import os
+import os.path
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+
+import logjam.inotify
+
+
+@contextlib.contextmanager
+def temporary_directory():
+    tempdir = None
+    try:
+        tempdir = tempfile.mkdtemp()
+        yield tempdir
+    finally:
+        if tempdir and os.path.isdir(tempdir):
+            shutil.rmtree(tempdir)
+
+
+def _pack_event(wd, mask, cookie, name):
+    name += '\0' * (16 - len(name))
+    return struct.pack('iIII', wd, mask, cookie, len(name)) + name
+
+
+class TestInotify(unittest.TestCase):
+
+    #
+    # test_parse_events_*
+    #
+
+    def test_parse_events_two_events(self):
+        data = (
+            _pack_event(1, logjam.inotify.IN_CREATE, 0, 'a.log') +
+            _pack_event(1, logjam.inotify.IN_CLOSE_WRITE, 0, 'b.log')
+        )
+        expected = [
+            logjam.inotify.Event(1, logjam.inotify.IN_CREATE, 0, 'a.log'),
+            logjam.inotify.Event(
+                1, logjam.inotify.IN_CLOSE_WRITE, 0, 'b.log'),
+        ]
+        self.assertEqual(expected, logjam.inotify.parse_events(data))
+
+    def test_parse_events_empty(self):
+        self.assertEqual([], logjam.inotify.parse_events(''))
+
+
+    #
+    # test_directory_watcher_*
+    #
+
+    def _make_watcher(self, temp_dir, name_filter=None):
+        if not logjam.inotify.is_available():
+            self.skipTest('inotify is not available')
+        return logjam.inotify.DirectoryWatcher(
+            temp_dir, name_filter=name_filter)
+
+    def test_directory_watcher_no_change(self):
+        with temporary_directory() as temp_dir:
+            watcher = self._make_watcher(temp_dir)
+            try:
+                start = time.time()
+                self.assertFalse(watcher.wait(0.05))
+                self.assertTrue(time.time() - start >= 0.05)
+            finally:
+                watcher.close()
+
+    def test_directory_watcher_new_file(self):
+        with temporary_directory() as temp_dir:
+            watcher = self._make_watcher(temp_dir)
+            try:
+                with open(os.path.join(temp_dir, 'a.log'), 'w') as f:
+                    f.write('a')
+                self.assertTrue(watcher.wait(1))
+
+                # ... and wait() consumed every pending event.
+                self.assertFalse(watcher.wait(0))
+            finally:
+                watcher.close()
+
+    def test_directory_watcher_missing_dir(self):
+        with temporary_directory() as temp_dir:
+            with self.assertRaises(OSError):
+                self._make_watcher(os.path.join(temp_dir, 'missing'))
+
+    def test_directory_watcher_filtered_file(self):
+        with temporary_directory() as temp_dir:
+            watcher = self._make_watcher(
+                temp_dir, name_filter=lambda name: name.endswith('.log'))
+            try:
+                os.mkdir(os.path.join(temp_dir, 'archive'))
+                self.assertFalse(watcher.wait(0.05))
+            finally:
+                watcher.close()
@@ -0,0 +1,223 @@
+""" tests for logjam.online """
+
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+import zlib
+
+import logjam.compress
+import logjam.online
+import logjam.state
+
+
+@contextlib.contextmanager
+def temporary_directory():
+    tempdir = None
+    try:
+        tempdir = tempfile.mkdtemp()
+        yield tempdir
+    finally:
+        if tempdir and os.path.isdir(tempdir):
+            shutil.rmtree(tempdir)
+
+
+def gunzip(data):
+    """ Decompresses every gzip member in data. """
+    result = []
+    while data:
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        result.append(d.decompress(data))
+        data = d.unused_data
+    return ''.join(result)
+
+
+FILENAME = 'haproxy-20130727T1300Z.log'
+
+
+class TestOnlineCompressor(unittest.TestCase):
+
+    #
+    # Helpers
+    #
+
+    @contextlib.contextmanager
+    def _log_dir(self):
+        with temporary_directory() as log_dir:
+            archive_dir = os.path.join(log_dir, 'archive')
+            os.mkdir(archive_dir)
+            yield log_dir, archive_dir
+
+    def _make_compressor(self, archive_dir, min_chunk_size=1):
+        return logjam.online.OnlineCompressor(
+            archive_dir, logjam.compress.gzip_compressobj, '.gz',
+            min_chunk_size=min_chunk_size
+        )
+
+    def _append(self, log_dir, contents):
+        with open(os.path.join(log_dir, FILENAME), 'a') as f:
+            f.write(contents)
+
+    #
+    # test_tick_*, test_finish_*
+    #
+
+    def test_tick_then_finish(self):
+        with self._log_dir() as (log_dir, archive_dir):
+            compressor = self._make_compressor(archive_dir)
+            self._append(log_dir, 'line 1\n')
+            compressor.tick(log_dir, [FILENAME, 'messages'])
+            self._append(log_dir, 'line 2\n')
+            compressor.tick(log_dir, [FILENAME])
+            self._append(log_dir, 'line 3\n')
+
+            partial_path = compressor.finish(
+                os.path.join(log_dir, FILENAME))
+            with open(partial_path, 'rb') as f:
+                self.assertEqual('line 1\nline 2\nline 3\n', gunzip(f.read()))
+
+            # ... and its state is gone.
+            self.assertEqual(
+                [FILENAME + '.gz.partial'],
+                os.listdir(compressor.state_dir)
+            )
+
+    def test_tick_below_min_chunk_size(self):
+        with self._log_dir() as (log_dir, archive_dir):
+            compressor = self._make_compressor(archive_dir, 1024)
+            self._append(log_dir, 'line 1\n')
+            compressor.tick(log_dir, [FILENAME])
+            self.assertEqual([], os.listdir(compressor.state_dir))
+            self.assertIsNone(
+                compressor.finish(os.path.join(log_dir, FILENAME)))
+
+    def test_tick_forgets_inactive_logfiles(self):
+        with self._log_dir() as (log_dir, archive_dir):
+            compressor = self._make_compressor(archive_dir)
+            self._append(log_dir, 'line 1\n')
+            compressor.tick(log_dir, [FILENAME])
+            self.assertEqual(2, len(os.listdir(compressor.state_dir)))
+            compressor.tick(log_dir, [])
+            self.assertEqual([], os.listdir(compressor.state_dir))
+
+    def test_finish_resumes_after_restart(self):
+        with self._log_dir() as (log_dir, archive_dir):
+            compressor = self._make_compressor(archive_dir)
+            self._append(log_dir, 'line 1\n')
+            compressor.tick(log_dir, [FILENAME])
+
+            # Simulate a crash midway through writing the next member.
+            partial_path = os.path.join(
+                compressor.state_dir, FILENAME + '.gz.partial')
+            with open(partial_path, 'ab') as f:
+                f.write('garbage')
+            self._append(log_dir, 'line 2\n')
+
+            compressor = self._make_compressor(archive_dir)
+            partial_path = compressor.finish(
+                os.path.join(log_dir, FILENAME))
+            with open(partial_path, 'rb') as f:
+                self.assertEqual('line 1\nline 2\n', gunzip(f.read()))
+
+    def test_finish_after_logfile_replaced(self):
+        with self._log_dir() as (log_dir, archive_dir):
+            compressor = self._make_compressor(archive_dir)
+            self._append(log_dir, 'line 1\nline 2\n')
+            compressor.tick(log_dir, [FILENAME])
+
+            os.unlink(os.path.join(log_dir, FILENAME))
+            self._append(log_dir, 'new\n')
+
+            partial_path = compressor.finish(
+                os.path.join(log_dir, FILENAME))
+            with open(partial_path, 'rb') as f:
+                self.assertEqual('new\n', gunzip(f.read()))
+
+    def test_scan_and_compress_online(self):
+        with self._log_dir() as (log_dir, archive_dir):
+            compressor = self._make_compressor(archive_dir)
+            self._append(log_dir, 'line 1\n')
+            compressor.tick(log_dir, [FILENAME])
+            self._append(log_dir, 'line 2\n')
+
+            # A current logfile supersedes FILENAME, and is ticked itself.
+            newer_filename = 'haproxy-{}.log'.format(
+                datetime.datetime.utcnow().strftime('%Y%m%dT%H00Z'))
+            with open(os.path.join(log_dir, newer_filename), 'w') as f:
+                f.write('line 3\n')
+
+            logjam.compress.scan_and_compress(
+                log_dir, ('false',), '.gz',
+                online_compressor=compressor
+            )
+            self.assertEqual(
+                sorted(['archive', newer_filename]), sorted(os.listdir(log_dir))
+            )
+            with open(os.path.join(archive_dir, FILENAME + '.gz')) as f:
+                self.assertEqual('line 1\nline 2\n', gunzip(f.read()))
+
+            with open(os.path.join(
+                    compressor.state_dir, newer_filename + '.json')) as f:
+                self.assertEqual(len('line 3\n'), json.load(f)['offset'])
+
+    def test_scan_and_compress_online_finish_fails(self):
+        class FailingOnlineCompressor(logjam.online.OnlineCompressor):
+            def finish(self, path):
+                raise IOError(28, 'No space left on device')
+
+        with self._log_dir() as (log_dir, archive_dir):
+            compressor = FailingOnlineCompressor(
+                archive_dir, logjam.compress.gzip_compressobj, '.gz')
+            filenames = [
+                'haproxy-20130727T{:02d}00Z.log'.format(hour)
+                for hour in range(13, 16)
+            ]
+            for filename in filenames:
+                with open(os.path.join(log_dir, filename), 'w') as f:
+                    f.write(filename)
+
+            # Each logfile is compressed afresh, rather than the error
+            # aborting the others.
+            logjam.compress.scan_and_compress(
+                log_dir, logjam.compress.StreamEngine(), '.gz', workers=2,
+                online_compressor=compressor
+            )
+            self.assertEqual(['archive'], os.listdir(log_dir))
+            for filename in filenames:
+                with open(os.path.join(archive_dir, filename + '.gz')) as f:
+                    self.assertEqual(filename, gunzip(f.read()))
+
+    def test_scan_and_compress_online_checksums(self):
+        with self._log_dir() as (log_dir, archive_dir):
+            compressor = self._make_compressor(archive_dir)
+            store = logjam.state.open_store(archive_dir)
+            self.addCleanup(store.close)
+            checksums = logjam.state.ChecksumStore(store)
+            self._append(log_dir, 'line 1\n')
+            compressor.tick(log_dir, [FILENAME])
+            self._append(log_dir, 'line 2\n')
+            newer_filename = 'haproxy-{}.log'.format(
+                datetime.datetime.utcnow().strftime('%Y%m%dT%H00Z'))
+            with open(os.path.join(log_dir, newer_filename), 'w') as f:
+                f.write('line 3\n')
+
+            logjam.compress.scan_and_compress(
+                log_dir, ('false',), '.gz',
+                online_compressor=compressor, checksums=checksums
+            )
+
+            archived = os.path.join(archive_dir, FILENAME + '.gz')
+            with open(archived, 'rb') as f:
+                compressed = f.read()
+            checksum = checksums.get(FILENAME + '.gz')
+            self.assertEqual(len(compressed), checksum.size)
+            self.assertEqual(os.stat(archived).st_mtime, checksum.mtime)
+            self.assertEqual(
+                hashlib.md5(compressed).hexdigest(), checksum.md5)
+            self.assertEqual(
+                [hashlib.md5(compressed).hexdigest()], checksum.part_md5s)
@@ -129,3 +129,23 @@ class TestParse(unittest.TestCase):
             }
         actual = logjam.parse.group_filenames(filenames)
         self.assertEqual(expected, actual)
+
+
+    def test_group_logfiles_two_groups(self):
+        pf = logjam.parse.parse_filename
+        logfiles = [
+            pf('flask-requests-20130727T1300Z-us-west-2-i-ae23fega.log'),
+            pf('haproxy-20130727T0100Z-us-west-2-i-ae23fega.log'),
+            pf('flask-requests-20130727T1200Z-us-west-2-i-ae23fega.log'),
+            ]
+        expected = {
+            ('flask-requests', 'us-west-2-i-ae23fega', '.log'): [
+                pf('flask-requests-20130727T1200Z-us-west-2-i-ae23fega.log'),
+                pf('flask-requests-20130727T1300Z-us-west-2-i-ae23fega.log'),
+                ],
+            ('haproxy', 'us-west-2-i-ae23fega', '.log'): [
+                pf('haproxy-20130727T0100Z-us-west-2-i-ae23fega.log'),
+                ],
+            }
+        actual = logjam.parse.group_logfiles(logfiles)
+        self.assertEqual(expected, actual)
@@ -0,0 +1,191 @@
+""" tests for logjam.pipeline """
+
+import contextlib
+import os
+import os.path
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+import logjam.compress
+import logjam.pipeline
+import logjam.state
+
+
+@contextlib.contextmanager
+def temporary_directory():
+    tempdir = None
+    try:
+        tempdir = tempfile.mkdtemp()
+        yield tempdir
+    finally:
+        if tempdir and os.path.isdir(tempdir):
+            shutil.rmtree(tempdir)
+
+
+def create_logs(log_dir, *filenames):
+    for filename in filenames:
+        with open(os.path.join(log_dir, filename), 'w') as f:
+            f.write('foo\n')
+
+
+#
+# Mocks
+#
+
+class MockUploader(object):
+    """
+    Mocks logjam.base_uploader.BaseUploader. Clones share its list of
+    uploaded filenames. Uploads of filenames in fail_filenames fail
+    fail_count times each.
+    """
+
+    def __init__(self, fail_filenames=(), fail_count=1, parent=None):
+        self.parent = parent
+        if parent is not None:
+            self.lock = parent.lock
+            self.uploaded = parent.uploaded
+            self.failures = parent.failures
+        else:
+            self.lock = threading.Lock()
+            self.uploaded = []
+            self.failures = dict(
+                (filename, fail_count) for filename in fail_filenames)
+
+    def clone(self):
+        return MockUploader(parent=self)
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def check_uri(self):
+        pass
+
+    def upload_logfile(self, log_archive_dir, logfile):
+        assert os.path.isfile(os.path.join(log_archive_dir, logfile.filename))
+        with self.lock:
+            if self.failures.get(logfile.filename):
+                self.failures[logfile.filename] -= 1
+                return IOError('upload failed')
+            self.uploaded.append(logfile.filename)
+
+
+class TestPipeline(unittest.TestCase):
+
+    #
+    # Helpers
+    #
+
+    def _make_pipeline(self, log_dir, uploader, **kwargs):
+        pipeline = logjam.pipeline.PipelineService(
+            log_dir, 's3://bucket/{prefix}/{filename}', ('gzip', '-c'),
+            '.gz', uploader=uploader, **kwargs)
+        self.addCleanup(pipeline.journal.store.close)
+        return pipeline
+
+    #
+    # test_run_*
+    #
+
+    def test_run_once(self):
+        with temporary_directory() as log_dir:
+            create_logs(
+                log_dir,
+                'flask-20130727T0000Z-i-34aea3fe.log',
+                'flask-20130727T0100Z-i-34aea3fe.log',
+                'flask-20130727T0200Z-i-34aea3fe.log',
+            )
+            uploader = MockUploader()
+            pipeline = self._make_pipeline(
+                log_dir, uploader, workers=2, concurrency=2, queue_depth=1)
+
+            archived = pipeline.run_once()
+
+            expected = [
+                'flask-20130727T0000Z-i-34aea3fe.log.gz',
+                'flask-20130727T0100Z-i-34aea3fe.log.gz',
+                'flask-20130727T0200Z-i-34aea3fe.log.gz',
+            ]
+            self.assertEqual(
+                expected, sorted(os.path.basename(p) for p in archived))
+            self.assertEqual(expected, sorted(uploader.uploaded))
+            self.assertEqual(
+                set(expected), pipeline.journal.get_uploaded(expected))
+            self.assertEqual([], pipeline.threads)
+
+    def test_run_uploads_backlog(self):
+        with temporary_directory() as log_dir:
+            archive_dir = os.path.join(log_dir, 'archive')
+            os.mkdir(archive_dir)
+            create_logs(
+                archive_dir,
+                'flask-20130727T0000Z-i-34aea3fe.log.gz',
+                'flask-20130727T0100Z-i-34aea3fe.log.gz',
+            )
+            uploader = MockUploader()
+            pipeline = self._make_pipeline(log_dir, uploader)
+            pipeline.journal.add(['flask-20130727T0000Z-i-34aea3fe.log.gz'])
+
+            self.assertEqual([], pipeline.run_once())
+            self.assertEqual(
+                ['flask-20130727T0100Z-i-34aea3fe.log.gz'],
+                uploader.uploaded)
+
+    def test_run_retries_failed_uploads(self):
+        with temporary_directory() as log_dir:
+            create_logs(
+                log_dir,
+                'flask-20130727T0000Z-i-34aea3fe.log',
+                'flask-20130727T0100Z-i-34aea3fe.log',
+            )
+            filename = 'flask-20130727T0000Z-i-34aea3fe.log.gz'
+            uploader = MockUploader(fail_filenames=[filename])
+            pipeline = self._make_pipeline(log_dir, uploader)
+
+            pipeline.run()
+            pipeline.queue.join()
+            self.assertEqual(
+                ['flask-20130727T0100Z-i-34aea3fe.log.gz'],
+                uploader.uploaded)
+            self.assertEqual(set([filename]), pipeline.failed)
+
+            self.assertEqual([], pipeline.run_once())
+            self.assertEqual(filename, uploader.uploaded[-1])
+            self.assertEqual(
+                set([filename]), pipeline.journal.get_uploaded([filename]))
+
+    def test_run_survives_journal_errors(self):
+        with temporary_directory() as log_dir:
+            create_logs(
+                log_dir,
+                'flask-20130727T0000Z-i-34aea3fe.log',
+                'flask-20130727T0100Z-i-34aea3fe.log',
+            )
+            filename = 'flask-20130727T0000Z-i-34aea3fe.log.gz'
+            uploader = MockUploader()
+            pipeline = self._make_pipeline(log_dir, uploader, queue_depth=1)
+
+            journal_add = pipeline.journal.add
+            failures = [filename]
+
+            def _add(filenames):
+                if failures and filenames == failures[:1]:
+                    failures.pop()
+                    raise sqlite3.OperationalError('database is locked')
+                journal_add(filenames)
+            pipeline.journal.add = _add
+
+            pipeline.run()
+            pipeline.queue.join()
+            self.assertEqual(set([filename]), pipeline.failed)
+            self.assertTrue(all(t.is_alive() for t in pipeline.threads))
+            self.assertEqual(set(), pipeline.journal.get_uploaded([filename]))
+
+            pipeline.run_once()
+            self.assertEqual(
+                set([filename]), pipeline.journal.get_uploaded([filename]))
@@ -0,0 +1,168 @@
+""" tests for logjam.retry """
+
+import errno
+import socket
+import threading
+import unittest
+
+import boto.exception
+
+from logjam.retry import THROTTLED, SERVER_ERROR, NETWORK_ERROR, FATAL
+import logjam.retry
+
+
+def _throttled():
+    return boto.exception.S3ResponseError(503, 'Slow Down')
+
+
+class TestRetry(unittest.TestCase):
+
+    #
+    # test_classify
+    #
+
+    def test_classify(self):
+        slow_down = boto.exception.S3ResponseError(400, 'Bad Request')
+        slow_down.error_code = 'SlowDown'
+        cases = [
+            (None, None),
+            (_throttled(), THROTTLED),
+            (boto.exception.S3ResponseError(429, 'Too Many'), THROTTLED),
+            (slow_down, THROTTLED),
+            (boto.exception.BotoServerError(500, 'Oops'), SERVER_ERROR),
+            (boto.exception.S3ResponseError(403, 'Forbidden'), FATAL),
+            (socket.timeout('timed out'), NETWORK_ERROR),
+            (IOError('reset'), NETWORK_ERROR),
+            (socket.error(errno.ECONNRESET, 'reset'), NETWORK_ERROR),
+            (IOError(errno.ETIMEDOUT, 'timed out'), NETWORK_ERROR),
+            (IOError(errno.ENOENT, 'No such file or directory'), FATAL),
+            (OSError(errno.EACCES, 'Permission denied'), FATAL),
+            (ValueError('bad'), FATAL),
+        ]
+        for error, expected in cases:
+            self.assertEqual(expected, logjam.retry.classify(error))
+
+    #
+    # test_retry_policy_*
+    #
+
+    def _make_policy(self, **kwargs):
+        sleeps = []
+        policy = logjam.retry.RetryPolicy(
+            sleep=sleeps.append, random_func=lambda: 1.0, **kwargs)
+        return policy, sleeps
+
+    def test_retry_policy_retries_until_success(self):
+        policy, sleeps = self._make_policy()
+        errors = [_throttled(), IOError('reset'), None]
+        observed = []
+
+        actual = policy.call(lambda: errors.pop(0), observe=observed.append)
+        self.assertIsNone(actual)
+        self.assertEqual([0.5, 1.0], sleeps)
+        self.assertEqual([THROTTLED, NETWORK_ERROR, None], observed)
+
+    def test_retry_policy_limits_by_class(self):
+        policy, sleeps = self._make_policy(
+            max_attempts={SERVER_ERROR: 2}, max_delay=0.75)
+        error = boto.exception.BotoServerError(500, 'Oops')
+        calls = []
+
+        def fail():
+            calls.append(1)
+            return error
+
+        self.assertIs(error, policy.call(fail))
+        self.assertEqual(2, len(calls))
+
+        policy.call(_throttled)
+        self.assertEqual([0.5, 0.75, 0.75, 0.75, 0.75], sleeps[1:])
+
+    def test_retry_policy_fatal(self):
+        policy, sleeps = self._make_policy()
+        error = boto.exception.S3ResponseError(403, 'Forbidden')
+        self.assertIs(error, policy.call(lambda: error))
+        self.assertEqual([], sleeps)
+
+    def test_retry_policy_jitter(self):
+        policy = logjam.retry.RetryPolicy(random_func=lambda: 0.25)
+        self.assertEqual(0.125, policy.get_delay(1))
+        self.assertEqual(0.5, policy.get_delay(3))
+        self.assertEqual(7.5, policy.get_delay(20))
+
+    #
+    # test_circuit_breaker_*
+    #
+
+    def test_circuit_breaker(self):
+        now = [0]
+        breaker = logjam.retry.CircuitBreaker(
+            window=4, threshold=0.5, min_results=4, cooldown=10,
+            time_func=lambda: now[0])
+
+        for error_class in [None, THROTTLED, None, FATAL]:
+            self.assertTrue(breaker.allow())
+            breaker.record(error_class)
+        self.assertTrue(breaker.allow())
+        breaker.record(SERVER_ERROR)
+        self.assertFalse(breaker.allow())
+
+        # After the cooldown, one probe is let through.
+        now[0] = 10
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record(NETWORK_ERROR)
+        self.assertFalse(breaker.allow())
+
+        now[0] = 20
+        self.assertTrue(breaker.allow())
+        breaker.record(None)
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+
+    #
+    # test_aimd_controller_*
+    #
+
+    def test_aimd_controller(self):
+        controller = logjam.retry.AIMDController(8, minimum=2, initial=4)
+        for _ in range(4):
+            controller.acquire()
+        self.assertEqual(4, controller.in_flight)
+
+        # One burst of throttling halves the limit once.
+        for _ in range(4):
+            controller.release(THROTTLED)
+        self.assertEqual(2, controller.limit)
+
+        for _ in range(3):
+            controller.acquire()
+            controller.release(THROTTLED)
+        self.assertEqual(2, controller.limit)
+
+        # Successes add about one for each limit of them.
+        for _ in range(2):
+            controller.acquire()
+            controller.release(None)
+        self.assertAlmostEqual(2.9, controller.limit, places=1)
+
+        for _ in range(100):
+            controller.acquire()
+            controller.release(None)
+        self.assertEqual(8, controller.limit)
+
+    def test_aimd_controller_blocks(self):
+        controller = logjam.retry.AIMDController(1)
+        controller.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            controller.acquire()
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.05))
+        controller.release(None)
+        self.assertTrue(acquired.wait(5))
+        thread.join()
@@ -1,12 +1,18 @@
 """ tests for logjam.s3_uploader """
 
+import hashlib
 import os.path
+import shutil
+import tempfile
+import time
 import unittest
 
 import boto.exception
 
+import logjam.bundle
 import logjam.parse
 import logjam.s3_uploader
+import logjam.state
 
 
 #
@@ -33,22 +39,102 @@ class MockS3Key(object):
         self.name = name
         self.contents = contents
 
-    def set_contents_from_filename(self, filename):
+    def set_contents_from_filename(self, filename, headers=None, md5=None):
+        if (headers or {}).get('If-None-Match') == '*' and \
+                self.name in self.bucket.keys:
+            raise boto.exception.S3ResponseError(412, 'Precondition Failed')
         self.contents = 'file:{}'.format(filename)
+        self.headers = headers
+        self.md5 = md5
+        self.bucket.keys[self.name] = self
+
+
+    def set_contents_from_string(self, contents):
+        self.contents = contents
+        self.bucket.keys[self.name] = self
+
+    def set_contents_from_file(self, fp, headers=None, md5=None):
+        self.contents = fp.read()
+        self.headers = headers
+        self.md5 = md5
         self.bucket.keys[self.name] = self
 
 
 class FailingMockS3Key(MockS3Key):
-    def set_contents_from_filename(self, filename):
+    def set_contents_from_filename(self, filename, headers=None, md5=None):
         raise boto.exception.BotoServerError(500, 'unknown reason')
 
 
+class MockMultiPartPart(object):
+    def __init__(self, part_number, etag):
+        self.part_number = part_number
+        self.etag = etag
+
+
+class MockMultiPartUpload(object):
+    def __init__(self, bucket, key_name, upload_id):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.id = upload_id
+
+    def _get_parts(self):
+        if self.id not in self.bucket.multipart_uploads:
+            raise boto.exception.S3ResponseError(404, 'NoSuchUpload')
+        return self.bucket.multipart_uploads[self.id][1]
+
+    def __iter__(self):
+        parts = self._get_parts()
+        return iter([
+            MockMultiPartPart(n, '"{}"'.format(hashlib.md5(parts[n]).hexdigest()))
+            for n in sorted(parts)
+            ])
+
+    def upload_part_from_file(self, fp, part_num, md5=None, size=None):
+        parts = self._get_parts()
+        parts[part_num] = fp.read(size)
+        self.bucket.part_uploads.append(part_num)
+        self.bucket.part_md5s[part_num] = md5
+        return MockMultiPartPart(
+            part_num, '"{}"'.format(hashlib.md5(parts[part_num]).hexdigest()))
+
+    def complete_upload(self):
+        _, parts = self.bucket.multipart_uploads.pop(self.id)
+        key = self.bucket.new_key(self.key_name)
+        key.contents = ''.join(parts[n] for n in sorted(parts))
+        self.bucket.keys[self.key_name] = key
+
+    def cancel_upload(self):
+        del self.bucket.multipart_uploads[self.id]
+        self.bucket.cancelled_uploads.append(self.id)
+
+
+class FailingMockMultiPartUpload(MockMultiPartUpload):
+    def upload_part_from_file(self, fp, part_num, md5=None, size=None):
+        if part_num == 2:
+            raise boto.exception.BotoServerError(500, 'unknown reason')
+        return MockMultiPartUpload.upload_part_from_file(
+            self, fp, part_num, md5=md5, size=size)
+
+
+class MockRateLimiter(object):
+    def __init__(self):
+        self.consumed = []
+
+    def consume(self, n):
+        self.consumed.append(n)
+
+
 class MockS3Bucket(object):
 
     key_class = MockS3Key
+    multipart_upload_class = MockMultiPartUpload
 
     def __init__(self, name, keys):
         self.name = name
+        self.multipart_uploads = {}
+        self.part_uploads = []
+        self.part_md5s = {}
+        self.cancelled_uploads = []
         self.keys = dict(
             (key_name, self.key_class(key_name, contents))
             for key_name, contents in keys.iteritems()
@@ -56,12 +142,17 @@ class MockS3Bucket(object):
         for key in self.keys.itervalues():
             key.bucket = self
 
-    def list(self, prefix):
-        return [
-            self.keys[k] for k in self.keys if k.startswith(prefix)
-            ]
+    def list(self, prefix, marker=''):
+        self.listed_prefixes = getattr(self, 'listed_prefixes', [])
+        self.listed_prefixes.append(prefix)
+        self.listed = getattr(self, 'listed', [])
+        for k in sorted(self.keys):
+            if k.startswith(prefix) and k > marker:
+                self.listed.append(k)
+                yield self.keys[k]
 
     def get_key(self, name):
+        self.get_key_count = getattr(self, 'get_key_count', 0) + 1
         return self.keys.get(name)
 
     def new_key(self, name):
@@ -69,6 +160,19 @@ class MockS3Bucket(object):
         key.bucket = self
         return key
 
+    def initiate_multipart_upload(self, key_name):
+        self.upload_count = getattr(self, 'upload_count', 0) + 1
+        upload_id = 'upload-{}'.format(self.upload_count)
+        self.multipart_uploads[upload_id] = (key_name, {})
+        return self.multipart_upload_class(self, key_name, upload_id)
+
+    def get_all_multipart_uploads(self, prefix):
+        return [
+            self.multipart_upload_class(self, key_name, upload_id)
+            for upload_id, (key_name, _) in self.multipart_uploads.items()
+            if key_name.startswith(prefix)
+            ]
+
 
 
 class FailingMockS3Bucket(MockS3Bucket):
@@ -86,7 +190,8 @@ class MockS3Connection(object):
             for bucket_name, keys in buckets.iteritems()
             )
 
-    def get_bucket(self, name):
+    def get_bucket(self, name, validate=True):
+        self.get_bucket_count = getattr(self, 'get_bucket_count', 0) + 1
         if name not in self.buckets:
             raise boto.exception.S3ResponseError(404, 'Bucket not found')
         return self.buckets[name]
@@ -268,6 +373,35 @@ class TestS3UploaderHelpers(unittest.TestCase):
         self.assertEqual(expected_calls, calls)
 
 
+    def test_connect_s3_records_credentials_expiration(self):
+        os_environ = {'AWS_DEFAULT_REGION': 'us-west-2'}
+        get_ec2_metadata, _ = _make_mock_function(
+            {
+                'iam': {
+                    'security-credentials': {
+                        'FOO': {
+                            'AccessKeyId': 'ID',
+                            'SecretAccessKey': 'KEY',
+                            'Token': 'TOKEN',
+                            'Expiration': '2013-07-27T12:00:00Z',
+                            }
+                        }
+                    },
+            })
+
+        class MockConnection(object):
+            pass
+
+        def boto_connect_s3(*args, **kwargs):
+            if len(args) == 0:
+                raise boto.exception.NoAuthHandlerFound
+            return MockConnection()
+
+        actual = logjam.s3_uploader._connect_s3(
+            os_environ, get_ec2_metadata, boto_connect_s3)
+        self.assertEqual(1374926400, actual.credentials_expiration)
+
+
     def test_get_logfile_uri_valid_uri(self):
         upload_uri = 's3://nt8.logs.us-west-2/{prefix}/{year}/{month}/{day}/{filename}'
         filename = 'haproxy-20130727T0100Z-i-34aea3fe.log.gz'
@@ -301,6 +435,29 @@ class TestS3UploaderHelpers(unittest.TestCase):
         self._assert_get_logfile_uri_raises(upload_uri, 'day')
 
 
+    #
+    # test_get_parts_*
+    #
+
+    def test_get_parts(self):
+        self.assertEqual(
+            [(1, 0, 4), (2, 4, 4), (3, 8, 2)],
+            logjam.s3_uploader.get_parts(10, 4)
+            )
+
+    def test_get_parts_exact(self):
+        self.assertEqual(
+            [(1, 0, 5), (2, 5, 5)],
+            logjam.s3_uploader.get_parts(10, 5)
+            )
+
+    def test_get_parts_too_many_parts(self):
+        size = logjam.s3_uploader.MAX_PARTS * 10 + 1
+        parts = logjam.s3_uploader.get_parts(size, 1)
+        self.assertTrue(len(parts) <= logjam.s3_uploader.MAX_PARTS)
+        self.assertEqual(size, sum(length for _, _, length in parts))
+
+
     #
     # test_get_parent_dir_uris_*
     #
@@ -360,7 +517,8 @@ class TestS3Uploader(unittest.TestCase):
     # Helpers
     #
 
-    def _make_uploader(self, upload_uri, buckets, bucket_class=None):
+    def _make_uploader(self, upload_uri, buckets, bucket_class=None,
+                       **kwargs):
         """
         Makes an S3Uploader, bound to a MockS3Connection containing a
         given dict of MockS3Buckets.
@@ -378,14 +536,52 @@ class TestS3Uploader(unittest.TestCase):
         if upload_uri is None:
             upload_uri = 's3://nt8.logs.us-west-2/{prefix}/{year}/{month}/{day}/{filename}'
 
+        def bind_multipart_upload(bucket, key_name, upload_id):
+            return bucket.multipart_upload_class(bucket, key_name, upload_id)
+
         uploader = logjam.s3_uploader.S3Uploader(
             upload_uri,
             connect_s3=connect_s3,
-            storage_uri_for_key=storage_uri_for_key)
+            storage_uri_for_key=storage_uri_for_key,
+            bind_multipart_upload=bind_multipart_upload,
+            **kwargs)
         uploader.connect()
 
         return uploader
 
+    #
+    # test_connect_*
+    #
+
+    def test_connect_keeps_connection(self):
+        connect_s3, calls = _make_mock_function(MockS3Connection({}))
+        uploader = logjam.s3_uploader.S3Uploader(
+            'nt8.logs.us-west-2/{prefix}/{filename}', connect_s3=connect_s3)
+
+        uploader.connect()
+        uploader.connect()
+        self.assertEqual(1, len(calls))
+
+        uploader.disconnect()
+        self.assertIsNone(uploader.s3_conn)
+        uploader.connect()
+        self.assertEqual(2, len(calls))
+
+    def test_connect_refreshes_expiring_credentials(self):
+        s3_conn = MockS3Connection({})
+        connect_s3, calls = _make_mock_function(s3_conn)
+        uploader = logjam.s3_uploader.S3Uploader(
+            'nt8.logs.us-west-2/{prefix}/{filename}', connect_s3=connect_s3)
+
+        s3_conn.credentials_expiration = time.time() + 3600
+        uploader.connect()
+        uploader.connect()
+        self.assertEqual(1, len(calls))
+
+        s3_conn.credentials_expiration = time.time() + 60
+        uploader.connect()
+        self.assertEqual(2, len(calls))
+
     #
     # test_check_uri_*
     #
@@ -397,6 +593,22 @@ class TestS3Uploader(unittest.TestCase):
         actual = uploader.check_uri()
         self.assertEqual(expected, actual)
 
+    def test_check_uri_checks_once(self):
+        uploader = self._make_uploader(None, {'nt8.logs.us-west-2': {}})
+        self.assertIsNone(uploader.check_uri())
+        self.assertIsNone(uploader.check_uri())
+        self.assertEqual(1, uploader.s3_conn.get_bucket_count)
+
+        # The bucket found is cached for uploads.
+        uploader._get_bucket('nt8.logs.us-west-2')
+        self.assertEqual(1, uploader.s3_conn.get_bucket_count)
+
+        # Until we disconnect.
+        uploader.disconnect()
+        uploader.connect()
+        self.assertIsNone(uploader.check_uri())
+        self.assertEqual(2, uploader.s3_conn.get_bucket_count)
+
     def test_check_uri_invalid_uri(self):
         upload_uri = 's3://nt8.logs.us-west-2/{year}/{month}/{day}/'
         uploader = self._make_uploader(upload_uri, {'nt8.logs.us-west-2': {}})
@@ -509,6 +721,162 @@ class TestS3Uploader(unittest.TestCase):
         self.assertEqual(expected_not_uploaded, not_uploaded)
 
 
+    def _make_manifest(self, now):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        store = logjam.state.open_store(temp_dir)
+        self.addCleanup(store.close)
+        return logjam.state.Manifest(store, time_func=lambda: now[0])
+
+    def test_scan_remote_manifest(self):
+        upload_uri = 's3://nt8.logs.us-west-2/{prefix}/{year}/{month}/{day}/{filename}'
+        now = [1000.0]
+        manifest = self._make_manifest(now)
+        uploader = self._make_uploader(
+            upload_uri,
+            {'nt8.logs.us-west-2': {
+                'flask/2013/07/27/flask-20130727T0000Z-i-34aea3fe.log.gz': '1',
+                'flask/2013/07/27/flask-20130727T0000Z-i-99999999.log.gz': '2',
+                }
+            },
+            manifest=manifest,
+            reconcile_interval=100
+            )
+        bucket = uploader.s3_conn.get_bucket('nt8.logs.us-west-2')
+
+        pf = logjam.parse.parse_filename
+        logfiles = [
+            pf('flask-20130727T0000Z-i-34aea3fe.log.gz'),
+            pf('flask-20130727T0100Z-i-34aea3fe.log.gz'),
+            ]
+
+        # The first scan lists the directory ...
+        uploaded, not_uploaded = uploader.scan_remote(logfiles)
+        self.assertEqual(set(logfiles[:1]), uploaded)
+        self.assertEqual(set(logfiles[1:]), not_uploaded)
+        self.assertEqual(
+            ['flask/2013/07/27/flask-20130727T0'], bucket.listed_prefixes)
+
+        # ... and later scans use the manifest, which knows of uploads.
+        error = uploader.upload_logfile(
+            '/does/not/exist/var/log/archive', logfiles[1])
+        self.assertIsNone(error)
+        uploaded, not_uploaded = uploader.scan_remote(logfiles)
+        self.assertEqual(set(logfiles), uploaded)
+        self.assertEqual(set(), not_uploaded)
+        self.assertEqual(
+            ['flask/2013/07/27/flask-20130727T0'], bucket.listed_prefixes)
+
+        # Once the listing is stale, the directory is reconciled.
+        del bucket.keys[
+            'flask/2013/07/27/flask-20130727T0000Z-i-34aea3fe.log.gz']
+        now[0] += 101
+        uploaded, not_uploaded = uploader.scan_remote(logfiles)
+        self.assertEqual(set(logfiles[1:]), uploaded)
+        self.assertEqual(set(logfiles[:1]), not_uploaded)
+        self.assertEqual(
+            ['flask/2013/07/27/flask-20130727T0'] * 2,
+            bucket.listed_prefixes)
+        self.assertEqual(
+            set(['s3://nt8.logs.us-west-2/flask/2013/07/27/'
+                 'flask-20130727T0100Z-i-34aea3fe.log.gz']),
+            manifest.get_uploaded(
+                logjam.s3_uploader.get_logfile_uri(upload_uri, lf)
+                for lf in logfiles))
+
+
+    def test_scan_remote_narrows_listing(self):
+        upload_uri = 's3://nt8.logs.us-west-2/{prefix}/{year}/{month}/{day}/{filename}'
+        uploader = self._make_uploader(
+            upload_uri,
+            {'nt8.logs.us-west-2': {
+                'flask/2013/07/27/flask-20130727T0000Z-i-34aea3fe.log.gz': '1',
+                'flask/2013/07/27/flask-20130727T0000Z-i-99999999.log.gz': '2',
+                'flask/2013/07/27/flask-20130727T1000Z-i-34aea3fe.log.gz': '3',
+                'flask/2013/07/27/flask-20130727T1100Z-i-34aea3fe.log.gz': '4',
+                'flask/2013/07/27/flask-20130727T1200Z-i-34aea3fe.log.gz': '5',
+                'flask/2013/07/27/flask-20130727T1300Z-i-34aea3fe.log.gz': '6',
+                'flask/2013/07/27/flask-20130727T2000Z-i-34aea3fe.log.gz': '7',
+                'flask/2013/07/27/gunicorn-20130727T1100Z-i-34aea3fe.log.gz': '8',
+                }
+            }
+            )
+        bucket = uploader.s3_conn.get_bucket('nt8.logs.us-west-2')
+
+        pf = logjam.parse.parse_filename
+        logfiles = [
+            pf('flask-20130727T1100Z-i-34aea3fe.log.gz'),
+            pf('flask-20130727T1200Z-i-34aea3fe.log.gz'),
+            pf('flask-20130727T1500Z-i-34aea3fe.log.gz'),
+            ]
+
+        uploaded, not_uploaded = uploader.scan_remote(logfiles)
+        self.assertEqual(set(logfiles[:2]), uploaded)
+        self.assertEqual(set(logfiles[2:]), not_uploaded)
+
+        # Only keys from the first logfile on are listed, up to the first
+        # one after the last logfile.
+        self.assertEqual(
+            ['flask/2013/07/27/flask-20130727T1'], bucket.listed_prefixes)
+        self.assertEqual(
+            [
+                'flask/2013/07/27/flask-20130727T1100Z-i-34aea3fe.log.gz',
+                'flask/2013/07/27/flask-20130727T1200Z-i-34aea3fe.log.gz',
+                'flask/2013/07/27/flask-20130727T1300Z-i-34aea3fe.log.gz',
+            ],
+            bucket.listed)
+
+    def test_scan_remote_lists_concurrently(self):
+        upload_uri = 's3://nt8.logs.us-west-2/{prefix}/{year}/{month}/{day}/{filename}'
+        uploader = self._make_uploader(
+            upload_uri,
+            {'nt8.logs.us-west-2': {
+                'flask/2013/07/26/flask-20130726T2300Z-i-34aea3fe.log.gz': '1',
+                'flask/2013/07/27/flask-20130727T0000Z-i-34aea3fe.log.gz': '2',
+                'haproxy/2013/07/27/haproxy-20130727T0000Z-i-34aea3fe.log.gz': '3',
+                }
+            },
+            list_concurrency=3
+            )
+
+        pf = logjam.parse.parse_filename
+        logfiles = [
+            pf('flask-20130726T2300Z-i-34aea3fe.log.gz'),
+            pf('flask-20130727T0000Z-i-34aea3fe.log.gz'),
+            pf('haproxy-20130727T0000Z-i-34aea3fe.log.gz'),
+            pf('haproxy-20130727T0100Z-i-34aea3fe.log.gz'),
+            ]
+
+        uploaded, not_uploaded = uploader.scan_remote(logfiles)
+        self.assertEqual(set(logfiles[:3]), uploaded)
+        self.assertEqual(set(logfiles[3:]), not_uploaded)
+
+    def test_scan_remote_keeps_worker_connections(self):
+        uploader = self._make_uploader(
+            None, {'nt8.logs.us-west-2': {}}, list_concurrency=3)
+        connect_s3, calls = _make_mock_function(uploader.s3_conn)
+        uploader.connect_s3 = connect_s3
+
+        pf = logjam.parse.parse_filename
+        logfiles = [
+            pf('flask-20130726T2300Z-i-34aea3fe.log.gz'),
+            pf('flask-20130727T0000Z-i-34aea3fe.log.gz'),
+            pf('haproxy-20130727T0000Z-i-34aea3fe.log.gz'),
+            ]
+        uploader.scan_remote(logfiles)
+        connected = len(calls)
+        self.assertTrue(1 <= connected <= 3)
+
+        # The next cycle's list threads reuse those connections.
+        uploader.scan_remote(logfiles)
+        self.assertEqual(connected, len(calls))
+
+        # Unless their credentials are about to expire.
+        uploader.s3_conn.credentials_expiration = time.time() + 60
+        uploader.scan_remote(logfiles)
+        self.assertGreater(len(calls), connected)
+
+
     #
     # test_upload_logfile_*
     #
@@ -563,6 +931,53 @@ class TestS3Uploader(unittest.TestCase):
         self.assertEqual(expected_key_contents, key.contents)
 
 
+    def test_upload_logfile_trust_scan(self):
+        upload_uri = 's3://nt8.logs.us-west-2/{prefix}/{year}/{month}/{day}/{filename}'
+        uploader = self._make_uploader(
+            upload_uri, {'nt8.logs.us-west-2': {}}, trust_scan=True
+            )
+
+        pf = logjam.parse.parse_filename
+        logfile = pf('flask-20130727T0000Z-i-34aea3fe.log.gz')
+        log_archive_dir = '/does/not/exist/var/log/archive'
+
+        error = uploader.upload_logfile(log_archive_dir, logfile)
+        self.assertIsNone(error)
+
+        bucket = uploader.s3_conn.get_bucket('nt8.logs.us-west-2')
+        self.assertEqual(0, getattr(bucket, 'get_key_count', 0))
+        key = bucket.keys[
+            'flask/2013/07/27/flask-20130727T0000Z-i-34aea3fe.log.gz']
+        self.assertEqual({'If-None-Match': '*'}, key.headers)
+
+
+    def test_upload_logfile_trust_scan_exists_already(self):
+        upload_uri = 's3://nt8.logs.us-west-2/{prefix}/{year}/{month}/{day}/{filename}'
+        uploader = self._make_uploader(
+            upload_uri,
+            {'nt8.logs.us-west-2': {
+                'flask/2013/07/27/flask-20130727T0000Z-i-34aea3fe.log.gz': 'SOMETHING ELSE'
+                }
+            },
+            trust_scan=True
+            )
+
+        pf = logjam.parse.parse_filename
+        logfile = pf('flask-20130727T0000Z-i-34aea3fe.log.gz')
+        log_archive_dir = '/does/not/exist/var/log/archive'
+
+        error = uploader.upload_logfile(log_archive_dir, logfile)
+        self.assertIsNone(error)
+
+        bucket = uploader.s3_conn.get_bucket('nt8.logs.us-west-2')
+        self.assertEqual(0, getattr(bucket, 'get_key_count', 0))
+        self.assertEqual(
+            'SOMETHING ELSE',
+            bucket.keys[
+                'flask/2013/07/27/flask-20130727T0000Z-i-34aea3fe.log.gz'
+                ].contents)
+
+
     def test_upload_logfile_upload_fails(self):
         upload_uri = 's3://nt8.logs.us-west-2/{prefix}/{year}/{month}/{day}/{filename}'
         uploader = self._make_uploader(
@@ -579,3 +994,416 @@ class TestS3Uploader(unittest.TestCase):
 
         error = uploader.upload_logfile(log_archive_dir, logfile)
         self.assertIsInstance(error, boto.exception.BotoServerError)
+
+
+    def _make_archive(self, filename, contents):
+        log_archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_archive_dir)
+        with open(os.path.join(log_archive_dir, filename), 'w') as f:
+            f.write(contents)
+        return log_archive_dir
+
+    def _get_multipart_state(self, uploader):
+        self.addCleanup(uploader.multipart_state.store.close)
+        return uploader.multipart_state
+
+    def test_upload_logfile_multipart(self):
+        upload_uri = 's3://nt8.logs.us-west-2/{prefix}/{year}/{month}/{day}/{filename}'
+        uploader = self._make_uploader(
+            upload_uri, {'nt8.logs.us-west-2': {}},
+            multipart_threshold=10, part_size=4, part_concurrency=2
+            )
+
+        logfile = logjam.parse.parse_filename(
+            'flask-20130727T0000Z-i-34aea3fe.log.gz')
+        contents = '0123456789abcdefghij'
+        log_archive_dir = self._make_archive(logfile.filename, contents)
+
+        error = uploader.upload_logfile(log_archive_dir, logfile)
+        self.assertIsNone(error)
+        mp_state = self._get_multipart_state(uploader)
+
+        bucket = uploader.s3_conn.get_bucket('nt8.logs.us-west-2')
+        key = bucket.get_key(
+            'flask/2013/07/27/flask-20130727T0000Z-i-34aea3fe.log.gz')
+        self.assertEqual(contents, key.contents)
+        self.assertEqual({}, bucket.multipart_uploads)
+        self.assertIsNone(mp_state.get('nt8.logs.us-west-2', key.name))
+
+    def test_upload_logfile_multipart_from_bundle_dir(self):
+        uploader = self._make_uploader(
+            None, {'nt8.logs.us-west-2': {}},
+            multipart_threshold=10, part_size=4, part_concurrency=2
+            )
+        logfile = logjam.parse.parse_filename(
+            'flask-20130727T0000Z-i-34aea3fe.log.gz')
+        log_archive_dir = self._make_archive('unused', '')
+        bundle_dir = logjam.bundle.Bundler().get_bundle_dir(log_archive_dir)
+        os.makedirs(bundle_dir)
+        with open(os.path.join(bundle_dir, logfile.filename), 'w') as f:
+            f.write('0123456789abcdefghij')
+
+        # Progress is kept with the archive directory's, not in a new
+        # state directory within the bundles directory.
+        self.assertIsNone(uploader.upload_logfile(bundle_dir, logfile))
+        mp_state = self._get_multipart_state(uploader)
+        self.assertEqual(
+            logjam.state.store_path(log_archive_dir), mp_state.store.path)
+        self.assertEqual([logfile.filename], os.listdir(bundle_dir))
+
+    def test_upload_logfile_multipart_below_threshold(self):
+        upload_uri = 's3://nt8.logs.us-west-2/{prefix}/{year}/{month}/{day}/{filename}'
+        uploader = self._make_uploader(
+            upload_uri, {'nt8.logs.us-west-2': {}},
+            multipart_threshold=100, part_size=4
+            )
+
+        logfile = logjam.parse.parse_filename(
+            'flask-20130727T0000Z-i-34aea3fe.log.gz')
+        log_archive_dir = self._make_archive(logfile.filename, 'foo')
+
+        error = uploader.upload_logfile(log_archive_dir, logfile)
+        self.assertIsNone(error)
+
+        key = uploader.s3_conn.get_bucket('nt8.logs.us-west-2').get_key(
+            'flask/2013/07/27/flask-20130727T0000Z-i-34aea3fe.log.gz')
+        self.assertEqual(
+            'file:{}'.format(
+                os.path.join(log_archive_dir, logfile.filename)),
+            key.contents)
+
+    def test_upload_logfile_multipart_fails_then_resumes(self):
+        upload_uri = 's3://nt8.logs.us-west-2/{prefix}/{year}/{month}/{day}/{filename}'
+        key_name = 'flask/2013/07/27/flask-20130727T0000Z-i-34aea3fe.log.gz'
+        uploader = self._make_uploader(
+            upload_uri, {'nt8.logs.us-west-2': {}},
+            multipart_threshold=10, part_size=4, part_concurrency=1
+            )
+        bucket = uploader.s3_conn.get_bucket('nt8.logs.us-west-2')
+        bucket.multipart_upload_class = FailingMockMultiPartUpload
+
+        logfile = logjam.parse.parse_filename(
+            'flask-20130727T0000Z-i-34aea3fe.log.gz')
+        contents = '0123456789abcdefghij'
+        log_archive_dir = self._make_archive(logfile.filename, contents)
+
+        error = uploader.upload_logfile(log_archive_dir, logfile)
+        self.assertIsInstance(error, boto.exception.BotoServerError)
+
+        # The upload is kept, with its completed parts, to be resumed.
+        self.assertIsNone(bucket.get_key(key_name))
+        self.assertEqual([], bucket.cancelled_uploads)
+        mp_state = self._get_multipart_state(uploader)
+        record = mp_state.get('nt8.logs.us-west-2', key_name)
+        self.assertEqual('upload-1', record.upload_id)
+        self.assertEqual([1, 3, 4, 5], sorted(record.etags))
+
+        # As by a restarted daemon, with a fresh uploader.
+        bucket.multipart_upload_class = MockMultiPartUpload
+        del bucket.part_uploads[:]
+        uploader = uploader.clone()
+        uploader.connect()
+        error = uploader.upload_logfile(log_archive_dir, logfile)
+        self.assertIsNone(error)
+
+        self.assertEqual([2], bucket.part_uploads)
+        self.assertEqual(contents, bucket.get_key(key_name).contents)
+        self.assertEqual({}, bucket.multipart_uploads)
+        self.assertIsNone(mp_state.get('nt8.logs.us-west-2', key_name))
+
+    def test_upload_logfile_multipart_cancels_stale_uploads(self):
+        upload_uri = 's3://nt8.logs.us-west-2/{prefix}/{year}/{month}/{day}/{filename}'
+        key_name = 'flask/2013/07/27/flask-20130727T0000Z-i-34aea3fe.log.gz'
+        uploader = self._make_uploader(
+            upload_uri, {'nt8.logs.us-west-2': {}},
+            multipart_threshold=10, part_size=4
+            )
+        bucket = uploader.s3_conn.get_bucket('nt8.logs.us-west-2')
+
+        # Left behind by an uploader that lost its state.
+        bucket.initiate_multipart_upload(key_name)
+        bucket.initiate_multipart_upload(key_name + '.other')
+
+        logfile = logjam.parse.parse_filename(
+            'flask-20130727T0000Z-i-34aea3fe.log.gz')
+        contents = '0123456789abcdefghij'
+        log_archive_dir = self._make_archive(logfile.filename, contents)
+
+        error = uploader.upload_logfile(log_archive_dir, logfile)
+        self.assertIsNone(error)
+        self._get_multipart_state(uploader)
+
+        self.assertEqual(['upload-1'], bucket.cancelled_uploads)
+        self.assertEqual(['upload-2'], list(bucket.multipart_uploads))
+        self.assertEqual(contents, bucket.get_key(key_name).contents)
+
+    def test_upload_logfile_multipart_restarts_changed_file(self):
+        upload_uri = 's3://nt8.logs.us-west-2/{prefix}/{year}/{month}/{day}/{filename}'
+        key_name = 'flask/2013/07/27/flask-20130727T0000Z-i-34aea3fe.log.gz'
+        uploader = self._make_uploader(
+            upload_uri, {'nt8.logs.us-west-2': {}},
+            multipart_threshold=10, part_size=4
+            )
+        bucket = uploader.s3_conn.get_bucket('nt8.logs.us-west-2')
+        bucket.multipart_upload_class = FailingMockMultiPartUpload
+
+        logfile = logjam.parse.parse_filename(
+            'flask-20130727T0000Z-i-34aea3fe.log.gz')
+        log_archive_dir = self._make_archive(
+            logfile.filename, '0123456789abcdefghij')
+        error = uploader.upload_logfile(log_archive_dir, logfile)
+        self.assertIsInstance(error, boto.exception.BotoServerError)
+        self._get_multipart_state(uploader)
+
+        contents = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+        with open(os.path.join(log_archive_dir, logfile.filename), 'w') as f:
+            f.write(contents)
+        bucket.multipart_upload_class = MockMultiPartUpload
+        error = uploader.upload_logfile(log_archive_dir, logfile)
+        self.assertIsNone(error)
+
+        self.assertEqual(['upload-1'], bucket.cancelled_uploads)
+        self.assertEqual(contents, bucket.get_key(key_name).contents)
+
+
+    def _put_checksum(self, log_archive_dir, filename, part_size):
+        path = os.path.join(log_archive_dir, filename)
+        with open(path, 'rb') as f:
+            contents = f.read()
+        store = logjam.state.open_store(log_archive_dir)
+        self.addCleanup(store.close)
+        checksum = logjam.state.Checksum(
+            len(contents),
+            os.stat(path).st_mtime,
+            hashlib.md5(contents).hexdigest(),
+            part_size,
+            [
+                hashlib.md5(contents[i:i + part_size]).hexdigest()
+                for i in range(0, len(contents), part_size)
+                ]
+            )
+        logjam.state.ChecksumStore(store).put(filename, checksum)
+        return checksum
+
+    def test_upload_logfile_uses_checksum(self):
+        upload_uri = 's3://nt8.logs.us-west-2/{prefix}/{year}/{month}/{day}/{filename}'
+        uploader = self._make_uploader(upload_uri, {'nt8.logs.us-west-2': {}})
+
+        logfile = logjam.parse.parse_filename(
+            'flask-20130727T0000Z-i-34aea3fe.log.gz')
+        log_archive_dir = self._make_archive(logfile.filename, 'foo')
+        self._put_checksum(log_archive_dir, logfile.filename, 4)
+        self.addCleanup(lambda: uploader.checksums.store.close())
+
+        error = uploader.upload_logfile(log_archive_dir, logfile)
+        self.assertIsNone(error)
+
+        key = uploader.s3_conn.get_bucket('nt8.logs.us-west-2').get_key(
+            'flask/2013/07/27/flask-20130727T0000Z-i-34aea3fe.log.gz')
+        self.assertEqual(
+            ('acbd18db4cc2f85cedef654fccc4a4d8', 'rL0Y20zC+Fzt72VPzMSk2A=='),
+            key.md5)
+
+        # Once uploaded, the checksum is forgotten.
+        self.assertIsNone(uploader.checksums.get(logfile.filename))
+
+    def test_upload_logfile_ignores_stale_checksum(self):
+        upload_uri = 's3://nt8.logs.us-west-2/{prefix}/{year}/{month}/{day}/{filename}'
+        uploader = self._make_uploader(upload_uri, {'nt8.logs.us-west-2': {}})
+
+        logfile = logjam.parse.parse_filename(
+            'flask-20130727T0000Z-i-34aea3fe.log.gz')
+        log_archive_dir = self._make_archive(logfile.filename, 'foo')
+        self._put_checksum(log_archive_dir, logfile.filename, 4)
+        self.addCleanup(lambda: uploader.checksums.store.close())
+        with open(os.path.join(log_archive_dir, logfile.filename), 'a') as f:
+            f.write('bar')
+
+        error = uploader.upload_logfile(log_archive_dir, logfile)
+        self.assertIsNone(error)
+
+        key = uploader.s3_conn.get_bucket('nt8.logs.us-west-2').get_key(
+            'flask/2013/07/27/flask-20130727T0000Z-i-34aea3fe.log.gz')
+        self.assertIsNone(key.md5)
+
+    def test_upload_logfile_multipart_uses_part_checksums(self):
+        upload_uri = 's3://nt8.logs.us-west-2/{prefix}/{year}/{month}/{day}/{filename}'
+        uploader = self._make_uploader(
+            upload_uri, {'nt8.logs.us-west-2': {}},
+            multipart_threshold=10, part_size=4
+            )
+
+        logfile = logjam.parse.parse_filename(
+            'flask-20130727T0000Z-i-34aea3fe.log.gz')
+        log_archive_dir = self._make_archive(
+            logfile.filename, '0123456789')
+        checksum = self._put_checksum(log_archive_dir, logfile.filename, 4)
+        self.addCleanup(lambda: uploader.checksums.store.close())
+
+        error = uploader.upload_logfile(log_archive_dir, logfile)
+        self.assertIsNone(error)
+        self._get_multipart_state(uploader)
+
+        bucket = uploader.s3_conn.get_bucket('nt8.logs.us-west-2')
+        self.assertEqual(
+            dict(
+                (n, logjam.s3_uploader._md5_arg(md5))
+                for n, md5 in enumerate(checksum.part_md5s, 1)
+                ),
+            bucket.part_md5s)
+
+
+    #
+    # test_open_stream_*
+    #
+
+    def test_open_stream_single_put(self):
+        upload_uri = 's3://nt8.logs.us-west-2/{prefix}/{year}/{month}/{day}/{filename}'
+        uploader = self._make_uploader(
+            upload_uri, {'nt8.logs.us-west-2': {}}, part_size=10)
+        logfile = logjam.parse.parse_filename(
+            'flask-20130727T0000Z-i-34aea3fe.log.gz')
+
+        stream = uploader.open_stream(logfile)
+        stream.write('foo')
+        stream.write(buffer('bar'))
+        self.assertIsNone(stream.close())
+
+        bucket = uploader.s3_conn.get_bucket('nt8.logs.us-west-2')
+        key = bucket.get_key(
+            'flask/2013/07/27/flask-20130727T0000Z-i-34aea3fe.log.gz')
+        self.assertEqual('foobar', key.contents)
+        self.assertEqual({}, bucket.multipart_uploads)
+
+    def test_open_stream_multipart(self):
+        upload_uri = 's3://nt8.logs.us-west-2/{prefix}/{year}/{month}/{day}/{filename}'
+        uploader = self._make_uploader(
+            upload_uri, {'nt8.logs.us-west-2': {}},
+            part_size=4, part_concurrency=2)
+        logfile = logjam.parse.parse_filename(
+            'flask-20130727T0000Z-i-34aea3fe.log.gz')
+
+        stream = uploader.open_stream(logfile)
+        contents = '0123456789abcdefghij'
+        for i in range(0, len(contents), 3):
+            stream.write(contents[i:i + 3])
+        self.assertIsNone(stream.close())
+
+        bucket = uploader.s3_conn.get_bucket('nt8.logs.us-west-2')
+        key = bucket.get_key(
+            'flask/2013/07/27/flask-20130727T0000Z-i-34aea3fe.log.gz')
+        self.assertEqual(contents, key.contents)
+        self.assertEqual({}, bucket.multipart_uploads)
+        self.assertEqual([1, 2, 3, 4], sorted(bucket.part_uploads))
+
+    def test_open_stream_part_fails(self):
+        upload_uri = 's3://nt8.logs.us-west-2/{prefix}/{year}/{month}/{day}/{filename}'
+
+        class FailingMultipartBucket(MockS3Bucket):
+            multipart_upload_class = FailingMockMultiPartUpload
+
+        uploader = self._make_uploader(
+            upload_uri, {'nt8.logs.us-west-2': {}},
+            bucket_class=FailingMultipartBucket,
+            part_size=4, part_concurrency=1)
+        logfile = logjam.parse.parse_filename(
+            'flask-20130727T0000Z-i-34aea3fe.log.gz')
+
+        stream = uploader.open_stream(logfile)
+        with self.assertRaises(IOError):
+            for i in range(10):
+                stream.write('0123')
+        stream.cancel()
+
+        bucket = uploader.s3_conn.get_bucket('nt8.logs.us-west-2')
+        self.assertEqual({}, bucket.multipart_uploads)
+        self.assertEqual(['upload-1'], bucket.cancelled_uploads)
+        self.assertIsNone(bucket.get_key(
+            'flask/2013/07/27/flask-20130727T0000Z-i-34aea3fe.log.gz'))
+
+    #
+    # test_*_rate_limited
+    #
+
+    def test_upload_logfile_rate_limited(self):
+        limiter = MockRateLimiter()
+        uploader = self._make_uploader(
+            None, {'nt8.logs.us-west-2': {}}, rate_limiter=limiter)
+        logfile = logjam.parse.parse_filename(
+            'flask-20130727T0000Z-i-34aea3fe.log.gz')
+        contents = '0123456789'
+        log_archive_dir = self._make_archive(logfile.filename, contents)
+
+        self.assertIsNone(uploader.upload_logfile(log_archive_dir, logfile))
+
+        key = uploader.s3_conn.get_bucket('nt8.logs.us-west-2').get_key(
+            'flask/2013/07/27/flask-20130727T0000Z-i-34aea3fe.log.gz')
+        self.assertEqual(contents, key.contents)
+        self.assertEqual(hashlib.md5(contents).hexdigest(), key.md5[0])
+        # Read once, through the limiter (and once more, to EOF).
+        self.assertEqual(len(contents), sum(limiter.consumed))
+
+    def test_upload_logfile_multipart_rate_limited(self):
+        limiter = MockRateLimiter()
+        uploader = self._make_uploader(
+            None, {'nt8.logs.us-west-2': {}}, rate_limiter=limiter,
+            multipart_threshold=10, part_size=4, part_concurrency=2)
+        logfile = logjam.parse.parse_filename(
+            'flask-20130727T0000Z-i-34aea3fe.log.gz')
+        contents = '0123456789abcdefghij'
+        log_archive_dir = self._make_archive(logfile.filename, contents)
+
+        self.assertIsNone(uploader.upload_logfile(log_archive_dir, logfile))
+        self._get_multipart_state(uploader)
+
+        bucket = uploader.s3_conn.get_bucket('nt8.logs.us-west-2')
+        key = bucket.get_key(
+            'flask/2013/07/27/flask-20130727T0000Z-i-34aea3fe.log.gz')
+        self.assertEqual(contents, key.contents)
+        self.assertEqual(hashlib.md5('0123').hexdigest(),
+                         bucket.part_md5s[1][0])
+        self.assertEqual(len(contents), sum(limiter.consumed))
+
+    def test_open_stream_rate_limited(self):
+        limiter = MockRateLimiter()
+        uploader = self._make_uploader(
+            None, {'nt8.logs.us-west-2': {}}, rate_limiter=limiter,
+            part_size=4, part_concurrency=2)
+        logfile = logjam.parse.parse_filename(
+            'flask-20130727T0000Z-i-34aea3fe.log.gz')
+
+        stream = uploader.open_stream(logfile)
+        contents = '0123456789abcdefghij'
+        for i in range(0, len(contents), 3):
+            stream.write(contents[i:i + 3])
+        self.assertIsNone(stream.close())
+
+        key = uploader.s3_conn.get_bucket('nt8.logs.us-west-2').get_key(
+            'flask/2013/07/27/flask-20130727T0000Z-i-34aea3fe.log.gz')
+        self.assertEqual(contents, key.contents)
+        self.assertEqual(len(contents), sum(limiter.consumed))
+
+    #
+    # test_clone_*
+    #
+
+    def test_clone_makes_own_connection(self):
+        upload_uri = 's3://nt8.logs.us-west-2/{prefix}/{year}/{month}/{day}/{filename}'
+        uploader = self._make_uploader(upload_uri, {'nt8.logs.us-west-2': {}})
+
+        clone = uploader.clone()
+        self.assertEqual(upload_uri, clone.upload_uri)
+        self.assertIs(uploader.connect_s3, clone.connect_s3)
+        self.assertIs(
+            uploader.storage_uri_for_key, clone.storage_uri_for_key)
+        self.assertIsNone(clone.s3_conn)
+
+        clone.connect()
+        self.assertIsNotNone(clone.s3_conn)
+        self.assertIsNot(uploader.bucket_cache, clone.bucket_cache)
+
+    def test_clone_shares_rate_limiter(self):
+        limiter = MockRateLimiter()
+        uploader = self._make_uploader(
+            None, {'nt8.logs.us-west-2': {}}, rate_limiter=limiter)
+        self.assertIs(limiter, uploader.clone().rate_limiter)
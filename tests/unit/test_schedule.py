@@ -0,0 +1,123 @@
+""" tests for logjam.schedule """
+
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import logjam.parse
+import logjam.schedule
+
+
+FILENAMES = [
+    'flask-20130727T0000Z.log.gz',
+    'flask-20130727T0100Z.log.gz',
+    'flask-20130727T0200Z.log.gz',
+    'haproxy-20130727T0000Z.log.gz',
+    'haproxy-20130727T0100Z.log.gz',
+]
+
+
+class TestSchedule(unittest.TestCase):
+
+    def setUp(self):
+        self.log_archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.log_archive_dir)
+        sizes = [30, 10, 20, 5, 50]
+        for filename, size in zip(FILENAMES, sizes):
+            with open(os.path.join(self.log_archive_dir, filename),
+                      'wb') as f:
+                f.write('x' * size)
+        self.logfiles = set(map(logjam.parse.parse_filename, FILENAMES))
+
+    def _order(self, scheduler, logfiles=None):
+        if logfiles is None:
+            logfiles = self.logfiles
+        return [
+            lf.filename
+            for lf in scheduler.order(self.log_archive_dir, logfiles)
+        ]
+
+    #
+    # test_order_*
+    #
+
+    def test_order_oldest(self):
+        self.assertEqual([
+            'flask-20130727T0000Z.log.gz',
+            'haproxy-20130727T0000Z.log.gz',
+            'flask-20130727T0100Z.log.gz',
+            'haproxy-20130727T0100Z.log.gz',
+            'flask-20130727T0200Z.log.gz',
+        ], self._order(logjam.schedule.Scheduler('oldest')))
+
+    def test_order_newest(self):
+        self.assertEqual([
+            'flask-20130727T0200Z.log.gz',
+            'flask-20130727T0100Z.log.gz',
+            'haproxy-20130727T0100Z.log.gz',
+            'flask-20130727T0000Z.log.gz',
+            'haproxy-20130727T0000Z.log.gz',
+        ], self._order(logjam.schedule.Scheduler('newest')))
+
+    def test_order_smallest(self):
+        self.assertEqual([
+            'haproxy-20130727T0000Z.log.gz',
+            'flask-20130727T0100Z.log.gz',
+            'flask-20130727T0200Z.log.gz',
+            'flask-20130727T0000Z.log.gz',
+            'haproxy-20130727T0100Z.log.gz',
+        ], self._order(logjam.schedule.Scheduler('smallest')))
+
+    def test_order_smallest_missing_file(self):
+        os.unlink(os.path.join(self.log_archive_dir, FILENAMES[2]))
+        actual = self._order(logjam.schedule.Scheduler('smallest'))
+        self.assertEqual(FILENAMES[2], actual[0])
+
+    def test_order_by_prefix(self):
+        scheduler = logjam.schedule.Scheduler(
+            'oldest', {'haproxy': 'smallest'})
+        self.assertEqual([
+            'flask-20130727T0000Z.log.gz',
+            'haproxy-20130727T0000Z.log.gz',
+            'flask-20130727T0100Z.log.gz',
+            'haproxy-20130727T0100Z.log.gz',
+            'flask-20130727T0200Z.log.gz',
+        ], self._order(scheduler))
+
+        scheduler = logjam.schedule.Scheduler(
+            'oldest', {'flask': 'newest', 'haproxy': 'newest'})
+        self.assertEqual(
+            self._order(logjam.schedule.Scheduler('newest')),
+            self._order(scheduler))
+
+    def test_order_by_prefix_takes_turns(self):
+        scheduler = logjam.schedule.Scheduler('newest', {'flask': 'oldest'})
+        self.assertEqual([
+            'flask-20130727T0000Z.log.gz',
+            'haproxy-20130727T0100Z.log.gz',
+            'flask-20130727T0100Z.log.gz',
+            'haproxy-20130727T0000Z.log.gz',
+            'flask-20130727T0200Z.log.gz',
+        ], self._order(scheduler))
+
+    def test_order_no_logfiles(self):
+        self.assertEqual([], self._order(logjam.schedule.Scheduler(), []))
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            logjam.schedule.Scheduler('largest')
+        with self.assertRaises(ValueError):
+            logjam.schedule.Scheduler('oldest', {'flask': 'largest'})
+
+    #
+    # test_parse_prefix_policy_*
+    #
+
+    def test_parse_prefix_policy(self):
+        self.assertEqual(
+            ('flask', 'newest'),
+            logjam.schedule.parse_prefix_policy('flask=newest'))
+        for arg in ('flask', '=newest', 'flask=largest', 'flask='):
+            with self.assertRaises(ValueError):
+                logjam.schedule.parse_prefix_policy(arg)
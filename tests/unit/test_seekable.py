@@ -0,0 +1,152 @@
+""" tests for logjam.seekable """
+
+import contextlib
+import gzip
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import logjam.compress
+import logjam.parse
+import logjam.s3_uploader
+import logjam.seekable
+
+
+@contextlib.contextmanager
+def temporary_directory():
+    tempdir = None
+    try:
+        tempdir = tempfile.mkdtemp()
+        yield tempdir
+    finally:
+        if tempdir and os.path.isdir(tempdir):
+            shutil.rmtree(tempdir)
+
+
+def make_lines(minutes):
+    return [
+        '2013-07-27T14:{:02d}:00 GET /{}\n'.format(m, m)
+        for m in range(minutes)
+    ]
+
+
+class TestSeekable(unittest.TestCase):
+
+    #
+    # Helpers
+    #
+
+    def _compress(self, temp_dir, contents, block_size=100):
+        log_path = os.path.join(temp_dir, 'haproxy-20130727T1400Z.log')
+        with open(log_path, 'w') as f:
+            f.write(contents)
+        archive_dir = os.path.join(temp_dir, 'archive')
+        os.mkdir(archive_dir)
+
+        engine = logjam.seekable.BlockEngine(
+            logjam.compress.gzip_compressobj, block_size=block_size)
+        dst_path = logjam.compress.compress_path(
+            log_path, engine, '.gz', archive_dir)
+        with open(dst_path + logjam.seekable.INDEX_EXTENSION) as f:
+            index = logjam.seekable.load_index(f)
+        return dst_path, index
+
+    #
+    # test_block_engine_*
+    #
+
+    def test_block_engine_archive_and_index(self):
+        lines = make_lines(10)
+        with temporary_directory() as temp_dir:
+            dst_path, index = self._compress(temp_dir, ''.join(lines))
+
+            self.assertEqual(
+                sorted([
+                    'haproxy-20130727T1400Z.log.gz',
+                    'haproxy-20130727T1400Z.log.gz.idx',
+                ]),
+                sorted(os.listdir(os.path.dirname(dst_path)))
+            )
+
+            # The archive is readable by plain gzip...
+            with gzip.GzipFile(dst_path) as f:
+                self.assertEqual(''.join(lines), f.read())
+
+            # ... and blocks start on line boundaries.
+            blocks = index['blocks']
+            self.assertTrue(len(blocks) > 1)
+            self.assertEqual([0, 0, '2013-07-27T14:00:00'], blocks[0])
+            for _, uncompressed_offset, timestamp in blocks:
+                line_number = ''.join(lines)[:uncompressed_offset].count(
+                    '\n')
+                self.assertEqual(
+                    '2013-07-27T14:{:02d}:00'.format(line_number),
+                    timestamp)
+
+    def test_block_engine_empty_logfile(self):
+        with temporary_directory() as temp_dir:
+            dst_path, index = self._compress(temp_dir, '')
+            self.assertEqual([], index['blocks'])
+            with gzip.GzipFile(dst_path) as f:
+                self.assertEqual('', f.read())
+
+    def test_block_engine_invalid_pattern(self):
+        with self.assertRaisesRegexp(ValueError, 'lacks groups: second$'):
+            logjam.seekable.BlockEngine(
+                logjam.compress.gzip_compressobj,
+                timestamp_pattern=(
+                    r'(?P<year>\d{4})(?P<month>\d\d)(?P<day>\d\d)'
+                    r'(?P<hour>\d\d)(?P<minute>\d\d)'
+                )
+            )
+
+    #
+    # test_select_blocks_*, test_read_window_*
+    #
+
+    def test_select_blocks(self):
+        index = {'blocks': [
+            [0, 0, '2013-07-27T14:00:00'],
+            [10, 100, None],
+            [20, 200, '2013-07-27T14:30:00'],
+            [30, 300, '2013-07-27T14:45:00'],
+        ]}
+        select_blocks = logjam.seekable.select_blocks
+        self.assertEqual(
+            (1, 2),
+            select_blocks(
+                index, '2013-07-27T14:20:00', '2013-07-27T14:40:00'))
+        self.assertEqual(
+            (3, 3),
+            select_blocks(
+                index, '2013-07-27T14:50:00', '2013-07-27T15:00:00'))
+        self.assertIsNone(
+            select_blocks(
+                index, '2013-07-27T13:00:00', '2013-07-27T14:00:00'))
+
+    def test_read_window(self):
+        lines = make_lines(60)
+        with temporary_directory() as temp_dir:
+            dst_path, index = self._compress(temp_dir, ''.join(lines))
+            with open(dst_path, 'rb') as f:
+                actual = list(logjam.seekable.read_window(
+                    f, index, '2013-07-27T14:37:00', '2013-07-27T14:43:00'))
+        self.assertEqual(lines[37:43], actual)
+
+    #
+    # The sidecar is uploaded next to its archive.
+    #
+
+    def test_index_uploaded_next_to_archive(self):
+        upload_uri = 's3://logs/{prefix}/{year}/{month}/{day}/{filename}'
+        archive, index = [
+            logjam.s3_uploader.get_logfile_uri(
+                upload_uri, logjam.parse.parse_filename(filename))
+            for filename in (
+                'haproxy-20130727T1400Z-i-34aea3fe.log.gz',
+                'haproxy-20130727T1400Z-i-34aea3fe.log.gz.idx',
+            )
+        ]
+        self.assertEqual(archive + logjam.seekable.INDEX_EXTENSION, index)
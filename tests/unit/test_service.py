@@ -0,0 +1,49 @@
+""" tests for logjam.service """
+
+import time
+import unittest
+
+import logjam.service
+
+
+class StopService(Exception):
+    pass
+
+
+class TestService(unittest.TestCase):
+
+    #
+    # test_do_on_change_*
+    #
+
+    def test_do_on_change_runs_on_change_and_interval(self):
+        calls = []
+        def do_func(*args, **kwargs):
+            calls.append((args, kwargs))
+            if len(calls) == 3:
+                raise StopService
+
+        # One change, then nothing until the interval elapses.
+        changes = [True]
+        timeouts = []
+        def wait_for_change(timeout):
+            timeouts.append(timeout)
+            if timeout == 0:
+                return False
+            if changes:
+                return changes.pop(0)
+            time.sleep(timeout)
+            return False
+
+        orig_min_change_interval = logjam.service.MIN_CHANGE_INTERVAL
+        logjam.service.MIN_CHANGE_INTERVAL = 0
+        try:
+            with self.assertRaises(StopService):
+                logjam.service.do_on_change(
+                    do_func, wait_for_change, 0.01, 'a', b='b')
+        finally:
+            logjam.service.MIN_CHANGE_INTERVAL = orig_min_change_interval
+
+        self.assertEqual([(('a',), {'b': 'b'})] * 3, calls)
+        # The change was followed by a non-blocking drain.
+        self.assertEqual(0, timeouts[1])
@@ -0,0 +1,259 @@
+""" tests for logjam.ship """
+
+import contextlib
+import gzip
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+import boto.exception
+
+import logjam.compress
+import logjam.s3_uploader
+import logjam.ship
+import logjam.state
+
+
+@contextlib.contextmanager
+def temporary_directory():
+    tempdir = None
+    try:
+        tempdir = tempfile.mkdtemp()
+        yield tempdir
+    finally:
+        if tempdir and os.path.isdir(tempdir):
+            shutil.rmtree(tempdir)
+
+
+#
+# Mocks
+#
+
+class MockStream(object):
+    def __init__(self, uploader, logfile):
+        self.uploader = uploader
+        self.logfile = logfile
+        self.buf = StringIO.StringIO()
+
+    def write(self, data):
+        self.buf.write(data)
+
+    def close(self):
+        if self.uploader.fail:
+            return IOError('upload failed')
+        self.uploader.uploaded[self.logfile.filename] = self.buf.getvalue()
+
+    def cancel(self):
+        self.uploader.cancelled.append(self.logfile.filename)
+
+
+class MockStreamUploader(object):
+    """ Mocks the open_stream() of logjam.base_uploader.BaseUploader. """
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.uploaded = {}
+        self.cancelled = []
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def check_uri(self):
+        pass
+
+    def open_stream(self, logfile):
+        return MockStream(self, logfile)
+
+
+class FlakyMockS3Key(object):
+    """ Mocks boto.s3.key.Key, failing its bucket's first PUT. """
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def set_contents_from_string(self, contents):
+        self.bucket.puts += 1
+        if self.bucket.puts == 1:
+            raise boto.exception.BotoServerError(500, 'unknown reason')
+        self.bucket.keys[self.name] = contents
+
+
+class FlakyMockS3Bucket(object):
+    def __init__(self, name):
+        self.name = name
+        self.keys = {}
+        self.puts = 0
+
+    def new_key(self, name):
+        return FlakyMockS3Key(self, name)
+
+
+class MockS3Connection(object):
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def get_bucket(self, name, validate=True):
+        return self.bucket
+
+
+class TestShip(unittest.TestCase):
+
+    #
+    # Helpers
+    #
+
+    def _gunzip(self, data):
+        return gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
+
+    def _make_logfile(self, log_dir, filename, contents):
+        path = os.path.join(log_dir, filename)
+        with open(path, 'w') as f:
+            f.write(contents)
+        return path
+
+    def _make_journal(self, archive_dir):
+        os.mkdir(archive_dir)
+        store = logjam.state.open_store(archive_dir)
+        self.addCleanup(store.close)
+        return logjam.state.UploadJournal(store)
+
+    #
+    # test_ship_path_*
+    #
+
+    def test_ship_path(self):
+        with temporary_directory() as log_dir:
+            filename = 'flask-20130727T0000Z-i-34aea3fe.log'
+            contents = ''.join('line %d\n' % i for i in range(1000))
+            path = self._make_logfile(log_dir, filename, contents)
+            journal = self._make_journal(os.path.join(log_dir, 'archive'))
+            uploader = MockStreamUploader()
+
+            actual = logjam.ship.ship_path(
+                path, logjam.compress.StreamEngine(), '.gz', uploader,
+                journal)
+
+            self.assertEqual(filename + '.gz', actual)
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual(
+                contents, self._gunzip(uploader.uploaded[filename + '.gz']))
+            self.assertEqual(
+                set([filename + '.gz']),
+                journal.get_uploaded([filename + '.gz']))
+            self.assertEqual(['.logjam'], os.listdir(
+                os.path.join(log_dir, 'archive')))
+
+    def test_ship_path_keep(self):
+        with temporary_directory() as log_dir:
+            filename = 'flask-20130727T0000Z-i-34aea3fe.log'
+            contents = ''.join('line %d\n' % i for i in range(1000))
+            path = self._make_logfile(log_dir, filename, contents)
+            archive_dir = os.path.join(log_dir, 'archive')
+            journal = self._make_journal(archive_dir)
+            uploader = MockStreamUploader()
+
+            actual = logjam.ship.ship_path(
+                path, ('gzip', '-c'), '.gz', uploader, journal,
+                archive_dir=archive_dir)
+
+            self.assertEqual(filename + '.gz', actual)
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual(['archive'], os.listdir(log_dir))
+            with open(os.path.join(archive_dir, actual), 'rb') as f:
+                self.assertEqual(uploader.uploaded[actual], f.read())
+            self.assertEqual(
+                contents, self._gunzip(uploader.uploaded[actual]))
+
+    def test_ship_path_upload_fails(self):
+        with temporary_directory() as log_dir:
+            filename = 'flask-20130727T0000Z-i-34aea3fe.log'
+            path = self._make_logfile(log_dir, filename, 'foo\n')
+            archive_dir = os.path.join(log_dir, 'archive')
+            journal = self._make_journal(archive_dir)
+            uploader = MockStreamUploader(fail=True)
+
+            actual = logjam.ship.ship_path(
+                path, logjam.compress.StreamEngine(), '.gz', uploader,
+                journal, archive_dir=archive_dir)
+
+            self.assertIsNone(actual)
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual(
+                sorted(['archive', filename]), sorted(os.listdir(log_dir)))
+            self.assertEqual(['.logjam'], os.listdir(archive_dir))
+            self.assertEqual(set(), journal.get_uploaded([filename + '.gz']))
+
+    def test_ship_path_compress_fails(self):
+        with temporary_directory() as log_dir:
+            filename = 'flask-20130727T0000Z-i-34aea3fe.log'
+            path = self._make_logfile(log_dir, filename, 'foo\n')
+            journal = self._make_journal(os.path.join(log_dir, 'archive'))
+            uploader = MockStreamUploader()
+
+            actual = logjam.ship.ship_path(
+                path, ('false',), '.gz', uploader, journal)
+
+            self.assertIsNone(actual)
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual([filename + '.gz'], uploader.cancelled)
+            self.assertEqual({}, uploader.uploaded)
+
+    #
+    # test_ship_service_*
+    #
+
+    def test_ship_service_run(self):
+        with temporary_directory() as log_dir:
+            filenames = [
+                'flask-20130727T0000Z-i-34aea3fe.log',
+                'flask-20130727T0100Z-i-34aea3fe.log',
+            ]
+            for filename in filenames:
+                self._make_logfile(log_dir, filename, 'foo\n')
+            uploader = MockStreamUploader()
+
+            ship_service = logjam.ship.ShipService(
+                log_dir, 's3://bucket/{prefix}/{filename}',
+                logjam.compress.StreamEngine(), '.gz', uploader=uploader)
+            self.addCleanup(ship_service.journal.store.close)
+
+            self.assertEqual(
+                sorted(fn + '.gz' for fn in filenames),
+                sorted(ship_service.run()))
+            self.assertEqual(['archive'], os.listdir(log_dir))
+            self.assertEqual([], ship_service.run())
+
+    def test_ship_service_run_after_failure(self):
+        with temporary_directory() as log_dir:
+            filenames = [
+                'flask-20130727T0000Z-i-34aea3fe.log',
+                'flask-20130727T0100Z-i-34aea3fe.log',
+            ]
+            for filename in filenames:
+                self._make_logfile(log_dir, filename, 'foo\n')
+            bucket = FlakyMockS3Bucket('bucket')
+            uploader = logjam.s3_uploader.S3Uploader(
+                's3://bucket/{prefix}/{year}/{month}/{day}/{filename}',
+                connect_s3=lambda: MockS3Connection(bucket))
+
+            ship_service = logjam.ship.ShipService(
+                log_dir, uploader.upload_uri,
+                logjam.compress.StreamEngine(), '.gz', uploader=uploader)
+            self.addCleanup(ship_service.journal.store.close)
+
+            # The first upload fails, but the next still ships.
+            self.assertEqual([filenames[1] + '.gz'], ship_service.run())
+            self.assertEqual(
+                ['flask/2013/07/27/' + filenames[1] + '.gz'],
+                bucket.keys.keys())
+
+            # And the first ships on the next run, after reconnecting.
+            self.assertEqual([filenames[0] + '.gz'], ship_service.run())
+            self.assertEqual(2, len(bucket.keys))
@@ -0,0 +1,269 @@
+""" tests for logjam.state """
+
+import contextlib
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import logjam.parse
+import logjam.state
+
+
+@contextlib.contextmanager
+def temporary_directory():
+    tempdir = None
+    try:
+        tempdir = tempfile.mkdtemp()
+        yield tempdir
+    finally:
+        if tempdir and os.path.isdir(tempdir):
+            shutil.rmtree(tempdir)
+
+
+def create_files(dir_path, *filenames):
+    for filename in filenames:
+        with open(os.path.join(dir_path, filename), 'w'):
+            pass
+
+
+class CountingListdir(object):
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, path):
+        self.calls += 1
+        return os.listdir(path)
+
+
+class TestStateStore(unittest.TestCase):
+
+    def test_get_archive_dir(self):
+        self.assertEqual(
+            '/var/log/archive',
+            logjam.state.get_archive_dir('/var/log/archive'))
+        self.assertEqual(
+            '/var/log/archive',
+            logjam.state.get_archive_dir('/var/log/archive/.logjam/bundles'))
+        self.assertEqual('archive', logjam.state.get_archive_dir('archive'))
+
+    def test_open_store_of_state_subdir(self):
+        with temporary_directory() as archive_dir:
+            bundle_dir = os.path.join(
+                archive_dir, logjam.state.STATE_DIRNAME, 'bundles')
+            os.makedirs(bundle_dir)
+            store = logjam.state.open_store(bundle_dir)
+            self.addCleanup(store.close)
+            self.assertEqual(
+                logjam.state.store_path(archive_dir), store.path)
+            self.assertEqual([], os.listdir(bundle_dir))
+
+
+class TestScanCache(unittest.TestCase):
+
+    #
+    # Helpers
+    #
+
+    def _make_cache(self, archive_dir, listdir=None, time_func=None):
+        store = logjam.state.open_store(archive_dir)
+        self.addCleanup(store.close)
+        kwargs = {}
+        if listdir is not None:
+            kwargs['listdir'] = listdir
+        if time_func is not None:
+            kwargs['time_func'] = time_func
+        return logjam.state.ScanCache(store, **kwargs)
+
+    def _backdate(self, dir_path, secs=60):
+        mtime = os.stat(dir_path).st_mtime - secs
+        os.utime(dir_path, (mtime, mtime))
+
+    #
+    # test_list_logfiles_*
+    #
+
+    def test_list_logfiles(self):
+        pf = logjam.parse.parse_filename
+        with temporary_directory() as temp_dir:
+            log_dir = os.path.join(temp_dir, 'logs')
+            os.mkdir(log_dir)
+            create_files(
+                log_dir,
+                'haproxy-20130727T1300Z.log',
+                'haproxy-20130727T1400Z.log',
+                'messages',
+            )
+            cache = self._make_cache(temp_dir)
+            expected = [
+                pf('haproxy-20130727T1300Z.log'),
+                pf('haproxy-20130727T1400Z.log'),
+            ]
+            actual = sorted(cache.list_logfiles(log_dir))
+            self.assertEqual(expected, actual)
+
+    def test_list_logfiles_unchanged_dir_not_relisted(self):
+        with temporary_directory() as temp_dir:
+            log_dir = os.path.join(temp_dir, 'logs')
+            os.mkdir(log_dir)
+            create_files(log_dir, 'haproxy-20130727T1300Z.log')
+            self._backdate(log_dir)
+
+            listdir = CountingListdir()
+            cache = self._make_cache(temp_dir, listdir=listdir)
+            cache.list_logfiles(log_dir)
+            cache.list_logfiles(log_dir)
+            self.assertEqual(1, listdir.calls)
+
+            # ... even after a restart.
+            cache = self._make_cache(temp_dir, listdir=listdir)
+            self.assertEqual(1, len(cache.list_logfiles(log_dir)))
+            self.assertEqual(1, listdir.calls)
+
+            # Changing the directory means it's listed again.
+            create_files(log_dir, 'haproxy-20130727T1400Z.log')
+            os.unlink(os.path.join(log_dir, 'haproxy-20130727T1300Z.log'))
+            self.assertEqual(
+                ['haproxy-20130727T1400Z.log'],
+                [lf.filename for lf in cache.list_logfiles(log_dir)]
+            )
+            self.assertEqual(2, listdir.calls)
+
+    def test_list_logfiles_racy_mtime_relisted(self):
+        with temporary_directory() as temp_dir:
+            log_dir = os.path.join(temp_dir, 'logs')
+            os.mkdir(log_dir)
+            create_files(log_dir, 'haproxy-20130727T1300Z.log')
+
+            listdir = CountingListdir()
+            cache = self._make_cache(temp_dir, listdir=listdir)
+            cache.list_logfiles(log_dir)
+            cache.list_logfiles(log_dir)
+            self.assertEqual(2, listdir.calls)
+
+    #
+    # test_set_stage_*
+    #
+
+    def test_set_stage(self):
+        with temporary_directory() as temp_dir:
+            log_dir = os.path.join(temp_dir, 'logs')
+            os.mkdir(log_dir)
+            create_files(
+                log_dir,
+                'haproxy-20130727T1300Z.log',
+                'haproxy-20130727T1400Z.log',
+            )
+            self._backdate(log_dir)
+
+            cache = self._make_cache(temp_dir)
+            cache.set_stage(
+                log_dir, ['haproxy-20130727T1300Z.log'],
+                logjam.state.STAGE_UPLOADED
+            )
+            expected = ['haproxy-20130727T1400Z.log']
+            actual = [
+                lf.filename for lf in cache.list_logfiles(
+                    log_dir, exclude_stage=logjam.state.STAGE_UPLOADED)
+            ]
+            self.assertEqual(expected, actual)
+
+            # Stages persist across restarts.
+            cache = self._make_cache(temp_dir)
+            actual = [
+                lf.filename for lf in cache.list_logfiles(
+                    log_dir, exclude_stage=logjam.state.STAGE_UPLOADED)
+            ]
+            self.assertEqual(expected, actual)
+
+
+class TestMultipartState(unittest.TestCase):
+
+    def test_start_add_part_finish(self):
+        with temporary_directory() as archive_dir:
+            store = logjam.state.open_store(archive_dir)
+            self.addCleanup(store.close)
+            mp_state = logjam.state.MultipartState(
+                store, time_func=lambda: 1000.0)
+
+            self.assertIsNone(mp_state.get('bucket', 'a/key'))
+
+            mp_state.start('bucket', 'a/key', 'upload-1', 4, 10, 500.0)
+            mp_state.add_part('upload-1', 1, 'etag1')
+            mp_state.add_part('upload-1', 3, 'etag3')
+            self.assertEqual(
+                logjam.state.MultipartUpload(
+                    'upload-1', 4, 10, 500.0, 1000.0,
+                    {1: 'etag1', 3: 'etag3'}),
+                mp_state.get('bucket', 'a/key')
+            )
+
+            # Starting afresh forgets the parts of the old upload.
+            mp_state.start('bucket', 'a/key', 'upload-2', 4, 10, 500.0)
+            self.assertEqual(
+                {}, mp_state.get('bucket', 'a/key').etags)
+
+            mp_state.finish('bucket', 'a/key')
+            self.assertIsNone(mp_state.get('bucket', 'a/key'))
+            self.assertEqual(
+                [], store.query('SELECT * FROM multipart_parts'))
+
+
+class TestManifest(unittest.TestCase):
+
+    def test_listing_and_uploads(self):
+        with temporary_directory() as archive_dir:
+            store = logjam.state.open_store(archive_dir)
+            self.addCleanup(store.close)
+            now = [1000.0]
+            manifest = logjam.state.Manifest(
+                store, time_func=lambda: now[0])
+
+            self.assertEqual(set(), manifest.get_listed(['s3://b/a/'], 60))
+
+            manifest.set_listing('s3://b/a/', ['s3://b/a/1'], ['s3://b/a/2'])
+            manifest.add_uploaded(['s3://b/a/3'])
+            self.assertEqual(
+                set(['s3://b/a/']),
+                manifest.get_listed(['s3://b/a/', 's3://b/c/'], 60))
+            self.assertEqual(
+                set(['s3://b/a/1', 's3://b/a/3']),
+                manifest.get_uploaded(
+                    ['s3://b/a/1', 's3://b/a/2', 's3://b/a/3']))
+
+            now[0] += 61
+            self.assertEqual(set(), manifest.get_listed(['s3://b/a/'], 60))
+
+            manifest.set_listing('s3://b/a/', [], ['s3://b/a/1'])
+            self.assertEqual(
+                set(['s3://b/a/3']),
+                manifest.get_uploaded(['s3://b/a/1', 's3://b/a/3']))
+
+    def test_get_uploaded_many_uris(self):
+        with temporary_directory() as archive_dir:
+            store = logjam.state.open_store(archive_dir)
+            self.addCleanup(store.close)
+            manifest = logjam.state.Manifest(store)
+            uris = ['s3://b/a/{}'.format(i) for i in range(2000)]
+            manifest.add_uploaded(uris[::2])
+            self.assertEqual(set(uris[::2]), manifest.get_uploaded(uris))
+
+
+class TestUploadJournal(unittest.TestCase):
+
+    def test_add_bundle(self):
+        with temporary_directory() as archive_dir:
+            store = logjam.state.open_store(archive_dir)
+            self.addCleanup(store.close)
+            journal = logjam.state.UploadJournal(store)
+
+            journal.add(['a.log.gz'])
+            journal.add_bundle('bundle.tar', ['b.log.gz', 'c.log.gz'])
+            self.assertEqual(
+                set(['a.log.gz', 'b.log.gz', 'c.log.gz']),
+                journal.get_uploaded(
+                    ['a.log.gz', 'b.log.gz', 'c.log.gz', 'd.log.gz']))
+            self.assertEqual(
+                {'b.log.gz': 'bundle.tar', 'c.log.gz': 'bundle.tar'},
+                journal.get_bundles(['a.log.gz', 'b.log.gz', 'c.log.gz']))
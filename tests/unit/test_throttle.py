@@ -0,0 +1,99 @@
+""" tests for logjam.throttle """
+
+import cStringIO
+import threading
+import unittest
+
+import logjam.throttle
+
+
+class MockClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.sleeps.append(secs)
+        self.now += secs
+
+
+class TestThrottle(unittest.TestCase):
+
+    #
+    # test_token_bucket_*
+    #
+
+    def _make_bucket(self, rate, burst=None):
+        clock = MockClock()
+        bucket = logjam.throttle.TokenBucket(
+            rate, burst, time_func=clock.time, sleep=clock.sleep)
+        return bucket, clock
+
+    def test_token_bucket_allows_burst(self):
+        bucket, clock = self._make_bucket(100)
+        bucket.consume(60)
+        bucket.consume(40)
+        self.assertEqual([], clock.sleeps)
+
+    def test_token_bucket_limits_rate(self):
+        bucket, clock = self._make_bucket(100, burst=10)
+        for _ in range(10):
+            bucket.consume(50)
+        # 500 bytes, less the burst, at 100 bytes/sec.
+        self.assertAlmostEqual(4.9, clock.now)
+
+    def test_token_bucket_refills(self):
+        bucket, clock = self._make_bucket(100)
+        bucket.consume(100)
+        clock.now += 0.5
+        bucket.consume(50)
+        self.assertEqual([], clock.sleeps)
+        clock.now += 10
+        bucket.consume(150)
+        # Never refilled beyond the burst.
+        self.assertEqual([0.5], clock.sleeps)
+
+    def test_token_bucket_shared_between_threads(self):
+        bucket, clock = self._make_bucket(1000, burst=0)
+        lock = threading.Lock()
+
+        def _sleep(secs):
+            with lock:
+                clock.sleeps.append(secs)
+        bucket.sleep = _sleep
+
+        threads = [
+            threading.Thread(target=bucket.consume, args=(100,))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Each thread waits its turn behind those before it.
+        self.assertEqual([0.1, 0.2, 0.3, 0.4, 0.5],
+                         sorted(round(s, 6) for s in clock.sleeps))
+
+    #
+    # test_throttled_file_*
+    #
+
+    def test_throttled_file(self):
+        consumed = []
+
+        class MockBucket(object):
+            def consume(self, n):
+                consumed.append(n)
+
+        f = logjam.throttle.ThrottledFile(
+            cStringIO.StringIO('0123456789'), MockBucket())
+        self.assertEqual('0123', f.read(4))
+        self.assertEqual(4, f.tell())
+        self.assertEqual('456789', f.read())
+        self.assertEqual('', f.read())
+        f.seek(0)
+        self.assertEqual('01', f.read(2))
+        self.assertEqual([4, 6, 0, 2], consumed)
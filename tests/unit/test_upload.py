@@ -2,15 +2,22 @@
 
 import contextlib
 import datetime
+import errno
 import os
 import shutil
+import socket
 import tempfile
+import threading
 import unittest
 
 import boto.exception
 
 from logjam.parse import LogFile
+import logjam.bundle
 import logjam.parse
+import logjam.retry
+import logjam.schedule
+import logjam.state
 import logjam.upload
 
 
@@ -46,6 +53,7 @@ class MockUploader(object):
         self.uploaded = set()
         self.not_uploaded = set()
         self.scan_remote_count = 0
+        self.disconnect_count = 0
 
     #
     # Methods used by logjam.upload
@@ -55,6 +63,10 @@ class MockUploader(object):
         pass
 
 
+    def disconnect(self):
+        self.disconnect_count += 1
+
+
     def check_uri(self):
         pass
 
@@ -74,6 +86,91 @@ class FailingMockUploader(MockUploader):
     def upload_logfile(self, log_archive_dir, logfile):
         return boto.exception.BotoServerError(500, 'unknown reason')
 
+class CloningMockUploader(MockUploader):
+    """
+    A MockUploader whose clones share its uploaded sets, and which
+    records which threads connected a clone, and how many clones it made.
+    """
+
+    def __init__(self, upload_uri, parent=None):
+        MockUploader.__init__(self, upload_uri)
+        self.parent = parent
+        if parent is not None:
+            self.uploaded = parent.uploaded
+            self.not_uploaded = parent.not_uploaded
+        self.lock = threading.Lock()
+        self.connected_threads = []
+        self.idle_clones = []
+        self.clone_count = 0
+
+    def clone(self):
+        self.clone_count += 1
+        return self.__class__(self.upload_uri, parent=self)
+
+    def acquire_clone(self):
+        with self.lock:
+            clone = self.idle_clones.pop() if self.idle_clones else None
+        if clone is None:
+            clone = self.clone()
+        clone.connect()
+        return clone
+
+    def release_clone(self, clone):
+        with self.lock:
+            self.idle_clones.append(clone)
+
+    def connect(self):
+        if self.parent is not None:
+            with self.parent.lock:
+                self.parent.connected_threads.append(
+                    threading.current_thread().ident)
+
+    def upload_logfile(self, log_archive_dir, logfile):
+        with (self.parent or self).lock:
+            MockUploader.upload_logfile(self, log_archive_dir, logfile)
+
+
+class FlakyMockUploader(MockUploader):
+    """ A MockUploader whose uploads return errors, in turn, first. """
+
+    def __init__(self, upload_uri, errors):
+        MockUploader.__init__(self, upload_uri)
+        self.errors = list(errors)
+        self.attempts = 0
+
+    def upload_logfile(self, log_archive_dir, logfile):
+        self.attempts += 1
+        if self.errors:
+            return self.errors.pop(0)
+        MockUploader.upload_logfile(self, log_archive_dir, logfile)
+
+
+class RaisingMockUploader(FlakyMockUploader):
+    """ A FlakyMockUploader that raises its errors, as boto does. """
+
+    def upload_logfile(self, log_archive_dir, logfile):
+        error = FlakyMockUploader.upload_logfile(
+            self, log_archive_dir, logfile)
+        if error is not None:
+            raise error
+
+
+class RecordingMockUploader(MockUploader):
+    """
+    A MockUploader that records the directory and filename of each
+    upload, including of files it wasn't told of by scan_remote().
+    """
+
+    def __init__(self, upload_uri):
+        MockUploader.__init__(self, upload_uri)
+        self.uploads = []
+
+    def upload_logfile(self, log_archive_dir, logfile):
+        self.uploads.append((log_archive_dir, logfile.filename))
+        self.uploaded.add(logfile)
+        self.not_uploaded.discard(logfile)
+
+
 DEFAULT_UPLOAD_URI ='s3://logs.us-east-1/{prefix}/{year}/{month}/{day}/{filename}'
 
 
@@ -153,12 +250,259 @@ class TestUpload(unittest.TestCase):
         self.assertEqual(expected_not_uploaded, not_uploaded)
 
 
+    def test_scan_and_upload_filenames_concurrency(self):
+        uploader = CloningMockUploader(DEFAULT_UPLOAD_URI)
+        filenames = [
+            'flask-20130727T{:02d}00Z-i-34aea3fe.log.gz'.format(hour)
+            for hour in range(8)
+            ]
+
+        all_logfiles = set(
+            logjam.parse.parse_filename(fn) for fn in filenames
+            )
+        uploader.not_uploaded.update(all_logfiles)
+
+        uploaded, not_uploaded = logjam.upload.scan_and_upload_filenames(
+            '/does/not/exist/log/archive',
+            filenames,
+            uploader,
+            concurrency=3
+            )
+        self.assertEqual(all_logfiles, uploaded)
+        self.assertEqual(set(), not_uploaded)
+        self.assertEqual(all_logfiles, uploader.uploaded)
+
+        # Each worker thread connects its own clone, once.
+        self.assertTrue(1 <= len(uploader.connected_threads) <= 3)
+        self.assertEqual(
+            len(uploader.connected_threads),
+            len(set(uploader.connected_threads)))
+
+    def test_scan_and_upload_filenames_concurrently_reuses_clones(self):
+        uploader = CloningMockUploader(DEFAULT_UPLOAD_URI)
+        for hours in (range(0, 8), range(8, 16)):
+            filenames = [
+                'flask-20130727T{:02d}00Z-i-34aea3fe.log.gz'.format(hour)
+                for hour in hours
+                ]
+            uploader.not_uploaded.update(
+                map(logjam.parse.parse_filename, filenames))
+            uploaded, not_uploaded = (
+                logjam.upload.scan_and_upload_filenames(
+                    '/does/not/exist/log/archive', filenames, uploader,
+                    concurrency=3))
+            self.assertEqual(set(), not_uploaded)
+
+        # The second call reuses the clones of the first.
+        self.assertTrue(1 <= uploader.clone_count <= 3)
+        self.assertEqual(uploader.clone_count, len(uploader.idle_clones))
+        self.assertNotIn(
+            threading.current_thread().ident, uploader.connected_threads)
+
+    def test_scan_and_upload_filenames_concurrency_one_failure(self):
+
+        class FailingCloningMockUploader(CloningMockUploader):
+            def clone(self):
+                return FailingCloningMockUploader(
+                    self.upload_uri, parent=self)
+
+            def upload_logfile(self, log_archive_dir, logfile):
+                if logfile.filename == filenames[-1]:
+                    raise boto.exception.BotoServerError(500, 'unknown')
+                CloningMockUploader.upload_logfile(
+                    self, log_archive_dir, logfile)
+
+        uploader = FailingCloningMockUploader(DEFAULT_UPLOAD_URI)
+        filenames = [
+            'flask-20130727T0000Z-i-34aea3fe.log.gz',
+            'flask-20130727T0100Z-i-34aea3fe.log.gz',
+            'flask-20130727T0200Z-i-34aea3fe.log.gz',
+            ]
+        all_logfiles = set(
+            logjam.parse.parse_filename(fn) for fn in filenames
+            )
+        uploader.not_uploaded.update(all_logfiles)
+
+        uploaded, not_uploaded = logjam.upload.scan_and_upload_filenames(
+            '/does/not/exist/log/archive',
+            filenames,
+            uploader,
+            concurrency=2
+            )
+        self.assertEqual(
+            set(logjam.parse.parse_filename(fn) for fn in filenames[:-1]),
+            uploaded)
+        self.assertEqual(
+            set([logjam.parse.parse_filename(filenames[-1])]),
+            not_uploaded)
+
+    def test_scan_and_upload_filenames_retries(self):
+        uploader = FlakyMockUploader(DEFAULT_UPLOAD_URI, [
+            boto.exception.S3ResponseError(503, 'Slow Down'),
+            boto.exception.BotoServerError(500, 'unknown reason'),
+        ])
+        filename = 'flask-20130727T0000Z-i-34aea3fe.log.gz'
+        logfile = logjam.parse.parse_filename(filename)
+        uploader.not_uploaded.add(logfile)
+        sleeps = []
+        retry_policy = logjam.retry.RetryPolicy(sleep=sleeps.append)
+
+        uploaded, not_uploaded = logjam.upload.scan_and_upload_filenames(
+            '/nonexistent', [filename], uploader,
+            retry_policy=retry_policy)
+        self.assertEqual(set([logfile]), uploaded)
+        self.assertEqual(set(), not_uploaded)
+        self.assertEqual(3, uploader.attempts)
+        self.assertEqual(2, len(sleeps))
+
+    def test_scan_and_upload_filenames_retries_raised_errors(self):
+        uploader = RaisingMockUploader(DEFAULT_UPLOAD_URI, [
+            socket.error(errno.ECONNRESET, 'Connection reset by peer'),
+        ])
+        filename = 'flask-20130727T0000Z-i-34aea3fe.log.gz'
+        logfile = logjam.parse.parse_filename(filename)
+        uploader.not_uploaded.add(logfile)
+        sleeps = []
+        observed = []
+        retry_policy = logjam.retry.RetryPolicy(sleep=sleeps.append)
+        breaker = logjam.retry.CircuitBreaker()
+        breaker.record = observed.append
+
+        uploaded, not_uploaded = logjam.upload.scan_and_upload_filenames(
+            '/nonexistent', [filename], uploader,
+            retry_policy=retry_policy, breaker=breaker)
+        self.assertEqual(set([logfile]), uploaded)
+        self.assertEqual(2, uploader.attempts)
+        self.assertEqual(1, len(sleeps))
+        self.assertEqual([logjam.retry.NETWORK_ERROR, None], observed)
+
+    def test_scan_and_upload_filenames_circuit_breaker(self):
+        filenames = [
+            'flask-20130727T{:02d}00Z-i-34aea3fe.log.gz'.format(hour)
+            for hour in range(6)
+        ]
+        logfiles = map(logjam.parse.parse_filename, filenames)
+        uploader = FlakyMockUploader(
+            DEFAULT_UPLOAD_URI,
+            [boto.exception.BotoServerError(500, 'unknown reason')] * 2)
+        uploader.not_uploaded.update(logfiles)
+        breaker = logjam.retry.CircuitBreaker(
+            window=2, min_results=2, time_func=lambda: 0)
+
+        uploaded, not_uploaded = logjam.upload.scan_and_upload_filenames(
+            '/nonexistent', filenames, uploader, breaker=breaker)
+        self.assertEqual(set(), uploaded)
+        self.assertEqual(set(logfiles), not_uploaded)
+        self.assertEqual(2, uploader.attempts)
+
+    def test_scan_and_upload_filenames_local_errors_keep_circuit_closed(
+            self):
+        filenames = [
+            'flask-20130727T{:02d}00Z-i-34aea3fe.log.gz'.format(hour)
+            for hour in range(6)
+        ]
+        logfiles = map(logjam.parse.parse_filename, filenames)
+        uploader = FlakyMockUploader(
+            DEFAULT_UPLOAD_URI,
+            [IOError(errno.EACCES, 'Permission denied')] * 2)
+        uploader.not_uploaded.update(logfiles)
+        sleeps = []
+        breaker = logjam.retry.CircuitBreaker(
+            window=2, min_results=2, time_func=lambda: 0)
+
+        # The unreadable files aren't retried, and don't open the
+        # circuit for the others.
+        uploaded, not_uploaded = logjam.upload.scan_and_upload_filenames(
+            '/nonexistent', filenames, uploader,
+            retry_policy=logjam.retry.RetryPolicy(sleep=sleeps.append),
+            breaker=breaker)
+        self.assertEqual(set(logfiles[2:]), uploaded)
+        self.assertEqual(set(logfiles[:2]), not_uploaded)
+        self.assertEqual([], sleeps)
+
+    def test_scan_and_upload_filenames_adaptive_concurrency(self):
+        filenames = [
+            'flask-20130727T{:02d}00Z-i-34aea3fe.log.gz'.format(hour)
+            for hour in range(12)
+        ]
+        uploader = CloningMockUploader(DEFAULT_UPLOAD_URI)
+        uploader.not_uploaded.update(
+            map(logjam.parse.parse_filename, filenames))
+        controller = logjam.retry.AIMDController(4, initial=2)
+
+        uploaded, not_uploaded = logjam.upload.scan_and_upload_filenames(
+            '/nonexistent', filenames, uploader, concurrency=4,
+            controller=controller)
+        self.assertEqual(12, len(uploaded))
+        self.assertEqual(0, controller.in_flight)
+        self.assertGreater(controller.limit, 2)
+
+    def test_scan_and_upload_filenames_scheduler(self):
+        filenames = [
+            'flask-20130727T{:02d}00Z-i-34aea3fe.log.gz'.format(hour)
+            for hour in range(3)
+        ]
+        uploader = MockUploader(DEFAULT_UPLOAD_URI)
+        uploader.not_uploaded.update(
+            map(logjam.parse.parse_filename, filenames))
+        order = []
+        upload_logfile = uploader.upload_logfile
+
+        def _upload_logfile(log_archive_dir, logfile):
+            order.append(logfile.filename)
+            return upload_logfile(log_archive_dir, logfile)
+        uploader.upload_logfile = _upload_logfile
+
+        uploaded, not_uploaded = logjam.upload.scan_and_upload_filenames(
+            '/nonexistent', filenames, uploader,
+            scheduler=logjam.schedule.Scheduler('newest'))
+        self.assertEqual(3, len(uploaded))
+        self.assertEqual(filenames[::-1], order)
+
+    def test_scan_and_upload_filenames_bundler(self):
+        small = [
+            'flask-20130727T00{:02d}Z-i-34aea3fe.log.gz'.format(minute)
+            for minute in range(3)
+        ]
+        big = 'flask-20130727T0100Z-i-34aea3fe.log.gz'
+        uploader = RecordingMockUploader(DEFAULT_UPLOAD_URI)
+        uploader.not_uploaded.update(
+            map(logjam.parse.parse_filename, small + [big]))
+
+        with named_temporary_dir() as log_archive_dir:
+            create_logs(log_archive_dir, *small)
+            with open(os.path.join(log_archive_dir, big), 'w') as f:
+                f.write('x' * 100)
+            store = logjam.state.open_store(log_archive_dir)
+            self.addCleanup(store.close)
+            journal = logjam.state.UploadJournal(store)
+            bundler = logjam.bundle.Bundler(
+                max_size=10, min_count=2, journal=journal)
+
+            uploaded, not_uploaded = \
+                logjam.upload.scan_and_upload_filenames(
+                    log_archive_dir, small + [big], uploader,
+                    bundler=bundler)
+
+            bundle_dir = bundler.get_bundle_dir(log_archive_dir)
+            self.assertEqual(2, len(uploader.uploads))
+            self.assertEqual(bundle_dir, uploader.uploads[0][0])
+            self.assertEqual((log_archive_dir, big), uploader.uploads[1])
+            self.assertEqual([], os.listdir(bundle_dir))
+            self.assertEqual(
+                set(small + [big]), set(lf.filename for lf in uploaded))
+            self.assertEqual(set(), not_uploaded)
+            self.assertEqual(
+                set([uploader.uploads[0][1]]),
+                set(journal.get_bundles(small).values()))
+
+
     #
     # test_upload_service_run_*
     #
 
     @contextlib.contextmanager
-    def _upload_service(self, filenames):
+    def _upload_service(self, filenames, state_cache=False):
         with named_temporary_dir() as tempdir:
             tempdir = os.path.join(tempdir, 'archive')
             os.mkdir(tempdir)
@@ -177,9 +521,16 @@ class TestUpload(unittest.TestCase):
                 )
             uploader.not_uploaded.update(all_logfiles)
 
+            scan_cache = None
+            if state_cache:
+                store = logjam.state.open_store(tempdir)
+                self.addCleanup(store.close)
+                scan_cache = logjam.state.ScanCache(store)
+
             uploadService = logjam.upload.UploadService(
-                tempdir, DEFAULT_UPLOAD_URI, uploader
+                tempdir, DEFAULT_UPLOAD_URI, uploader, scan_cache=scan_cache
             )
+            self.addCleanup(uploadService.journal.store.close)
             yield tempdir, uploader, uploadService
 
 
@@ -193,13 +544,78 @@ class TestUpload(unittest.TestCase):
             tempdir, uploader, uploadService = tup
             uploadService.run()
             marked = sorted(
-                os.listdir(os.path.join(tempdir, '.uploaded'))
+                uploadService.journal.get_uploaded(os.listdir(tempdir))
             )
             assert filenames == marked
             assert set(filenames) == set(
                 u.filename for u in uploader.uploaded)
             assert 0 == len(uploader.not_uploaded)
 
+    def test_upload_service_migrates_marker_dir(self):
+        with named_temporary_dir() as tempdir:
+            tempdir = os.path.join(tempdir, 'archive')
+            marker_dir = os.path.join(tempdir, '.uploaded')
+            os.makedirs(marker_dir)
+
+            filenames = [
+               'flask-20130727T0000Z-i-34aea3fe.log.gz',
+               'flask-20130727T0100Z-i-34aea3fe.log.gz',
+               'flask-20130727T0200Z-i-34aea3fe.log.gz',
+            ]
+            create_logs(tempdir, *filenames)
+            create_logs(marker_dir, *filenames[:2])
+
+            uploader = MockUploader(DEFAULT_UPLOAD_URI)
+            uploader.not_uploaded.add(
+                logjam.parse.parse_filename(filenames[2]))
+            uploadService = logjam.upload.UploadService(
+                tempdir, DEFAULT_UPLOAD_URI, uploader)
+            self.addCleanup(uploadService.journal.store.close)
+
+            self.assertFalse(os.path.exists(marker_dir))
+            self.assertEqual(
+                set(filenames[:2]),
+                uploadService.journal.get_uploaded(filenames))
+
+            uploadService.run()
+            self.assertEqual(
+                set(filenames),
+                uploadService.journal.get_uploaded(filenames))
+            self.assertEqual(
+                set(filenames[2:]),
+                set(u.filename for u in uploader.uploaded))
+
+    def test_upload_service_run_keeps_uploader(self):
+        filenames = [
+           'flask-20130727T0000Z-i-34aea3fe.log.gz',
+           'flask-20130727T0100Z-i-34aea3fe.log.gz',
+        ]
+        with named_temporary_dir() as tempdir:
+            create_logs(tempdir, *filenames)
+            uploaders = []
+
+            def get_uploader(upload_uri, **kwargs):
+                uploaders.append(FailingMockUploader(upload_uri))
+                uploaders[-1].not_uploaded.update(
+                    map(logjam.parse.parse_filename, filenames))
+                return uploaders[-1]
+
+            uploadService = logjam.upload.UploadService(
+                tempdir, DEFAULT_UPLOAD_URI)
+            self.addCleanup(uploadService.journal.store.close)
+            original_get_uploader = logjam.upload.get_uploader
+            logjam.upload.get_uploader = get_uploader
+            self.addCleanup(
+                setattr, logjam.upload, 'get_uploader',
+                original_get_uploader)
+
+            uploadService.run()
+            uploadService.run()
+            self.assertEqual(1, len(uploaders))
+            # Failed uploads drop the connection, so it's made afresh
+            # (and the URI checked again) on the next run.
+            self.assertEqual(2, uploaders[0].disconnect_count)
+
     # make sure that run() doesn't call scan_remote() when it doesn't
     # need to
     def test_upload_service_run_scans_remote_once(self):
@@ -238,9 +654,37 @@ class TestUpload(unittest.TestCase):
             filenames.extend(more_filenames)
 
             marked = sorted(
-                os.listdir(os.path.join(tempdir, '.uploaded'))
+                uploadService.journal.get_uploaded(os.listdir(tempdir))
             )
             assert filenames == marked
             assert set(filenames) == set(
                 u.filename for u in uploader.uploaded)
             assert 0 == len(uploader.not_uploaded)
+
+
+    def test_upload_service_run_twice_state_cache(self):
+        filenames = [
+           'flask-20130727T0000Z-i-34aea3fe.log.gz',
+           'flask-20130727T0100Z-i-34aea3fe.log.gz',
+           'flask-20130727T0200Z-i-34aea3fe.log.gz',
+        ]
+        with self._upload_service(filenames, state_cache=True) as tup:
+            tempdir, uploader, uploadService = tup
+            uploadService.run()
+            assert 1 == uploader.scan_remote_count
+            uploadService.run()
+            assert 1 == uploader.scan_remote_count
+
+            more_filenames = [
+               'flask-20130727T0300Z-i-34aea3fe.log.gz',
+            ]
+            create_logs(tempdir, *more_filenames)
+            uploader.not_uploaded.update(
+                logjam.parse.parse_filename(fn) for fn in more_filenames
+            )
+            uploadService.run()
+            filenames.extend(more_filenames)
+
+            assert set(filenames) == set(
+                u.filename for u in uploader.uploaded)
+            assert 0 == len(uploader.not_uploaded)